@@ -0,0 +1,431 @@
+# asgi.py
+# ASGI 服务模式：与 main.py 相同的路由和 JSON 格式，运行在 ASGI（Starlette + uvicorn）上的线程池化前端。
+# 事件循环只负责网络 I/O；会话处理、模型调用（同步的 strands 调用，生成期间各占一个线程）、S3 上传和提交转录作业
+# 在有上限的线程池中执行，空闲连接和等待转录结果的连接不占用线程。转录作业由后台调度器统一轮询。
+# /ws 为每个训练会话提供一条 WebSocket 双工通道，承载对话消息、流式回复事件和边录边传的麦克风音频。
+#
+# 用法：
+#   pip install starlette uvicorn python-multipart
+#   python asgi.py
+#   # 或：uvicorn asgi:app --workers 2 --limit-concurrency 500
+
+import functools
+import json
+import os
+from contextlib import asynccontextmanager
+
+import anyio
+import anyio.to_thread
+import anyio.from_thread
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
+
+# 会话、模型和转录调度器与 Flask 版本共用同一套初始化
+from main import (
+    AUDIO_MIMETYPE_FORMATS, TranscriptionUploadError, _parse_chat_request, coach_agent, session_manager,
+    start_transcription, transcription_scheduler, warm_up,
+)
+from utils import metrics
+from utils.transcription import UploadTooLargeError
+
+# 同时执行阻塞调用（模型调用、S3 上传）的线程数上限
+ASGI_MAX_THREADS = int(os.getenv("ASGI_MAX_THREADS", 200))
+# SSE 每个连接最多缓冲的事件数，客户端读取过慢时模型输出线程会在此等待
+STREAM_BUFFER_EVENTS = int(os.getenv("ASGI_STREAM_BUFFER_EVENTS", 64))
+# WebSocket 每个连接最多缓冲的音频分片数，转录流程读取不及时时暂停接收，由 TCP 把背压传给浏览器
+WS_AUDIO_BUFFER_CHUNKS = int(os.getenv("ASGI_WS_AUDIO_BUFFER_CHUNKS", 32))
+# WebSocket 等待转录结果时检查作业状态的间隔（秒）；只读取内存中的作业状态，Transcribe 由后台调度器轮询
+WS_TRANSCRIPT_CHECK_INTERVAL = float(os.getenv("ASGI_WS_TRANSCRIPT_CHECK_INTERVAL", 0.2))
+
+# 每轮教练评估与医生回复所用的线程池与线程上限保持一致（未显式配置 TURN_PIPELINE_WORKERS 时），
+# 不再把同时处理的轮次限制在 Flask 模式的默认 16 个线程；实际的模型并发由 MODEL_MAX_CONCURRENCY 控制
+if not os.getenv("TURN_PIPELINE_WORKERS"):
+    coach_agent.resize_executor(ASGI_MAX_THREADS)
+
+_socket_connections = 0
+metrics.register_gauge("medcoach_websocket_connections", "Open WebSocket session channels.", lambda: _socket_connections)
+
+
+class _AsyncBodyReader:
+    """把 ASGI 请求体（异步迭代器）包装成同步 file-like，供工作线程中的 boto3 分片上传边收边传"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks.__aiter__()
+        self._buffer = bytearray()
+        self._eof = False
+
+    async def _next_chunk(self) -> bytes | None:
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = anyio.from_thread.run(self._next_chunk)
+            if chunk is None:
+                self._eof = True
+            else:
+                self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class _SocketAudioReader(_AsyncBodyReader):
+    """WebSocket 音频分片 -> 同步 file-like。连接在录音结束前断开时读取方收到异常，不会把半段录音当作完整录音转录"""
+
+    def __init__(self, chunks):
+        super().__init__(chunks)
+        self.aborted = False
+
+    def read(self, size: int = -1) -> bytes:
+        data = super().read(size)
+        if self._eof and self.aborted:
+            raise ConnectionError("录音传输中断")
+        return data
+
+
+def _run_chat(user_message: str, session) -> list:
+    with session.lock:
+        responses = coach_agent.handle_message(user_message, session=session)
+        session_manager.save(session)
+    return responses
+
+
+async def chat(request):
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = {}
+        user_message, session_id, error = _parse_chat_request(data or {})
+        if error:
+            return JSONResponse({"error": error}, status_code=400)
+
+        session = await anyio.to_thread.run_sync(session_manager.get_or_create, session_id)
+        agent_responses = await anyio.to_thread.run_sync(_run_chat, user_message, session)
+
+        if not isinstance(agent_responses, list):
+            print(f"Warning: agent_responses was not a list: {agent_responses}")
+            agent_responses = [f"System: 处理时发生内部错误。收到的响应: {str(agent_responses)}"]
+
+        return JSONResponse({"responses": agent_responses, "session_id": session.session_id})
+
+    except Exception as e:
+        print(f"Error in /chat endpoint: {str(e)}")
+        return JSONResponse({"responses": [f"System: 服务器处理请求时发生错误: {str(e)}"]}, status_code=500)
+
+
+async def chat_stream(request):
+    """与 /chat 相同的对话处理，但以 Server-Sent Events 逐 token 推送每一行回复"""
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    user_message, session_id, error = _parse_chat_request(data or {})
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+
+    session = await anyio.to_thread.run_sync(session_manager.get_or_create, session_id)
+
+    def sse(event):
+        return f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+    async def generate():
+        send_stream, receive_stream = anyio.create_memory_object_stream(STREAM_BUFFER_EVENTS)
+
+        def produce():
+            # 在单个工作线程中持有会话锁并消费 agent 的事件生成器；缓冲区满时阻塞在 send 上形成背压
+            try:
+                with session.lock:
+                    try:
+                        for event in coach_agent.stream_message(user_message, session=session):
+                            anyio.from_thread.run(send_stream.send, event)
+                    finally:
+                        # 客户端中途断开时本轮已修改的内存状态同样写入存储后端
+                        session_manager.save(session)
+            except anyio.BrokenResourceError:
+                pass  # 客户端已断开
+            finally:
+                anyio.from_thread.run_sync(send_stream.close)
+
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(anyio.to_thread.run_sync, produce)
+            async with receive_stream:
+                async for event in receive_stream:
+                    yield sse(event)
+        yield sse({"type": "done", "session_id": session.session_id})
+
+    return StreamingResponse(
+        generate(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+async def _get_audio_upload(request):
+    """与 main._get_audio_upload 相同的两种上传方式，返回 (stream, file_extension, error)"""
+    mimetype = request.headers.get('content-type', '').split(';', 1)[0].strip().lower()
+    if mimetype.startswith('audio/') or mimetype == 'application/octet-stream':
+        subtype = mimetype.split('/', 1)[1]
+        file_extension = request.query_params.get('format') or AUDIO_MIMETYPE_FORMATS.get(subtype, subtype)
+        if file_extension == 'octet-stream':
+            file_extension = 'webm'
+        return _AsyncBodyReader(request.stream()), file_extension, None
+
+    form = await request.form()
+    audio_file = form.get('audio')
+    if audio_file is None or isinstance(audio_file, str):
+        return None, None, "没有音频文件上传"
+    if not audio_file.filename:
+        return None, None, "文件名为空"
+    file_extension = audio_file.filename.rsplit('.', 1)[-1] if '.' in audio_file.filename else 'webm'
+    return audio_file.file, file_extension, None
+
+
+async def transcribe(request):
+    """上传音频并提交 Amazon Transcribe 作业，立即返回 job_id；结果通过 GET /transcribe/<job_id> 查询"""
+    with metrics.trace("transcribe_request"):
+        return await _transcribe(request)
+
+
+async def _transcribe(request):
+    try:
+        max_upload_bytes = int(os.getenv('TRANSCRIBE_MAX_UPLOAD_BYTES', 25 * 1024 * 1024))
+        content_length = request.headers.get('content-length')
+        if content_length and content_length.isdigit() and int(content_length) > max_upload_bytes:
+            return JSONResponse({"error": f"音频文件超过大小上限 {max_upload_bytes} 字节"}, status_code=413)
+
+        s3_bucket = os.getenv('AWS_S3_BUCKET')
+        if not s3_bucket:
+            return JSONResponse({"error": "AWS_S3_BUCKET 环境变量未配置。请配置 S3 存储桶以使用转录服务。"}, status_code=500)
+
+        audio_stream, file_extension, error = await _get_audio_upload(request)
+        if error:
+            return JSONResponse({"error": error}, status_code=400)
+
+        # 去重、预处理、上传和提交与 Flask 版本共用同一流程，在工作线程中执行
+        try:
+            job, preprocess_stats = await anyio.to_thread.run_sync(
+                start_transcription, audio_stream, file_extension, s3_bucket, max_upload_bytes,
+            )
+        except UploadTooLargeError as too_large:
+            return JSONResponse({"error": str(too_large)}, status_code=413)
+        except TranscriptionUploadError as upload_error:
+            return JSONResponse({"error": str(upload_error)}, status_code=500)
+        return _job_response(job, preprocess_stats)
+
+    except Exception as e:
+        print(f"Error in /transcribe endpoint: {str(e)}")
+        return JSONResponse({"error": f"转录服务错误: {str(e)}"}, status_code=500)
+
+
+def _job_response(job, preprocess_stats: dict | None = None) -> JSONResponse:
+    if job.status == "FAILED":
+        return JSONResponse({"error": job.error}, status_code=500)
+    result = job.to_dict()
+    if preprocess_stats is not None:
+        result["preprocess"] = preprocess_stats
+    return JSONResponse(result, status_code=200 if job.status == "COMPLETED" else 202)
+
+
+async def transcribe_status(request):
+    """查询转录作业状态：IN_PROGRESS / COMPLETED (含 text) / FAILED (含 error)"""
+    job_id = request.path_params['job_id']
+    job = transcription_scheduler.get(job_id, include_shared=False)
+    if job is None:
+        # 由其他 worker 受理的作业：从共享存储读取快照（阻塞 I/O，放到线程中执行）
+        job = await anyio.to_thread.run_sync(transcription_scheduler.get_shared, job_id)
+    if job is None:
+        return JSONResponse({"error": "转录作业不存在或结果已过期"}, status_code=404)
+    return JSONResponse(job.to_dict())
+
+
+async def session_socket(websocket):
+    """
+    训练会话的 WebSocket 通道
+
+    客户端 -> 服务端（文本帧为 JSON）：
+        {"type": "chat", "message": str, "session_id": str | null}   与 /chat/stream 相同的对话处理
+        {"type": "audio_start", "format": "webm"}                       开始一段语音输入，之后以二进制帧发送音频分片
+        {"type": "audio_end"}                                          录音结束，开始转录
+    服务端 -> 客户端：
+        与 /chat/stream 相同的 line_start / token / line / done 事件；
+        {"type": "transcript", "job_id", "status", "text" | "error"}    语音输入的转录结果；
+        {"type": "error", "error": str}                                 无法处理的消息
+    """
+    global _socket_connections
+    await websocket.accept()
+    _socket_connections += 1
+    # 所有发往客户端的事件经由同一个有界缓冲区，客户端读取过慢时模型输出线程和转录任务在此等待
+    send_stream, receive_stream = anyio.create_memory_object_stream(STREAM_BUFFER_EVENTS)
+    audio = None  # 进行中的语音输入：(音频分片发送端, 读取方)
+
+    async def sender():
+        async with receive_stream:
+            async for event in receive_stream:
+                await websocket.send_text(json.dumps(event, ensure_ascii=False))
+
+    async def run_chat(user_message: str, session_id: str | None):
+        session = await anyio.to_thread.run_sync(session_manager.get_or_create, session_id)
+
+        def produce():
+            connected = True
+            with session.lock:
+                for event in coach_agent.stream_message(user_message, session=session):
+                    if not connected:
+                        continue
+                    try:
+                        anyio.from_thread.run(send_stream.send, event)
+                    except (anyio.BrokenResourceError, anyio.ClosedResourceError):
+                        connected = False  # 连接已关闭，本轮仍处理完并保存会话
+                session_manager.save(session)
+
+        await anyio.to_thread.run_sync(produce)
+        await send_stream.send({"type": "done", "session_id": session.session_id})
+
+    async def run_transcription(reader: _SocketAudioReader, audio_receive, file_extension: str):
+        max_upload_bytes = int(os.getenv('TRANSCRIBE_MAX_UPLOAD_BYTES', 25 * 1024 * 1024))
+        s3_bucket = os.getenv('AWS_S3_BUCKET')
+        try:
+            if not s3_bucket:
+                raise TranscriptionUploadError("AWS_S3_BUCKET 环境变量未配置。请配置 S3 存储桶以使用转录服务。")
+            # 录音过程中即开始读取分片：短录音在结束时已全部在服务端，长录音边收边上传，结束后无需再上传
+            job, preprocess_stats = await anyio.to_thread.run_sync(
+                start_transcription, reader, file_extension, s3_bucket, max_upload_bytes,
+            )
+            # 调度器按 TRANSCRIBE_JOB_TIMEOUT 结束超时作业，这里再加一个上限，调度器异常时也不会永远等待
+            with anyio.fail_after(transcription_scheduler.timeout + transcription_scheduler.max_interval + 5):
+                while job.status == "IN_PROGRESS":
+                    await anyio.sleep(WS_TRANSCRIPT_CHECK_INTERVAL)
+            event = {"type": "transcript", **job.to_dict()}
+            if preprocess_stats is not None:
+                event["preprocess"] = preprocess_stats
+        except ConnectionError:
+            return
+        except UploadTooLargeError as too_large:
+            event = {"type": "transcript", "status": "FAILED", "error": str(too_large)}
+        except TimeoutError:
+            event = {"type": "transcript", "job_id": job.job_id, "status": "FAILED", "error": "转录作业超时"}
+        except Exception as e:
+            event = {"type": "transcript", "status": "FAILED", "error": f"转录服务错误: {str(e)}"}
+        finally:
+            # 转录流程提前结束（如超过大小上限）时关闭接收端，后续音频分片直接丢弃，接收循环不会因缓冲区满而阻塞
+            await audio_receive.aclose()
+        try:
+            await send_stream.send(event)
+        except (anyio.BrokenResourceError, anyio.ClosedResourceError):
+            pass
+
+    try:
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(sender)
+            try:
+                while True:
+                    message = await websocket.receive()
+                    if message["type"] == "websocket.disconnect":
+                        break
+                    if message.get("bytes") is not None:
+                        if audio is None:
+                            await send_stream.send({"type": "error", "error": "收到音频数据，但尚未开始语音输入（audio_start）"})
+                        else:
+                            try:
+                                # 缓冲区满时在此等待，暂停读取后续帧
+                                await audio[0].send(message["bytes"])
+                            except (anyio.BrokenResourceError, anyio.ClosedResourceError):
+                                pass  # 本段语音的转录已提前结束（错误已发送给客户端）
+                        continue
+
+                    try:
+                        data = json.loads(message.get("text") or "")
+                    except ValueError:
+                        data = None
+                    kind = data.get("type") if isinstance(data, dict) else None
+                    if kind == "chat":
+                        user_message, session_id, error = _parse_chat_request(data)
+                        if error:
+                            await send_stream.send({"type": "error", "error": error})
+                        else:
+                            task_group.start_soon(run_chat, user_message, session_id)
+                    elif kind == "audio_start":
+                        if audio is not None:
+                            await send_stream.send({"type": "error", "error": "上一段语音输入尚未结束"})
+                            continue
+                        audio_send, audio_receive = anyio.create_memory_object_stream(WS_AUDIO_BUFFER_CHUNKS)
+                        reader = _SocketAudioReader(audio_receive)
+                        audio = (audio_send, reader)
+                        task_group.start_soon(run_transcription, reader, audio_receive, str(data.get("format") or "webm"))
+                    elif kind == "audio_end":
+                        if audio is not None:
+                            await audio[0].aclose()
+                            audio = None
+                    else:
+                        await send_stream.send({"type": "error", "error": f"不支持的消息类型: {kind}"})
+            except WebSocketDisconnect:
+                pass
+            finally:
+                if audio is not None:
+                    audio[1].aborted = True
+                    await audio[0].aclose()
+                # 进行中的对话轮次仍会处理完并保存会话（与 SSE 断开时一致），之后发送端随之关闭
+                task_group.cancel_scope.cancel()
+    finally:
+        _socket_connections -= 1
+
+
+async def ready(request):
+    """就绪探针：预热全部完成后返回 200，否则返回 503 和各项任务的进度"""
+    status = warm_up.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+async def metrics_endpoint(request):
+    """Prometheus 格式的指标，与 Flask 版本的 /metrics 相同"""
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+@asynccontextmanager
+async def lifespan(app):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = ASGI_MAX_THREADS
+    warm_up.start()  # 后台线程执行，不阻塞开始监听
+    yield
+    # uvicorn 收到 SIGTERM 后先停止接收新连接并等待进行中的请求结束（ASGI_GRACEFUL_TIMEOUT），再执行这里的清理
+    await anyio.to_thread.run_sync(transcription_scheduler.stop)
+    await anyio.to_thread.run_sync(functools.partial(coach_agent.executor.shutdown, wait=True))
+
+
+app = Starlette(
+    routes=[
+        Route('/chat', chat, methods=['POST']),
+        Route('/chat/stream', chat_stream, methods=['POST']),
+        Route('/transcribe', transcribe, methods=['POST']),
+        Route('/transcribe/{job_id}', transcribe_status, methods=['GET']),
+        WebSocketRoute('/ws', session_socket),
+        Route('/ready', ready, methods=['GET']),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(
+        'asgi:app',
+        host=os.getenv('ASGI_HOST', '127.0.0.1'),
+        port=int(os.getenv('ASGI_PORT', 5000)),
+        workers=int(os.getenv('ASGI_WORKERS', 1)),
+        limit_concurrency=int(os.getenv('ASGI_LIMIT_CONCURRENCY', 1000)),  # 超出时返回 503
+        backlog=int(os.getenv('ASGI_BACKLOG', 2048)),
+        timeout_keep_alive=int(os.getenv('ASGI_KEEP_ALIVE', 5)),
+        timeout_graceful_shutdown=int(os.getenv('ASGI_GRACEFUL_TIMEOUT', 30)),
+    )
@@ -0,0 +1,267 @@
+# batch_grade.py
+# 离线批量评分：读取归档的训练对话（JSONL，每行一个会话），用进程池并行做规则评分，
+# 可选地通过有并发上限的线程池调用模型生成教练评估，结果增量写入 JSONL / Parquet，并支持断点续跑。
+#
+# 输入每行格式（两种任选其一）：
+#   {"session_id": "...", "conversation_log": [["Doctor 李伟", "..."], ["User", "..."], ...]}
+#   {"session_id": "...", "turns": [{"speaker": "Doctor 李伟", "text": "..."}, {"speaker": "User", "text": "..."}]}
+#
+# 用法：
+#   python batch_grade.py sessions.jsonl graded.jsonl --workers 8
+#   python batch_grade.py sessions.jsonl graded_parquet/ --format parquet --llm --llm-concurrency 4
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+
+from utils.lexicon import score_utterances
+from utils.summary import RollingEvaluation
+
+REP_SPEAKERS = ("User", "Rep")
+
+
+def _parse_session(line: str) -> dict:
+    record = json.loads(line)
+    if "turns" in record:
+        turns = [(turn["speaker"], turn["text"]) for turn in record["turns"]]
+    else:
+        turns = [tuple(turn) for turn in record.get("conversation_log", [])]
+    return {"session_id": record.get("session_id"), "turns": turns}
+
+
+def _rep_answers(turns) -> list[tuple[str, str]]:
+    """提取 (医生上一句, 代表回答) 对，忽略教练反馈和总结"""
+    pairs = []
+    last_doctor = ""
+    for speaker, text in turns:
+        if speaker.startswith("Doctor"):
+            last_doctor = text
+        elif speaker in REP_SPEAKERS:
+            pairs.append((last_doctor, text))
+    return pairs
+
+
+def _error_row(line_number: int, session_id, error: Exception) -> dict:
+    return {"session_id": session_id, "line": line_number, "error": f"{type(error).__name__}: {error}",
+            "utterances": [], "dimension_scores": {}}
+
+
+def _grade_session(session: dict, answers, scores) -> dict:
+    rolling = RollingEvaluation()
+    utterances = []
+    for index, ((doctor, rep), score) in enumerate(zip(answers, scores)):
+        rolling.update(doctor, rep)
+        utterances.append({"index": index, "doctor": doctor, "rep": rep, **score})
+    return {
+        "session_id": session["session_id"],
+        "utterances": utterances,
+        "dimension_scores": rolling.dimension_scores(),
+    }
+
+
+def grade_chunk(lines: list[str], first_line: int = 0) -> list[dict]:
+    """
+    在子进程中对一批会话做规则评分（单次自动机扫描整批代表发言）
+
+    格式错误或评分失败的会话输出一行 {"line", "error"}（line 为输入文件中从 0 开始的行号），不影响同批的其他会话。
+    """
+    parsed = []  # (行号, 会话, 代表回答) 或 (行号, None, 错误行)
+    for line_number, line in enumerate(lines, first_line):
+        if not line.strip():
+            continue
+        try:
+            session = _parse_session(line)
+            parsed.append((line_number, session, _rep_answers(session["turns"])))
+        except Exception as e:
+            parsed.append((line_number, None, _error_row(line_number, None, e)))
+
+    graded = [(line_number, session, answers) for line_number, session, answers in parsed if session is not None]
+    try:
+        all_scores = iter(score_utterances([rep for _, _, answers in graded for _, rep in answers]))
+        scores_per_session = [[next(all_scores) for _ in answers] for _, _, answers in graded]
+    except Exception:
+        scores_per_session = None  # 整批扫描失败时逐个会话评分，定位出错的会话
+
+    results = []
+    graded_index = 0
+    for line_number, session, answers in parsed:
+        if session is None:
+            results.append(answers)
+            continue
+        try:
+            scores = scores_per_session[graded_index] if scores_per_session is not None \
+                else score_utterances([rep for _, rep in answers])
+            results.append(_grade_session(session, answers, scores))
+        except Exception as e:
+            results.append(_error_row(line_number, session.get("session_id"), e))
+        graded_index += 1
+    return results
+
+
+def _read_chunks(input_path: str, skip_lines: int, chunk_size: int):
+    with open(input_path, encoding="utf-8") as f:
+        lines = islice(f, skip_lines, None)  # 空行也计入断点行数，在 grade_chunk 中跳过
+        while chunk := list(islice(lines, chunk_size)):
+            yield chunk
+
+
+class _Checkpoint:
+    """记录已处理的输入行数和 JSONL 输出的字节偏移，续跑时据此跳过输入并截断未确认的输出"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lines_done = 0
+        self.output_bytes = 0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+            self.lines_done = state["lines_done"]
+            self.output_bytes = state["output_bytes"]
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"lines_done": self.lines_done, "output_bytes": self.output_bytes}, f)
+        os.replace(tmp_path, self.path)
+
+
+class _JsonlWriter:
+    def __init__(self, path: str, checkpoint: _Checkpoint):
+        mode = "r+b" if checkpoint.lines_done and os.path.exists(path) else "wb"
+        self._file = open(path, mode)
+        self._file.truncate(checkpoint.output_bytes if mode == "r+b" else 0)
+        self._file.seek(0, os.SEEK_END)
+
+    def write(self, results: list[dict], first_line: int) -> int:
+        for result in results:
+            self._file.write((json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8"))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetWriter:
+    """每批写一个 part 文件，续跑时同名文件会被覆盖"""
+
+    def __init__(self, path: str, checkpoint: _Checkpoint):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            sys.exit("Parquet 输出需要安装 pyarrow：pip install pyarrow")
+        self._pa, self._pq = pa, pq
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, results: list[dict], first_line: int) -> int:
+        # 错误行没有逐句评分，Parquet 中不占行；进度输出中会报告错误数
+        rows = [
+            {"session_id": result["session_id"], **utterance,
+             "forbidden_hits": json.dumps(utterance["forbidden_hits"], ensure_ascii=False),
+             "dimension_scores": json.dumps(result["dimension_scores"], ensure_ascii=False)}
+            for result in results for utterance in result["utterances"]
+        ]
+        if rows:
+            table = self._pa.Table.from_pylist(rows)
+            self._pq.write_table(table, os.path.join(self.path, f"part-{first_line:09d}.parquet"))
+        return 0
+
+    def close(self):
+        pass
+
+
+def _attach_llm_evaluations(results: list[dict], llm_executor: ThreadPoolExecutor, coach_agent):
+    utterances = [utterance for result in results for utterance in result["utterances"]]
+
+    def evaluate(utterance):
+        try:
+            return coach_agent.evaluate_answer(utterance["doctor"], utterance["rep"])
+        except Exception as e:
+            return f"评估时出错: {str(e)}"
+
+    for utterance, feedback in zip(utterances, llm_executor.map(evaluate, utterances)):
+        utterance["coach_feedback"] = feedback
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="离线批量评分归档的训练对话")
+    parser.add_argument("input", help="输入 JSONL 文件，每行一个会话")
+    parser.add_argument("output", help="输出 JSONL 文件（--format parquet 时为输出目录）")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="规则评分的进程数")
+    parser.add_argument("--chunk-size", type=int, default=200, help="每批提交给子进程的会话数")
+    parser.add_argument("--llm", action="store_true", help="同时调用模型生成教练评估")
+    parser.add_argument("--llm-concurrency", type=int, default=4, help="同时进行的模型调用数上限")
+    parser.add_argument("--checkpoint", help="断点文件路径，默认为 <output>.ckpt")
+    parser.add_argument("--restart", action="store_true", help="忽略已有断点，从头开始")
+    args = parser.parse_args(argv)
+
+    checkpoint_path = args.checkpoint or f"{args.output.rstrip('/')}.ckpt"
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = _Checkpoint(checkpoint_path)
+    if checkpoint.lines_done:
+        print(f"INFO: Resuming from checkpoint, skipping {checkpoint.lines_done} sessions.")
+
+    writer = (_ParquetWriter if args.format == "parquet" else _JsonlWriter)(args.output, checkpoint)
+
+    coach_agent = llm_executor = None
+    if args.llm:
+        from utils.agent import PharmaRepCoachAgent
+        coach_agent = PharmaRepCoachAgent()
+        llm_executor = ThreadPoolExecutor(max_workers=args.llm_concurrency)
+
+    started = time.perf_counter()
+    graded_utterances = 0
+    failed_sessions = 0
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            # 流式读取输入：最多预提交 workers×2 批，结果按输入顺序写出，保证断点位置准确
+            chunks = _read_chunks(args.input, checkpoint.lines_done, args.chunk_size)
+            pending = deque()
+            submitted_lines = checkpoint.lines_done
+
+            def submit_next():
+                nonlocal submitted_lines
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    pending.append((chunk, pool.submit(grade_chunk, chunk, submitted_lines)))
+                    submitted_lines += len(chunk)
+
+            for _ in range(args.workers * 2):
+                submit_next()
+            while pending:
+                chunk, future = pending.popleft()
+                results = future.result()
+                submit_next()
+                if llm_executor is not None:
+                    _attach_llm_evaluations(results, llm_executor, coach_agent)
+                checkpoint.output_bytes = writer.write(results, checkpoint.lines_done)
+                checkpoint.lines_done += len(chunk)
+                checkpoint.save()
+
+                graded_utterances += sum(len(result["utterances"]) for result in results)
+                failed_sessions += sum(1 for result in results if "error" in result)
+                elapsed = time.perf_counter() - started
+                print(f"INFO: {checkpoint.lines_done} sessions, {graded_utterances} utterances, "
+                      f"{graded_utterances / elapsed:.1f} utterances/sec, {failed_sessions} failed")
+    finally:
+        writer.close()
+        if llm_executor is not None:
+            llm_executor.shutdown()
+
+    elapsed = time.perf_counter() - started
+    print(f"INFO: Done. Graded {graded_utterances} utterances in {elapsed:.2f}s "
+          f"({graded_utterances / elapsed if elapsed else 0:.1f} utterances/sec), {failed_sessions} sessions failed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+# benchmark.py
+# 负载 / 延迟基准：并发回放多轮训练脚本（默认为 demonstrate_chat_flow 的对话），统计每轮 /chat 的
+# p50/p95/p99 延迟、吞吐和每个会话的内存占用，结果追加到 JSONL 文件，并与上一次相同配置的结果对比。
+#
+# 默认在进程内通过 Flask test client 调用 main.py 的路由，并使用本地假模型和 S3/Transcribe 替身（不产生费用）：
+#   python benchmark.py --sessions 200 --concurrency 50
+#   python benchmark.py --sessions 50 --concurrency 20 --transcribe        # 每轮回答先经过 /transcribe（模拟语音输入）
+#   FAKE_MODEL_LATENCY=1.0 FAKE_MODEL_TOKENS_PER_SEC=30 python benchmark.py
+# 也可以压测已启动的服务（Flask 或 asgi.py），此时模型和 AWS 后端由服务端的配置决定：
+#   python benchmark.py --url http://127.0.0.1:5000 --sessions 100 --concurrency 100
+#
+# 自定义脚本为 JSON 文件：[["药品: ...。点击【Start】", "回答 1", ..., "点击【结束训练】"], ...]，每个会话轮流使用其中一个脚本。
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+DEFAULT_RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "results.jsonl")
+
+
+class _InProcessClient:
+    """通过 Flask test client 直接调用 main.py 中的路由，每个线程一个 client"""
+
+    def __init__(self):
+        from main import app, session_manager
+        self.app = app
+        self.session_manager = session_manager
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        return client
+
+    def post_json(self, path: str, payload: dict) -> tuple[int, dict]:
+        response = self._client().post(path, json=payload)
+        return response.status_code, response.get_json(silent=True) or {}
+
+    def post_audio(self, path: str, data: bytes, content_type: str) -> tuple[int, dict]:
+        response = self._client().post(path, data=data, content_type=content_type)
+        return response.status_code, response.get_json(silent=True) or {}
+
+    def get_json(self, path: str) -> tuple[int, dict]:
+        response = self._client().get(path)
+        return response.status_code, response.get_json(silent=True) or {}
+
+
+class _HttpClient:
+    def __init__(self, base_url: str, pool_size: int):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.base_url = base_url.rstrip("/")
+        self.session_manager = None
+        self.http = requests.Session()
+        self.http.mount("http://", HTTPAdapter(pool_maxsize=pool_size))
+        self.http.mount("https://", HTTPAdapter(pool_maxsize=pool_size))
+
+    def post_json(self, path: str, payload: dict) -> tuple[int, dict]:
+        response = self.http.post(self.base_url + path, json=payload, timeout=300)
+        return response.status_code, response.json()
+
+    def post_audio(self, path: str, data: bytes, content_type: str) -> tuple[int, dict]:
+        response = self.http.post(self.base_url + path, data=data, headers={"Content-Type": content_type}, timeout=300)
+        return response.status_code, response.json()
+
+    def get_json(self, path: str) -> tuple[int, dict]:
+        response = self.http.get(self.base_url + path, timeout=30)
+        return response.status_code, response.json()
+
+
+def _turn_kind(index: int, message: str, script_length: int) -> str:
+    if index == 0:
+        return "start"
+    if index == script_length - 1 or "结束训练" in message:
+        return "end"
+    return "interaction"
+
+
+def _run_session(client, script: list[str], args, samples: dict, errors: list):
+    session_id = None
+    for index, message in enumerate(script):
+        kind = _turn_kind(index, message, len(script))
+        if args.transcribe and kind == "interaction":
+            started = time.perf_counter()
+            status, body = client.post_audio("/transcribe?format=webm", os.urandom(args.audio_bytes), "audio/webm")
+            while status == 202 or body.get("status") == "IN_PROGRESS":
+                time.sleep(args.poll_interval)
+                status, body = client.get_json(f"/transcribe/{body['job_id']}")
+            if body.get("status") != "COMPLETED":
+                errors.append(f"transcribe: {body.get('error')}")
+            samples.setdefault("transcribe", []).append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        payload = {"message": message}
+        if session_id:
+            payload["session_id"] = session_id
+        status, body = client.post_json("/chat", payload)
+        elapsed = time.perf_counter() - started
+        if status != 200:
+            errors.append(f"{kind}: HTTP {status} {str(body)[:200]}")
+            return
+        session_id = body.get("session_id")
+        samples.setdefault(kind, []).append(elapsed)
+        samples.setdefault("all", []).append(elapsed)
+
+
+def _percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 1),
+        "p50_ms": round(pick(0.50) * 1000, 1),
+        "p95_ms": round(pick(0.95) * 1000, 1),
+        "p99_ms": round(pick(0.99) * 1000, 1),
+        "max_ms": round(ordered[-1] * 1000, 1),
+    }
+
+
+def _rss_bytes() -> int | None:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _previous_result(path: str, config: dict) -> dict | None:
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("config") == config:
+                previous = record
+    return previous
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="并发回放训练脚本，测量 /chat 的延迟和吞吐")
+    parser.add_argument("--sessions", type=int, default=50, help="回放的会话总数")
+    parser.add_argument("--concurrency", type=int, default=10, help="同时进行的会话数")
+    parser.add_argument("--script", help="自定义脚本 JSON 文件，默认使用 demonstrate_chat_flow 的对话")
+    parser.add_argument("--url", help="压测已启动的服务，如 http://127.0.0.1:5000；不指定时在进程内调用")
+    parser.add_argument("--real-backends", action="store_true", help="进程内模式下使用 .env 中配置的真实模型和 AWS 服务")
+    parser.add_argument("--transcribe", action="store_true", help="每轮回答前先上传一段音频并等待转录完成")
+    parser.add_argument("--audio-bytes", type=int, default=64 * 1024, help="--transcribe 时每段音频的大小")
+    parser.add_argument("--poll-interval", type=float, default=0.2, help="--transcribe 时查询转录结果的间隔（秒）")
+    parser.add_argument("--output", default=DEFAULT_RESULTS_PATH, help="结果追加写入的 JSONL 文件")
+    parser.add_argument("--label", help="本次运行的备注，写入结果文件")
+    args = parser.parse_args(argv)
+
+    if args.script:
+        with open(args.script, encoding="utf-8") as f:
+            scripts = json.load(f)
+    else:
+        from utils.agent import DEMO_CHAT_INTERACTIONS
+        scripts = [[message for speaker, message in DEMO_CHAT_INTERACTIONS if speaker == "User"]]
+
+    if args.url:
+        client = _HttpClient(args.url, args.concurrency)
+    else:
+        if not args.real_backends:
+            os.environ["MODEL_PROVIDER"] = "fake"
+            os.environ["AWS_BACKEND"] = "fake"
+            os.environ.setdefault("AWS_S3_BUCKET", "benchmark-bucket")
+        client = _InProcessClient()
+
+    # 进程内模式下扣除启动时的内存，剩余的增量视为会话状态和运行时缓存的占用
+    rss_before = _rss_bytes() if not args.url else None
+    samples: dict[str, list[float]] = {}
+    errors: list[str] = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [
+            pool.submit(_run_session, client, scripts[index % len(scripts)], args, samples, errors)
+            for index in range(args.sessions)
+        ]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - started
+    rss_after = _rss_bytes() if not args.url else None
+
+    config = {
+        "mode": "http" if args.url else ("in-process" if args.real_backends else "in-process-fake"),
+        "sessions": args.sessions,
+        "concurrency": args.concurrency,
+        "script": os.path.basename(args.script) if args.script else "demo",
+        "transcribe": args.transcribe,
+    }
+    if not args.url and not args.real_backends:
+        config["fake_model"] = {key: os.getenv(key) for key in ("FAKE_MODEL_LATENCY", "FAKE_MODEL_TOKENS_PER_SEC", "FAKE_MODEL_JITTER")}
+
+    retained_sessions = len(client.session_manager) if client.session_manager is not None else None
+    memory_per_session = None
+    if rss_before is not None and rss_after is not None and retained_sessions:
+        memory_per_session = max(rss_after - rss_before, 0) // retained_sessions
+
+    turns = len(samples.get("all", []))
+    result = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "label": args.label,
+        "config": config,
+        "elapsed_s": round(elapsed, 2),
+        "turns": turns,
+        "errors": len(errors),
+        "throughput_turns_per_s": round(turns / elapsed, 2) if elapsed else 0,
+        "throughput_sessions_per_s": round((args.sessions - len(errors)) / elapsed, 3) if elapsed else 0,
+        "latency": {kind: _percentiles(values) for kind, values in sorted(samples.items())},
+        "memory_per_session_bytes": memory_per_session,
+    }
+
+    previous = _previous_result(args.output, config)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+    print(f"INFO: {args.sessions} sessions x {len(scripts[0])} turns at concurrency {args.concurrency} "
+          f"in {elapsed:.2f}s ({result['throughput_turns_per_s']} turns/s), {len(errors)} errors.")
+    for kind, stats in result["latency"].items():
+        print(f"  {kind:<12} n={stats['count']:<6} p50={stats['p50_ms']}ms  p95={stats['p95_ms']}ms  p99={stats['p99_ms']}ms")
+    if memory_per_session is not None:
+        print(f"  memory/session ≈ {memory_per_session / 1024:.1f} KiB ({retained_sessions} sessions retained)")
+    for error in errors[:5]:
+        print(f"  error: {error}", file=sys.stderr)
+
+    if previous:
+        old, new = previous["latency"].get("all", {}), result["latency"].get("all", {})
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if old.get(key) and new.get(key):
+                change = (new[key] - old[key]) / old[key] * 100
+                print(f"  vs {previous.get('commit') or previous['timestamp']}: {key} {old[key]} -> {new[key]} ({change:+.1f}%)")
+    print(f"INFO: Results appended to {args.output}.")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
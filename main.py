@@ -1,51 +1,95 @@
-from dotenv import load_dotenv
-load_dotenv() # Load environment variables from .env file at the very beginning
+from utils.startup import WarmUp, load_env
+load_env() # Load environment variables from .env file at the very beginning
 
 # backend_app.py
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS # 方便本地开发时处理跨域问题
 from utils.agent import PharmaRepCoachAgent # 假设您的 agent 在 medical_agent.py
-import boto3
+from utils import audio_preprocess, clients, metrics
+from utils.lexicon import get_matcher
+from utils.objection_kb import get_knowledge_base
+from utils.session import SESSION_ID_PATTERN, SessionManager
+from utils.session_store import create_session_store
+from utils.transcription import (
+    HashingStream, TranscriptionScheduler, UploadTooLargeError, create_transcript_cache, upload_audio_stream,
+)
+import json
 import os
-import time
 import uuid
 
 app = Flask(__name__)
 CORS(app) # 允许所有来源的跨域请求，仅用于开发
 
-# 初始化 PharmaRepCoachAgent
+# 初始化 PharmaRepCoachAgent（模型客户端在所有会话间共享，首次使用或预热时才构建）
 coach_agent = PharmaRepCoachAgent()
+# 每个学员一份会话状态，通过请求中的 session_id 路由；配置 SESSION_STORE 后会话持久化并在多个 worker 间共享
+session_store = create_session_store()
+session_manager = SessionManager(store=session_store)
 
 # 初始化 AWS Transcribe 客户端
 def get_transcribe_client():
-    """创建并返回 Amazon Transcribe 客户端"""
-    return boto3.client(
-        'transcribe',
-        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-        region_name=os.getenv('AWS_REGION', 'us-east-1')
-    )
+    """返回进程内共享的 Amazon Transcribe 客户端"""
+    return clients.get_aws_client('transcribe')
 
 # 初始化 S3 客户端 (用于上传音频文件到 S3)
 def get_s3_client():
-    """创建并返回 S3 客户端"""
-    return boto3.client(
-        's3',
-        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-        region_name=os.getenv('AWS_REGION', 'us-east-1')
-    )
+    """返回进程内共享的 S3 客户端"""
+    return clients.get_aws_client('s3')
+
+# 服务开始监听后在后台预热模型客户端、AWS / HTTP 客户端、合规词库和异议知识库，首个请求无需再付出这些初始化开销；
+# 预热完成前请求同样可以处理（按需初始化），/ready 报告预热进度
+warm_up = WarmUp({
+    "model": coach_agent.warm_up,
+    "aws_clients": clients.warm_up,
+    "lexicon": get_matcher,
+    "objection_kb": get_knowledge_base,
+})
+
+# 转录作业后台调度器（批量轮询 + 自适应退避 + 统一清理 S3）
+# 相同录音按内容哈希去重：已完成的结果缓存在内存和 data/transcripts.sqlite3 中，进行中的相同请求合并到同一个作业
+# 作业状态同时写入会话存储后端，多 worker 部署时状态查询可以落到任意 worker
+transcription_scheduler = TranscriptionScheduler(
+    get_transcribe_client, get_s3_client, result_cache=create_transcript_cache(), job_store=session_store,
+)
+
+metrics.register_gauge("medcoach_active_sessions", "Training sessions held in memory.", lambda: len(session_manager))
+metrics.register_gauge("medcoach_transcription_jobs_in_flight", "Transcription jobs still being polled.",
+                       transcription_scheduler.in_flight_count)
+
+@app.before_request
+def _start_warm_up():
+    # 由 gunicorn 等 WSGI 服务器加载时没有 __main__ 入口，首个请求（通常是 /ready 探针）触发预热
+    warm_up.start()
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """就绪探针：预热全部完成后返回 200，否则返回 503 和各项任务的进度"""
+    status = warm_up.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+def _parse_chat_request(data):
+    """校验 /chat 与 /chat/stream 的请求体，返回 (user_message, session_id, error)"""
+    user_message = data.get('message')
+    session_id = data.get('session_id')
+    if not user_message:
+        return None, None, "Missing message in request"
+    # session_id 会用作溢出日志文件名和存储后端的 key，只接受字母、数字、下划线和连字符
+    if session_id is not None and (not isinstance(session_id, str) or not SESSION_ID_PATTERN.fullmatch(session_id)):
+        return None, None, "Invalid session_id"
+    return user_message, session_id, None
 
 @app.route('/chat', methods=['POST'])
 def chat():
     try:
         data = request.get_json()
-        user_message = data.get('message')
+        user_message, session_id, error = _parse_chat_request(data)
+        if error:
+            return jsonify({"error": error}), 400
 
-        if not user_message:
-            return jsonify({"error": "Missing message in request"}), 400
-
-        agent_responses = coach_agent.handle_message(user_message)
+        session = session_manager.get_or_create(session_id)
+        with session.lock:
+            agent_responses = coach_agent.handle_message(user_message, session=session)
+            session_manager.save(session)
         
         # 确保即使出现内部错误，也返回一个包含错误信息的列表
         if not isinstance(agent_responses, list):
@@ -55,139 +99,173 @@ def chat():
              agent_responses = [f"System: 处理时发生内部错误。收到的响应: {str(agent_responses)}"]
 
 
-        return jsonify({"responses": agent_responses})
+        return jsonify({"responses": agent_responses, "session_id": session.session_id})
 
     except Exception as e:
         print(f"Error in /chat endpoint: {str(e)}") # Log the error server-side
         # 返回一个包含错误信息的列表，以便前端可以显示
         return jsonify({"responses": [f"System: 服务器处理请求时发生错误: {str(e)}"]}), 500
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """与 /chat 相同的对话处理，但以 Server-Sent Events 逐 token 推送每一行回复"""
+    data = request.get_json(silent=True) or {}
+    user_message, session_id, error = _parse_chat_request(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    session = session_manager.get_or_create(session_id)
+
+    def sse(event):
+        return f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+    def generate():
+        with session.lock:
+            try:
+                for event in coach_agent.stream_message(user_message, session=session):
+                    yield sse(event)
+            finally:
+                # 客户端中途断开（GeneratorExit）时本轮已修改的内存状态同样写入存储后端
+                session_manager.save(session)
+        yield sse({"type": "done", "session_id": session.session_id})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+# 浏览器录音的 MIME 子类型到 Transcribe MediaFormat 的映射
+AUDIO_MIMETYPE_FORMATS = {'mpeg': 'mp3', 'x-wav': 'wav', 'wave': 'wav', 'x-flac': 'flac'}
+
+def _get_audio_upload():
+    """
+    从请求中取出音频流和文件扩展名，返回 (stream, file_extension, error)
+
+    推荐以原始请求体上传（Content-Type: audio/*，可选 ?format=webm），请求体直接流式转发到 S3；
+    仍兼容 multipart/form-data 的 audio 字段。
+    """
+    if request.mimetype.startswith('audio/') or request.mimetype == 'application/octet-stream':
+        subtype = request.mimetype.split('/', 1)[1]
+        file_extension = request.args.get('format') or AUDIO_MIMETYPE_FORMATS.get(subtype, subtype)
+        if file_extension == 'octet-stream':
+            file_extension = 'webm'
+        return request.stream, file_extension, None
+
+    # 检查是否有文件上传
+    if 'audio' not in request.files:
+        return None, None, "没有音频文件上传"
+    audio_file = request.files['audio']
+    if audio_file.filename == '':
+        return None, None, "文件名为空"
+    file_extension = audio_file.filename.rsplit('.', 1)[-1] if '.' in audio_file.filename else 'webm'
+    return audio_file.stream, file_extension, None
+
+class TranscriptionUploadError(Exception):
+    """音频上传到 S3 失败"""
+
+def start_transcription(audio_stream, file_extension: str, s3_bucket: str, max_upload_bytes: int):
+    """
+    对一段音频去重、可选预处理、上传到 S3 并提交转录作业，返回 (job, preprocess_stats)
+
+    HTTP /transcribe（Flask 与 ASGI）和 WebSocket 语音输入共用。重复的录音直接返回已有的作业（可能已完成）；
+    超过大小上限时抛出 UploadTooLargeError，上传失败时抛出 TranscriptionUploadError。
+    """
+    # 边读边计算音频哈希。短录音（不超过 TRANSCRIBE_DEDUP_PREFETCH_BYTES）先完整读入，
+    # 上传前即可判断是否重复：重复的请求直接返回已有结果或进行中的作业，不再产生任何 AWS 调用
+    audio_stream = HashingStream(audio_stream)
+    job = None
+    prefetch_bytes = min(int(os.getenv('TRANSCRIBE_DEDUP_PREFETCH_BYTES', 5 * 1024 * 1024)), max_upload_bytes)
+    if audio_stream.prefetch(prefetch_bytes):
+        job, created = transcription_scheduler.claim(audio_stream.hexdigest())
+        if not created:
+            return job, None
+
+    try:
+        # 可选：裁剪静音并转为 16 kHz 单声道 FLAC/WAV 后再上传（AUDIO_PREPROCESS=true）
+        preprocess_stats = None
+        upload_stream = audio_stream
+        if audio_preprocess.is_enabled():
+            upload_stream, file_extension, preprocess_stats = audio_preprocess.preprocess_audio(
+                audio_stream, file_extension, max_bytes=max_upload_bytes,
+            )
+
+        # 生成唯一的文件名，请求体直接流式上传到 S3，不经过本地临时文件
+        s3_key = f"transcribe-input/audio_{uuid.uuid4().hex}.{file_extension}"
+        try:
+            upload_audio_stream(get_s3_client(), upload_stream, s3_bucket, s3_key, max_bytes=max_upload_bytes)
+        except (UploadTooLargeError, ConnectionError):
+            # ConnectionError：WebSocket 语音输入的客户端中途断开，由调用方直接结束，不作为上传失败处理
+            raise
+        except Exception as s3_error:
+            raise TranscriptionUploadError(f"上传文件到 S3 失败: {str(s3_error)}") from s3_error
+    except Exception as e:
+        # 占位作业未能启动时结束它，合并到该作业上的重复请求收到同样的错误
+        if job is not None:
+            transcription_scheduler.abandon(job, str(e))
+        raise
+
+    # 提交转录作业，轮询与 S3 清理由后台调度器负责；长录音在上传完成后才得到哈希，此时再去重
+    job = transcription_scheduler.submit(
+        s3_bucket, s3_key, file_extension, job=job, audio_hash=None if job else audio_stream.hexdigest(),
+    )
+    return job, preprocess_stats
+
 @app.route('/transcribe', methods=['POST'])
 def transcribe():
-    """处理音频文件并使用 Amazon Transcribe 进行转录"""
+    """上传音频并提交 Amazon Transcribe 作业，立即返回 job_id；结果通过 GET /transcribe/<job_id> 查询"""
+    with metrics.trace("transcribe_request"):
+        return _transcribe()
+
+def _transcribe():
     try:
-        # 检查是否有文件上传
-        if 'audio' not in request.files:
-            return jsonify({"error": "没有音频文件上传"}), 400
-        
-        audio_file = request.files['audio']
-        
-        if audio_file.filename == '':
-            return jsonify({"error": "文件名为空"}), 400
-        
-        # 生成唯一的文件名
-        file_extension = audio_file.filename.rsplit('.', 1)[-1] if '.' in audio_file.filename else 'webm'
-        unique_filename = f"audio_{uuid.uuid4().hex}.{file_extension}"
-        temp_audio_path = os.path.join('/tmp', unique_filename)
-        
-        # 保存上传的音频文件到临时目录
-        audio_file.save(temp_audio_path)
-        
+        max_upload_bytes = int(os.getenv('TRANSCRIBE_MAX_UPLOAD_BYTES', 25 * 1024 * 1024))
+        if request.content_length and request.content_length > max_upload_bytes:
+            return jsonify({"error": f"音频文件超过大小上限 {max_upload_bytes} 字节"}), 413
+
         # 获取 S3 存储桶名称 (需要在环境变量中配置)
         s3_bucket = os.getenv('AWS_S3_BUCKET')
         if not s3_bucket:
-            # 如果没有配置 S3 存储桶，使用本地文件 URI (仅用于测试)
-            os.remove(temp_audio_path)
             return jsonify({"error": "AWS_S3_BUCKET 环境变量未配置。请配置 S3 存储桶以使用转录服务。"}), 500
-        
-        # 上传文件到 S3
-        s3_client = get_s3_client()
-        s3_key = f"transcribe-input/{unique_filename}"
-        
-        try:
-            s3_client.upload_file(temp_audio_path, s3_bucket, s3_key)
-        except Exception as s3_error:
-            os.remove(temp_audio_path)
-            return jsonify({"error": f"上传文件到 S3 失败: {str(s3_error)}"}), 500
-        
-        # 删除本地临时文件
-        os.remove(temp_audio_path)
-        
-        # 创建转录作业
-        transcribe_client = get_transcribe_client()
-        job_name = f"transcribe_job_{uuid.uuid4().hex}"
-        job_uri = f"s3://{s3_bucket}/{s3_key}"
-        
-        # 启动转录作业
-        try:
-            transcribe_client.start_transcription_job(
-                TranscriptionJobName=job_name,
-                Media={'MediaFileUri': job_uri},
-                MediaFormat=file_extension if file_extension in ['mp3', 'mp4', 'wav', 'flac', 'ogg', 'amr', 'webm'] else 'webm',
-                LanguageCode='zh-CN',  # 中文转录
-                Settings={
-                    'ShowSpeakerLabels': False,
-                }
-            )
-        except Exception as transcribe_error:
-            # 清理 S3 文件
-            try:
-                s3_client.delete_object(Bucket=s3_bucket, Key=s3_key)
-            except:
-                pass
-            return jsonify({"error": f"启动转录作业失败: {str(transcribe_error)}"}), 500
-        
-        # 等待转录作业完成
-        max_attempts = 60  # 最多等待 60 次（约 60 秒）
-        attempt = 0
-        
-        while attempt < max_attempts:
-            try:
-                status = transcribe_client.get_transcription_job(TranscriptionJobName=job_name)
-                job_status = status['TranscriptionJob']['TranscriptionJobStatus']
-                
-                if job_status == 'COMPLETED':
-                    # 获取转录结果
-                    transcript_file_uri = status['TranscriptionJob']['Transcript']['TranscriptFileUri']
-                    
-                    # 下载并解析转录结果
-                    import requests
-                    response = requests.get(transcript_file_uri)
-                    transcript_data = response.json()
-                    
-                    # 提取转录文本
-                    transcribed_text = transcript_data['results']['transcripts'][0]['transcript']
-                    
-                    # 清理 S3 文件
-                    try:
-                        s3_client.delete_object(Bucket=s3_bucket, Key=s3_key)
-                    except:
-                        pass
-                    
-                    return jsonify({"text": transcribed_text})
-                
-                elif job_status == 'FAILED':
-                    failure_reason = status['TranscriptionJob'].get('FailureReason', '未知原因')
-                    # 清理 S3 文件
-                    try:
-                        s3_client.delete_object(Bucket=s3_bucket, Key=s3_key)
-                    except:
-                        pass
-                    return jsonify({"error": f"转录作业失败: {failure_reason}"}), 500
-                
-                # 如果还在处理中，等待 1 秒后重试
-                time.sleep(1)
-                attempt += 1
-                
-            except Exception as status_error:
-                # 清理 S3 文件
-                try:
-                    s3_client.delete_object(Bucket=s3_bucket, Key=s3_key)
-                except:
-                    pass
-                return jsonify({"error": f"检查转录状态失败: {str(status_error)}"}), 500
-        
-        # 超时
-        # 清理 S3 文件
+
+        audio_stream, file_extension, error = _get_audio_upload()
+        if error:
+            return jsonify({"error": error}), 400
+
         try:
-            s3_client.delete_object(Bucket=s3_bucket, Key=s3_key)
-        except:
-            pass
-        return jsonify({"error": "转录作业超时"}), 500
+            job, preprocess_stats = start_transcription(audio_stream, file_extension, s3_bucket, max_upload_bytes)
+        except UploadTooLargeError as too_large:
+            return jsonify({"error": str(too_large)}), 413
+        except TranscriptionUploadError as upload_error:
+            return jsonify({"error": str(upload_error)}), 500
+        return _job_response(job, preprocess_stats)
         
     except Exception as e:
         print(f"Error in /transcribe endpoint: {str(e)}")
         return jsonify({"error": f"转录服务错误: {str(e)}"}), 500
 
+def _job_response(job, preprocess_stats: dict | None = None):
+    """提交结果：失败返回 500；已完成（去重命中）返回 200 和转录文本；进行中返回 202"""
+    if job.status == "FAILED":
+        return jsonify({"error": job.error}), 500
+    result = job.to_dict()
+    if preprocess_stats is not None:
+        result["preprocess"] = preprocess_stats  # 预处理前后的字节数和时长
+    return jsonify(result), 200 if job.status == "COMPLETED" else 202
+
+@app.route('/transcribe/<job_id>', methods=['GET'])
+def transcribe_status(job_id):
+    """查询转录作业状态：IN_PROGRESS / COMPLETED (含 text) / FAILED (含 error)"""
+    job = transcription_scheduler.get(job_id)
+    if job is None:
+        return jsonify({"error": "转录作业不存在或结果已过期"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 格式的指标（各阶段耗时直方图、模型调用与 token 计数、会话数和转录作业数）"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
+    warm_up.start()
     app.run(debug=True, port=5000) # Flask 默认运行在 5000 端口
\ No newline at end of file
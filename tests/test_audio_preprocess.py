@@ -0,0 +1,75 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from utils.audio_preprocess import FRAME_SAMPLES, SAMPLE_RATE, trim_silence
+
+
+def _tone(seconds: float, amplitude: float = 3000) -> "np.ndarray":
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    return (np.sin(2 * np.pi * 220 * t) * amplitude).astype(np.int16)
+
+
+def test_clip_shorter_than_kernel_is_kept():
+    # 0.5 秒的单词回答：帧数（16）少于默认 keep_silence 对应的卷积核（21 帧）
+    samples = (np.random.default_rng(0).standard_normal(8000) * 3000).astype(np.int16)
+    trimmed = trim_silence(samples)
+    assert len(trimmed) == len(samples)
+
+
+def test_short_clip_with_leading_silence_is_trimmed():
+    samples = np.concatenate([np.zeros(SAMPLE_RATE // 2, dtype=np.int16), _tone(0.1)])
+    trimmed = trim_silence(samples, keep_silence=0.03)
+    assert len(samples) > len(trimmed) >= int(0.1 * SAMPLE_RATE) - FRAME_SAMPLES
+
+
+def test_long_pause_is_compressed_and_padding_is_centred():
+    samples = np.concatenate([
+        np.zeros(SAMPLE_RATE, dtype=np.int16), _tone(1), np.zeros(3 * SAMPLE_RATE, dtype=np.int16), _tone(1),
+        np.zeros(SAMPLE_RATE, dtype=np.int16),
+    ])
+    trimmed = trim_silence(samples, keep_silence=0.3)
+    # 两段语音各 1 秒，首尾与中间每侧保留约 0.3 秒静音
+    assert abs(len(trimmed) / SAMPLE_RATE - 3.2) < 0.1
+
+
+def test_long_upload_skips_preprocessing_and_keeps_streaming(monkeypatch):
+    import io
+
+    from utils.audio_preprocess import preprocess_audio
+
+    monkeypatch.setenv("AUDIO_PREPROCESS_MAX_BYTES", "1000")
+    data = bytes(range(256)) * 64
+
+    class _Body:
+        def __init__(self):
+            self._buffer = io.BytesIO(data)
+            self.bytes_read = 0
+
+        def read(self, size=-1):
+            chunk = self._buffer.read(size)
+            self.bytes_read += len(chunk)
+            return chunk
+
+    body = _Body()
+    stream, extension, stats = preprocess_audio(body, "webm", max_bytes=len(data))
+    # 只读入了上限 + 1 字节，其余部分留在请求体中由上传流式读取
+    assert body.bytes_read == 1001
+    assert (extension, stats["applied"]) == ("webm", False)
+    assert stream.read(10) + stream.read() == data
+
+
+def test_encoded_output_larger_than_input_falls_back_to_original(monkeypatch):
+    import io
+
+    from utils import audio_preprocess
+
+    samples = np.concatenate([np.zeros(SAMPLE_RATE, dtype=np.int16), _tone(1)])
+    monkeypatch.setattr(audio_preprocess.shutil, "which", lambda name: "/usr/bin/ffmpeg")
+    monkeypatch.setattr(audio_preprocess, "decode", lambda data: samples)
+    monkeypatch.setattr(audio_preprocess, "encode", lambda trimmed, output_format: b"\0" * 4096)
+
+    original = b"\1" * 2048
+    stream, extension, stats = audio_preprocess.preprocess_audio(io.BytesIO(original), "webm")
+    # 有静音被裁掉，但编码结果比原始录音大，仍上传原始录音
+    assert (stream.read(), extension, stats["applied"]) == (original, "webm", False)
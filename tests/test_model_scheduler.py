@@ -0,0 +1,114 @@
+import threading
+import time
+
+import pytest
+
+from utils.model_scheduler import BoundedExecutor, ModelOverloadedError, ModelScheduler
+
+
+def test_scheduler_rejects_calls_beyond_max_queue_immediately():
+    scheduler = ModelScheduler("test", max_concurrency=1, max_queue=4, queue_timeout=30)
+    release = threading.Event()
+    results = []
+
+    def blocked_call():
+        release.wait(5)
+        return "ok"
+
+    def run():
+        try:
+            results.append(scheduler.run(blocked_call))
+        except ModelOverloadedError:
+            results.append("rejected")
+
+    # 1 个执行中 + 4 个排队占满调度器，其余调用应立即被拒绝
+    threads = [threading.Thread(target=run) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while scheduler.queue_depth < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert scheduler.queue_depth == 4
+
+    started = time.monotonic()
+    for _ in range(10):
+        with pytest.raises(ModelOverloadedError):
+            scheduler.run(blocked_call)
+    assert time.monotonic() - started < 0.5
+
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ["ok"] * 5
+
+
+def test_bounded_executor_fails_fast_when_backlog_is_full():
+    executor = BoundedExecutor(max_workers=2, max_queue=3)
+    release = threading.Event()
+    try:
+        accepted = [executor.submit(release.wait, 5) for _ in range(5)]
+
+        started = time.monotonic()
+        rejected = [executor.submit(release.wait, 5) for _ in range(20)]
+        assert time.monotonic() - started < 0.5
+        for future in rejected:
+            assert future.done()
+            with pytest.raises(ModelOverloadedError):
+                future.result()
+
+        release.set()
+        assert all(future.result(timeout=5) for future in accepted)
+        # 积压清空后可以重新提交
+        assert executor.submit(lambda: "ok").result(timeout=5) == "ok"
+    finally:
+        release.set()
+        executor.shutdown(wait=True)
+
+
+def test_executor_backlog_reaches_scheduler_queue():
+    # 线程池足够大时，积压的调用在调度器中排队，超出 MODEL_MAX_QUEUE 的部分被立即拒绝
+    scheduler = ModelScheduler("test-flood", max_concurrency=2, max_queue=5, queue_timeout=30)
+    executor = BoundedExecutor(max_workers=32, max_queue=8)
+    release = threading.Event()
+    try:
+        futures = [executor.submit(scheduler.run, lambda: release.wait(5)) for _ in range(20)]
+        deadline = time.monotonic() + 5
+        while sum(future.done() for future in futures) < 13 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        rejected = [future for future in futures if future.done()]
+        assert len(rejected) == 13
+        assert all(isinstance(future.exception(), ModelOverloadedError) for future in rejected)
+
+        release.set()
+        assert sum(future.result(timeout=5) is True for future in futures if future not in rejected) == 7
+    finally:
+        release.set()
+        executor.shutdown(wait=True)
+
+
+def test_backoff_releases_the_slot_for_other_callers(monkeypatch):
+    monkeypatch.setattr("utils.model_scheduler.random.uniform", lambda low, high: 0.5)
+    scheduler = ModelScheduler("test-backoff", max_concurrency=1, max_queue=4, max_retries=1)
+    attempts = []
+    throttled_once = threading.Event()
+
+    def throttled_call():
+        attempts.append("attempt")
+        if len(attempts) == 1:
+            throttled_once.set()
+            raise RuntimeError("ThrottlingException: rate exceeded")
+        return "retried"
+
+    results = []
+    retrying = threading.Thread(target=lambda: results.append(scheduler.run(throttled_call, stage="summary")))
+    retrying.start()
+    assert throttled_once.wait(5)
+
+    # 退避（0.5 秒）期间执行许可已释放，医生回复无需等待退避结束
+    started = time.monotonic()
+    assert scheduler.run(lambda: "doctor", stage="doctor_reply") == "doctor"
+    assert time.monotonic() - started < 0.25
+
+    retrying.join(5)
+    assert results == ["retried"]
+    assert len(attempts) == 2
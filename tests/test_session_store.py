@@ -0,0 +1,48 @@
+import pytest
+
+from utils.session import SessionManager
+from utils.session_store import SessionConflictError, SQLiteSessionStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"))
+
+
+def test_save_state_rejects_stale_version(store):
+    assert store.save_state("s1", 0, "doctor_interaction", None, {}) == 1
+    assert store.save_state("s1", 1, "doctor_interaction", None, {}) == 2
+    with pytest.raises(SessionConflictError):
+        store.save_state("s1", 1, "final_summary", None, {})
+    with pytest.raises(SessionConflictError):
+        store.save_state("s1", 0, "final_summary", None, {})
+    snapshot = store.load("s1", 10)
+    assert snapshot["version"] == 2
+    assert snapshot["current_mode"] == "doctor_interaction"
+
+
+def test_conflicting_save_keeps_other_writer_state_and_reloads(store):
+    # 两个 worker 同时持有同一会话的缓存，后保存的一方不能覆盖先保存的状态
+    first, second = SessionManager(store=store), SessionManager(store=store)
+    a, b = first.get_or_create("s1"), second.get_or_create("s1")
+    a.current_mode = "doctor_interaction"
+    first.save(a)
+    b.current_mode = "final_summary"
+    second.save(b)
+    assert store.load("s1", 10)["current_mode"] == "doctor_interaction"
+
+    reloaded = second.get_or_create("s1")
+    assert reloaded is not b
+    assert reloaded.current_mode == "doctor_interaction"
+    assert reloaded.version == 1
+
+
+def test_expired_sessions_are_purged_on_write_without_restart(tmp_path):
+    store = SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"), ttl=60, purge_interval=0)
+    store.save_state("old", 0, "doctor_interaction", None, {})
+    db = store._connection()
+    db.execute("UPDATE sessions SET updated_at = updated_at - 120 WHERE session_id = 'old'")
+    db.commit()
+    store.save_state("new", 0, "doctor_interaction", None, {})
+    assert store.get_version("old") is None
+    assert store.get_version("new") == 1
@@ -0,0 +1,166 @@
+import hashlib
+import io
+import threading
+import time
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+pytest.importorskip("requests")
+from botocore.stub import Stubber
+
+from utils.transcription import (
+    MIN_MULTIPART_CHUNK_BYTES, HashingStream, UploadTooLargeError, upload_audio_stream,
+)
+
+MIB = 1024 * 1024
+
+
+class _RequestBody:
+    """只支持 read() 的请求体流（不可 seek、不知道总长度），与 Flask / ASGI 的请求体一致"""
+
+    def __init__(self, data: bytes, read_limit: int = 64 * 1024):
+        self._buffer = io.BytesIO(data)
+        self.read_limit = read_limit
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        size = self.read_limit if size is None or size < 0 else min(size, self.read_limit)
+        chunk = self._buffer.read(size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+class _StubbedS3:
+    """
+    真实的 boto3 S3 客户端 + botocore Stubber：upload_fileobj 走完整的 s3transfer 流程，只是不发出网络请求
+
+    calls 按顺序记录每次 API 调用的 (操作名, 请求体字节数)；peak_buffered 记录发出 UploadPart 时
+    已从请求体读出、但尚未交给 S3 的字节数的最大值，即 s3transfer 在内存中缓冲的数据量。
+    """
+
+    def __init__(self, body: _RequestBody, part_delay: float = 0):
+        self.client = boto3.client(
+            "s3", region_name="us-east-1", aws_access_key_id="testing", aws_secret_access_key="testing",
+        )
+        self.stubber = Stubber(self.client)
+        self.body = body
+        self.part_delay = part_delay
+        self.calls = []
+        self.peak_buffered = 0
+        self._sent = 0
+        self._lock = threading.Lock()
+        self.client.meta.events.register("before-parameter-build.s3.*", self._record)
+
+    def _record(self, params, model, **kwargs):
+        size = len(params["Body"]) if "Body" in params else 0
+        with self._lock:
+            self.calls.append((model.name, size))
+            if model.name == "UploadPart":
+                self.peak_buffered = max(self.peak_buffered, self.body.bytes_read - self._sent)
+                self._sent += size
+        if model.name == "UploadPart":
+            time.sleep(self.part_delay)  # 模拟上传慢于读取请求体
+
+    def expect_put(self):
+        self.stubber.add_response("put_object", {"ETag": '"etag"'})
+
+    def expect_multipart(self, parts: int, abort: bool = False):
+        self.stubber.add_response("create_multipart_upload", {"UploadId": "upload-id"})
+        for number in range(parts):
+            self.stubber.add_response("upload_part", {"ETag": f'"etag-{number}"'})
+        if abort:
+            self.stubber.add_response("abort_multipart_upload", {})
+        else:
+            self.stubber.add_response("complete_multipart_upload", {"ETag": '"etag"'})
+
+    def operations(self) -> list[str]:
+        return [name for name, _ in self.calls]
+
+
+@pytest.fixture(autouse=True)
+def sequential_upload(monkeypatch):
+    # 默认逐片上传，Stubber 的响应顺序与调用顺序一致；并发场景在用例中单独设置
+    monkeypatch.setenv("TRANSCRIBE_UPLOAD_CONCURRENCY", "1")
+    monkeypatch.setenv("TRANSCRIBE_UPLOAD_CHUNK_BYTES", str(MIN_MULTIPART_CHUNK_BYTES))
+
+
+def test_short_recording_is_uploaded_with_a_single_put():
+    data = b"\x01" * (256 * 1024)
+    s3 = _StubbedS3(_RequestBody(data))
+    s3.expect_put()
+    with s3.stubber:
+        assert upload_audio_stream(s3.client, s3.body, "bucket", "short.webm", max_bytes=MIB) == len(data)
+    s3.stubber.assert_no_pending_responses()
+    assert s3.calls == [("PutObject", len(data))]
+
+
+def test_long_recording_is_streamed_as_multipart():
+    data = bytes(range(256)) * (12 * MIB // 256)
+    s3 = _StubbedS3(_RequestBody(data))
+    s3.expect_multipart(parts=3)
+    with s3.stubber:
+        assert upload_audio_stream(s3.client, s3.body, "bucket", "long.webm", max_bytes=25 * MIB) == len(data)
+    s3.stubber.assert_no_pending_responses()
+    # 12 MiB 按 5 MiB 分片：5 + 5 + 2
+    assert s3.calls == [
+        ("CreateMultipartUpload", 0),
+        ("UploadPart", 5 * MIB), ("UploadPart", 5 * MIB), ("UploadPart", 2 * MIB),
+        ("CompleteMultipartUpload", 0),
+    ]
+    assert s3.peak_buffered <= MIN_MULTIPART_CHUNK_BYTES
+
+
+def test_chunk_size_below_s3_minimum_is_raised_to_5_mib(monkeypatch):
+    monkeypatch.setenv("TRANSCRIBE_UPLOAD_CHUNK_BYTES", str(MIB))
+    s3 = _StubbedS3(_RequestBody(b"\x02" * (6 * MIB)))
+    s3.expect_multipart(parts=2)
+    with s3.stubber:
+        upload_audio_stream(s3.client, s3.body, "bucket", "min.webm")
+    assert [size for name, size in s3.calls if name == "UploadPart"] == [5 * MIB, MIB]
+
+
+def test_concurrent_upload_buffers_at_most_concurrency_plus_one_chunks(monkeypatch):
+    # 上传慢于读取时，s3transfer 默认会预读最多 10 个分片；内存占用应只与并发数有关
+    monkeypatch.setenv("TRANSCRIBE_UPLOAD_CONCURRENCY", "2")
+    data = b"\x05" * (60 * MIB)
+    s3 = _StubbedS3(_RequestBody(data), part_delay=0.05)
+    s3.expect_multipart(parts=12)
+    with s3.stubber:
+        assert upload_audio_stream(s3.client, s3.body, "bucket", "slow.webm", max_bytes=100 * MIB) == len(data)
+    s3.stubber.assert_no_pending_responses()
+    assert s3.operations().count("UploadPart") == 12
+    assert s3.peak_buffered <= 3 * MIN_MULTIPART_CHUNK_BYTES
+
+
+def test_upload_over_the_cap_is_aborted_mid_stream():
+    body = _RequestBody(b"\x03" * (40 * MIB))
+    s3 = _StubbedS3(body)
+    s3.expect_multipart(parts=1, abort=True)
+    with s3.stubber:
+        with pytest.raises(UploadTooLargeError):
+            upload_audio_stream(s3.client, body, "bucket", "huge.webm", max_bytes=6 * MIB)
+    # 超过上限后立即停止读取请求体并中止分片上传，不会先把整段音频读完
+    assert body.bytes_read <= 6 * MIB + MIN_MULTIPART_CHUNK_BYTES
+    assert s3.operations()[-1] == "AbortMultipartUpload"
+    assert "CompleteMultipartUpload" not in s3.operations()
+
+
+def test_upload_exactly_at_the_cap_is_accepted():
+    s3 = _StubbedS3(_RequestBody(b"\x04" * MIB))
+    s3.expect_put()
+    with s3.stubber:
+        assert upload_audio_stream(s3.client, s3.body, "bucket", "exact.webm", max_bytes=MIB) == MIB
+
+
+def test_hashing_stream_digest_matches_uploaded_bytes():
+    data = bytes(range(251)) * (7 * MIB // 251)
+    body = _RequestBody(data)
+    stream = HashingStream(body)
+    assert stream.prefetch(MIB) is False  # 长录音：预读不足以算出哈希，上传完成后才能得到
+    s3 = _StubbedS3(body)
+    s3.expect_multipart(parts=2)
+    with s3.stubber:
+        assert upload_audio_stream(s3.client, stream, "bucket", "hashed.webm", max_bytes=25 * MIB) == len(data)
+    assert sum(size for name, size in s3.calls if name == "UploadPart") == len(data)
+    assert stream.hexdigest() == hashlib.sha256(data).hexdigest()
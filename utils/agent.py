@@ -1,196 +1,508 @@
+import contextvars
+import itertools
+import json
 import os # Import os to access environment variables
-from dotenv import load_dotenv # 新增: 导入 load_dotenv
-from strands import Agent
-from strands.models.openai import OpenAIModel # 新增: 导入 OpenAIModel
-from .tools import scenario_tool, objection_tool, eval_tool
-from strands_tools import use_llm
+import queue
+import re
+import threading
+import time
+from . import metrics
+from .conversation import Speaker
+from .lexicon import get_matcher
+from .llm_cache import ResponseCache
+from .model_router import TIER_FALLBACKS, ModelRouter
+from .model_scheduler import BoundedExecutor, get_scheduler
+from .objection_kb import get_knowledge_base
+from .persona_store import PersonaStore, parse_start_message
+from .prompts import PromptBuilder, count_tokens
+from .session import SessionState
+from .startup import load_env
+from .summary import RollingEvaluation
 
-load_dotenv() # 新增: 在脚本早期加载 .env 文件
+load_env() # 在脚本早期加载 .env 文件（同一进程内只加载一次）
+
+# 各调用点的固定指令。每轮变化的内容由 PromptBuilder 追加在这些指令之后，保证请求开头的前缀稳定、可被提供方缓存
+DOCTOR_ROLE_PROMPT = (
+    "你是一位临床医生，正在与医药代表进行角色扮演对话。请根据你的专业背景和当前对话情境进行回应，"
+    "以专业、有时略带挑战性的语气互动，确保发言符合医学专业知识和常见的临床情景，自然、专业，并能推动对话有效进行。"
+)
+DOCTOR_REPLY_INSTRUCTION = (
+    "现在轮到你回应。你可以继续之前的对话，或者针对代表的发言提出一个相关的临床问题或常见的顾虑/异议"
+    "（例如关于药物效果、副作用、价格、患者依从性等）。请只生成你的下一句对话。"
+)
+COACH_EVAL_INSTRUCTION = (
+    "作为医药销售培训教练，请针对医生刚才所说的话，评估医药代表的回答。"
+    "请给出评分（例如X/100）、合规性（例如🟢或🔴）以及具体的亮点和改进建议。"
+)
+SUMMARY_INSTRUCTION = (
+    "作为医药销售培训教练，请根据本次训练的累计评估和最近几轮对话进行总结性评估。"
+    "内容应包括整体表现评分、主要优势、关键改进领域，以及可能的雷达图数据点（例如：学术性、沟通技巧、异议处理、合规性等维度，每个维度给一个分数）。"
+)
 
 class PharmaRepCoachAgent:
     def __init__(self):
-        bedrock_model_id = os.getenv("BEDROCK_MODEL_ID")
-        openai_api_key = os.getenv("OPENAI_API_KEY") # 新增: 获取 OpenAI API Key
-        openai_base_url = os.getenv("OPENAI_BASE_URL") # 新增: 获取 OpenAI Base URL
-        
-        agent_kwargs = {
-            "tools": [scenario_tool, objection_tool, eval_tool, use_llm],
-            "system_prompt": "你是一个医药代表培训协调员。你的任务是根据用户输入协调场景生成、医生互动和培训评估。"
-        }
-        
-        # 修改: 优先使用 OpenAI，然后 Bedrock，最后默认
-        if openai_api_key and openai_base_url:
-            agent_kwargs["model"] = OpenAIModel(
-                client_args={
-                    "api_key": openai_api_key,
-                    "base_url": openai_base_url,
-                },
-                model_id=os.getenv("OPENAI_MODEL_ID", "deepseek-ai/DeepSeek-R1"), # 允许通过环境变量配置模型ID，默认为 Qwen/Qwen3-32B
+        # strands、模型客户端和工具在首次使用（或 warm_up）时才导入和构建，创建实例本身不做任何重量级初始化
+        self.system_prompt = "你是一个医药代表培训协调员。你的任务是根据用户输入协调场景生成、医生互动和培训评估。"
+        self._model = None
+        self._tools = None
+        self._init_lock = threading.Lock()
+
+        # 模型客户端在所有会话间共享；未传入 session 时使用内置的默认会话（单用户脚本场景）
+        self.session = SessionState("default")
+        # 医生人设库：开始训练时直接从缓存/模板获取人设；开启 PERSONA_LLM_GENERATION 后在后台用模型生成更丰富的人设
+        llm_personas = os.getenv("PERSONA_LLM_GENERATION", "false").lower() in ("1", "true", "yes")
+        self.persona_store = PersonaStore(generator=self.generate_persona if llm_personas else None)
+        # 可选的模型响应缓存：相同的 prompt / system prompt / 模型 / temperature 直接返回缓存结果
+        cache_enabled = os.getenv("LLM_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+        self.response_cache = ResponseCache() if cache_enabled else None
+        # 分层模型路由：每轮的教练评估 / 医生回复走快速层级，总结与人设生成走大模型层级（见 MODEL_TIERS / MODEL_ROUTES）
+        self.router = ModelRouter(self)
+        # 同一轮中的教练评估与医生回复并发生成；线程池的等待队列有界，积压的调用在调度器中按优先级排队，
+        # 超出 MODEL_MAX_QUEUE 时立即失败，而不是在线程池中无限等待
+        self.resize_executor(int(os.getenv("TURN_PIPELINE_WORKERS") or 16))
+
+    def resize_executor(self, max_workers: int):
+        """
+        按服务模式设置并发线程池的大小（ASGI 模式与 ASGI_MAX_THREADS 一致），应在处理请求之前调用
+
+        线程按需创建，同时进行的模型调用数实际由各提供方调度器的 MODEL_MAX_CONCURRENCY 限制；
+        所有线程都忙时最多再排队 TURN_PIPELINE_MAX_QUEUE（默认与 MODEL_MAX_QUEUE 相同）个调用。
+        """
+        previous = getattr(self, "executor", None)
+        self.executor = BoundedExecutor(
+            max_workers=max_workers,
+            max_queue=int(os.getenv("TURN_PIPELINE_MAX_QUEUE") or os.getenv("MODEL_MAX_QUEUE") or 64),
+            thread_name_prefix="turn-pipeline",
+        )
+        if previous is not None:
+            previous.shutdown(wait=False)
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._init_lock:
+                if self._model is None:
+                    self._model = self._build_model()
+        return self._model
+
+    @property
+    def tools(self) -> list:
+        if self._tools is None:
+            from .tools import scenario_tool, objection_tool, eval_tool
+            self._tools = [scenario_tool, objection_tool, eval_tool]
+        return self._tools
+
+    def warm_up(self):
+        """导入 strands 并构建模型客户端和工具，供服务启动后在后台调用，避免首个请求承担这部分开销"""
+        import strands  # noqa: F401
+        self.tools
+        for tier in self.router.tiers.values():
+            tier.model
+
+    @property
+    def provider(self) -> str:
+        """当前使用的模型提供方：fake / openai / bedrock，用于按提供方限流"""
+        # 修改: 优先使用 OpenAI，然后 Bedrock，最后默认；MODEL_PROVIDER=fake 时使用本地假模型（压测/基准测试）
+        if os.getenv("MODEL_PROVIDER", "").lower() == "fake":
+            return "fake"
+        if os.getenv("OPENAI_API_KEY") and os.getenv("OPENAI_BASE_URL"):
+            return "openai"
+        return "bedrock"
+
+    def _build_model(self):
+        return self.build_model(self.provider)
+
+    def build_model(self, provider: str, model_id: str | None = None, max_tokens: int | None = None,
+                    temperature: float | None = None, timeout: float | None = None):
+        """
+        构建模型客户端。未指定的参数使用环境变量中的默认配置；timeout 为单次请求的读取超时（秒）。
+        默认模型和 utils/model_router.py 中的各个模型层级都通过这里构建。
+        """
+        if provider == "fake":
+            from .fake_model import FakeModel
+            print("INFO: Using fake model provider.")
+            return FakeModel(timeout=timeout)
+        elif provider == "openai":
+            from strands.models.openai import OpenAIModel
+            client_args = {
+                "api_key": os.getenv("OPENAI_API_KEY"), # 新增: 获取 OpenAI API Key
+                "base_url": os.getenv("OPENAI_BASE_URL"), # 新增: 获取 OpenAI Base URL
+            }
+            if timeout:
+                client_args["timeout"] = timeout
+            model = OpenAIModel(
+                client_args=client_args,
+                model_id=model_id or os.getenv("OPENAI_MODEL_ID", "deepseek-ai/DeepSeek-R1"), # 允许通过环境变量配置模型ID，默认为 Qwen/Qwen3-32B
                 params={
-                    "max_tokens": int(os.getenv("OPENAI_MAX_TOKENS", 1500)), # 确保是整数
-                    "temperature": float(os.getenv("OPENAI_TEMPERATURE", 0.7)),
+                    "max_tokens": max_tokens or int(os.getenv("OPENAI_MAX_TOKENS", 1500)), # 确保是整数
+                    "temperature": temperature if temperature is not None else float(os.getenv("OPENAI_TEMPERATURE", 0.7)),
                 }
             )
-            print("INFO: Using OpenAI model.")
-        elif bedrock_model_id:
-            agent_kwargs["model"] = bedrock_model_id
-            # model_provider defaults to "bedrock" if not set, which is desired.
-            # AWS_REGION, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY are picked up by AWS SDK from env.
+            print(f"INFO: Using OpenAI model: {model.get_config().get('model_id')}.")
+            return model
+
+        from strands.models import BedrockModel
+        # AWS_REGION, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY are picked up by AWS SDK from env.
+        bedrock_kwargs = {}
+        if max_tokens:
+            bedrock_kwargs["max_tokens"] = max_tokens
+        if temperature is not None:
+            bedrock_kwargs["temperature"] = temperature
+        if timeout:
+            from botocore.config import Config
+            bedrock_kwargs["boto_client_config"] = Config(read_timeout=timeout, retries={"mode": "standard"})
+        if os.getenv("BEDROCK_PROMPT_CACHE", "false").lower() in ("1", "true", "yes"):
+            # 在 system prompt 之后插入缓存点，稳定前缀（协调员 / 医生人设 system prompt）由 Bedrock 缓存
+            bedrock_kwargs["cache_prompt"] = "default"
+        bedrock_model_id = model_id or os.getenv("BEDROCK_MODEL_ID")
+        if bedrock_model_id:
             print(f"INFO: Using Bedrock model: {bedrock_model_id}.")
-        else:
-            print("INFO: Using default Strands Agent model.")
+            return BedrockModel(model_id=bedrock_model_id, **bedrock_kwargs)
+        print("INFO: Using default Strands Agent model.")
+        return BedrockModel(**bedrock_kwargs)
 
-        self.strands_agent = Agent(**agent_kwargs)
-        self.current_mode = "waiting_for_start"  # waiting_for_start, doctor_interaction, final_summary
-        self.doctor_persona = None  # 存储医生角色信息 (name, opening_line, characteristics)
-        self.conversation_log = []  # 存储对话历史 (speaker, utterance)
+    # 兼容单会话用法（如 demonstrate_chat_flow），直接访问默认会话的状态
+    @property
+    def current_mode(self):
+        return self.session.current_mode
 
-    def _get_doctor_system_prompt(self) -> str:
-        if not self.doctor_persona or 'name' not in self.doctor_persona:
-            return "你是一位资深临床医生。请以专业、有时略带挑战性的语气与医药代表互动。确保你的回答符合医学专业知识和常见的临床情景。"
-        
-        name = self.doctor_persona.get('name', '医生')
-        specialty = self.doctor_persona.get('specialty', '相关科室')
-        prompt = f"你是一位名叫 {name} 的{specialty}医生。你的任务是与医药代表进行角色扮演对话。请根据你的专业背景和当前对话情境进行回应。"
-        if 'characteristics' in self.doctor_persona:
-            prompt += f" 你的背景信息：{self.doctor_persona['characteristics']}。"
-        prompt += " 请确保你的发言自然、专业，并能推动对话有效进行。"
+    @property
+    def doctor_persona(self):
+        return self.session.doctor_persona
+
+    @property
+    def conversation_log(self):
+        return self.session.conversation_log
+
+    def _run_llm(self, prompt: str, system_prompt: str | None = None, use_tools: bool = True, on_token=None,
+                 stage: str = "llm") -> str:
+        """
+        用共享模型执行一次无状态调用
+
+        每次调用新建一个轻量 Agent（仅持有消息列表），不同会话之间不会共用对话历史，
+        也不需要临时修改共享 Agent 的 system_prompt。传入 on_token 时，模型生成的每个文本增量都会回调一次。
+        stage 用于指标标签（coach_eval、doctor_reply、summary、persona 等）。
+        """
+        chain = self.router.route(stage)
+        effective_prompt = system_prompt or self.system_prompt
+        if self.response_cache is not None:
+            # 写入时按实际应答的层级记键，查找时依次查链上每个层级，降级期间由后备层级生成的回复同样可以复用
+            cached = self.response_cache.get_any(
+                self._cache_key(prompt, effective_prompt, use_tools, tier.model) for tier in chain
+            )
+            if cached is not None:
+                metrics.record_llm_call(stage, "cache_hit")
+                if on_token is not None:
+                    on_token(cached)
+                return cached
+
+        streamed = False
+        callback_handler = None
+        if on_token is not None:
+            def callback_handler(**kwargs):
+                nonlocal streamed
+                if "data" in kwargs:
+                    streamed = True
+                    on_token(kwargs["data"])
+
+        from strands import Agent
+
+        estimated_tokens = (count_tokens(prompt) + count_tokens(effective_prompt)
+                            + int(os.getenv("MODEL_ESTIMATED_OUTPUT_TOKENS", 500)))
+        with metrics.span(stage):
+            # 按路由到的层级链依次尝试：当前层级超时或失败、且尚未向客户端推送输出时，改用下一个层级
+            for index, tier in enumerate(chain):
+                def invoke(model=tier.model):
+                    # 每次尝试使用新的 Agent，失败调用的消息不会带入重试
+                    agent = Agent(
+                        model=model,
+                        tools=self.tools if use_tools else [],
+                        system_prompt=effective_prompt,
+                        callback_handler=callback_handler,
+                    )
+                    return agent(prompt)
+
+                # 经由按提供方共享的调度器排队准入（并发上限、token 预算、优先级、限流重试）；
+                # 已向客户端推送过增量输出的调用不再重试，避免重复输出
+                scheduler = get_scheduler(tier.provider)
+                started = time.perf_counter()
+                try:
+                    result = scheduler.run(invoke, stage=stage, estimated_tokens=estimated_tokens,
+                                           can_retry=lambda: not streamed)
+                except Exception as e:
+                    tier.record(time.perf_counter() - started, failed=True)
+                    metrics.record_llm_call(stage, "error")
+                    if streamed or index == len(chain) - 1:
+                        raise
+                    print(f"Warning: model tier {tier.name} failed for {stage}, falling back to {chain[index + 1].name}: {str(e)}")
+                    TIER_FALLBACKS.inc(tier=tier.name, reason="error")
+                    continue
+                tier.record(time.perf_counter() - started)
+                break
+
+        usage = getattr(getattr(result, "metrics", None), "accumulated_usage", None)
+        metrics.record_llm_call(stage, "ok", usage)
+        if usage:
+            scheduler.settle(estimated_tokens, usage.get("totalTokens", estimated_tokens))
+        response = str(result)
+        if self.response_cache is not None:
+            self.response_cache.put(self._cache_key(prompt, effective_prompt, use_tools, tier.model), response)
+        return response
+
+    def _cache_key(self, prompt: str, system_prompt: str, use_tools: bool, model) -> str:
+        # 缓存键包含实际应答层级的模型配置，不同层级的回复互不复用
+        config = model.get_config()
+        params = config.get("params") or {}
+        temperature = params.get("temperature", config.get("temperature"))
+        return ResponseCache.make_key(prompt, system_prompt, config.get("model_id"), temperature, use_tools=use_tools)
+
+    def _generate_line(self, emit, line_id: int, prefix: str, prompt: str, **llm_kwargs) -> str:
+        """生成一行模型回复，生成过程中通过 emit 推送 line_start / token 事件"""
+        emit({"type": "line_start", "line": line_id, "prefix": prefix})
+        return self._run_llm(
+            prompt,
+            on_token=lambda delta: emit({"type": "token", "line": line_id, "text": delta}),
+            **llm_kwargs,
+        )
+
+    def generate_persona(self, drug: str, specialty: str, level: str = "basic", lang: str = "zh") -> dict:
+        """调用模型生成医生人设，返回 {name, specialty, opening_line, characteristics}"""
+        prompt = (
+            f"请为医药代表培训生成一位虚拟医生人设。药品：{drug}；科室：{specialty}；难度：{level}；语言：{lang}。"
+            "难度越高，医生越资深、提问越尖锐。只输出一个 JSON 对象，不要输出其他内容，字段为："
+            'name（姓名）、specialty（科室）、opening_line（医生的开场白，用引号括起）、characteristics（性别·年龄·职称·处方习惯等背景，一行）。'
+        )
+        text = self._run_llm(prompt, use_tools=False, stage="persona")
+        match = re.search(r"\{.*\}", text, re.DOTALL)
+        if not match:
+            raise ValueError(f"模型未返回 JSON 人设: {text[:200]}")
+        persona = json.loads(match.group(0))
+        missing = {"name", "opening_line"} - persona.keys()
+        if missing:
+            raise ValueError(f"人设缺少字段: {', '.join(sorted(missing))}")
+        return {key: str(persona[key]) for key in ("name", "specialty", "opening_line", "characteristics") if key in persona}
+
+    def _get_doctor_system_prompt(self, doctor_persona: dict | None) -> str:
+        # 所有医生共用的角色说明在前（跨会话共享的缓存前缀），本次训练的人设在后（会话内不变）
+        prompt = DOCTOR_ROLE_PROMPT
+        if not doctor_persona or 'name' not in doctor_persona:
+            return prompt + "\n\n你的身份：资深临床医生。"
+
+        name = doctor_persona.get('name', '医生')
+        specialty = doctor_persona.get('specialty', '相关科室')
+        prompt += f"\n\n你的身份：{name}，{specialty}医生。"
+        if 'characteristics' in doctor_persona:
+            prompt += f"\n你的背景信息：{doctor_persona['characteristics']}。"
         return prompt
 
-    def handle_message(self, user_input: str) -> list[str]:
+    def _build_eval_prompt(self, doctor_utterance: str, rep_answer: str) -> str:
+        return (
+            PromptBuilder("coach_eval")
+            .instruction(COACH_EVAL_INSTRUCTION)
+            .section("医生刚才说", doctor_utterance)
+            .section("医药代表的回答", rep_answer)
+            .build(self.system_prompt)
+        )
+
+    def evaluate_answer(self, doctor_utterance: str, rep_answer: str) -> str:
+        """对单条代表回答生成教练评估（不依赖会话状态，供离线批量评分使用）"""
+        return self._run_llm(self._build_eval_prompt(doctor_utterance, rep_answer), stage="coach_eval")
+
+    def _recent_dialogue(self, session: SessionState, limit: int) -> list[str]:
+        """最近 limit 条医生/代表发言（不含教练反馈），按时间顺序排列，每条一行"""
+        return [f"{turn.label}: {turn.text}" for turn in session.conversation_log.recent_dialogue(limit)]
+
+    def handle_message(self, user_input: str, session: SessionState | None = None) -> list[str]:
         responses = []
-        self.conversation_log.append(("User", user_input))
+        self._process_message(user_input, session or self.session,
+                              lambda event: responses.append(event["text"]) if event["type"] == "line" else None)
+        return responses
+
+    def stream_message(self, user_input: str, session: SessionState | None = None):
+        """
+        以事件流形式处理一条消息，供 /chat/stream 使用
+
+        事件类型：
+            line_start: 模型开始生成一行回复 {"line", "prefix"}
+            token: 该行的增量文本 {"line", "text"}
+            line: 完整的一行回复，与 handle_message 返回列表中的元素一致 {"line", "text"}
+        """
+        events = queue.Queue()
+        finished = object()
+
+        def worker():
+            try:
+                self._process_message(user_input, session or self.session, events.put)
+            except Exception as e:
+                events.put({"type": "line", "line": -1, "text": f"System: 处理时发生内部错误: {str(e)}"})
+            finally:
+                events.put(finished)
+
+        worker_thread = threading.Thread(target=worker, daemon=True)
+        worker_thread.start()
+        try:
+            while (event := events.get()) is not finished:
+                yield event
+        finally:
+            # 客户端提前断开时也等本轮处理完成，保证会话状态完整写入
+            worker_thread.join()
+
+    def _process_message(self, user_input: str, session: SessionState, emit):
+        # 整轮耗时按本轮开始时的模式计入指标，各阶段的 span 继承同一个 mode 标签
+        with metrics.trace("turn", mode=session.current_mode):
+            self._process_turn(user_input, session, emit)
 
-        if self.current_mode == "waiting_for_start":
+    def _process_turn(self, user_input: str, session: SessionState, emit):
+        line_ids = itertools.count()
+
+        def emit_line(text: str, line_id: int | None = None):
+            emit({"type": "line", "line": next(line_ids) if line_id is None else line_id, "text": text})
+
+        session.conversation_log.add(Speaker.USER, user_input)
+
+        if session.current_mode == "waiting_for_start":
             if ("药品" in user_input and "科室" in user_input and 
                 ("start" in user_input.lower() or "开始" in user_input)):
-                responses.append("System: 正在生成医生场景…")
+                emit_line("System: 正在生成医生场景…")
                 try:
-                    if "semaglutide" in user_input.lower() and "endocrinology" in user_input.lower():
-                        self.doctor_persona = {
-                            "name": "李伟", "specialty": "内分泌科",
-                            "opening_line": "“你好，我是李伟主任，最近门诊里肥胖合并 2 型糖尿病的患者越来越多。你们司美格鲁肽有哪些新版数据？”",
-                            "characteristics": "男·45 岁·主任医师·周处方量≈25 支"
-                        }
-                    else:
-                         self.doctor_persona = {
-                            "name": "王医生", "specialty": "相关科室",
-                            "opening_line": "“你好，关于你提到的药品，请详细介绍一下数据和证据。”",
-                            "characteristics": "经验丰富，关注药物的实际临床价值。"
-                        }
+                    start_params = parse_start_message(user_input)
+                    with metrics.span("persona_lookup"):
+                        persona = self.persona_store.get(
+                            start_params.get("drug", ""), start_params.get("specialty", ""), start_params["level"]
+                        )
+                    # 记录本次训练的药品，医生回复时按药品从异议知识库检索
+                    session.doctor_persona = {**persona, "drug": start_params.get("drug", "")}
                     
-                    self.current_mode = "doctor_interaction"
-                    doctor_display_name = self.doctor_persona.get('name', '医生')
-                    responses.append(f"Doctor {doctor_display_name} ▶ {self.doctor_persona['opening_line']}")
-                    if self.doctor_persona.get('characteristics'):
-                        responses.append(f"System     ▶ 【医生档案】{self.doctor_persona['characteristics']}")
-                    self.conversation_log.append((f"Doctor {doctor_display_name}", self.doctor_persona['opening_line']))
+                    session.current_mode = "doctor_interaction"
+                    session.rolling_evaluation = RollingEvaluation()
+                    doctor_display_name = session.doctor_persona.get('name', '医生')
+                    emit_line(f"Doctor {doctor_display_name} ▶ {session.doctor_persona['opening_line']}")
+                    if session.doctor_persona.get('characteristics'):
+                        emit_line(f"System     ▶ 【医生档案】{session.doctor_persona['characteristics']}")
+                    session.conversation_log.add(Speaker.DOCTOR, session.doctor_persona['opening_line'], name=doctor_display_name)
 
                 except Exception as e:
-                    responses.append(f"System: 抱歉，生成场景时出错: {str(e)}")
-                    self.current_mode = "waiting_for_start"
-                return responses
+                    emit_line(f"System: 抱歉，生成场景时出错: {str(e)}")
+                    session.current_mode = "waiting_for_start"
+                return
             else:
-                responses.append('System: 请提供药品、科室、难度信息并包含"Start"或"开始"以启动。例如："药品: Semaglutide；科室: Endocrinology；难度: Basic。点击【Start】"')
-                return responses
+                emit_line('System: 请提供药品、科室、难度信息并包含"Start"或"开始"以启动。例如："药品: Semaglutide；科室: Endocrinology；难度: Basic。点击【Start】"')
+                return
 
-        elif self.current_mode == "doctor_interaction":
-            responses.append("Coach: 正在评估您的回答…")
-            try:
-                doctor_last_utterance = self.conversation_log[-2][1] if len(self.conversation_log) >= 2 else self.doctor_persona.get('opening_line', '')
-                eval_prompt = f"作为医药销售培训教练，请针对医生刚才所说的{doctor_last_utterance}，评估医药代表的以下回答：{user_input}。请给出评分（例如X/100）、合规性（例如🟢或🔴）以及具体的亮点和改进建议。"
+        elif session.current_mode == "doctor_interaction":
+            emit_line("Coach: 正在评估您的回答…")
+            end_training = "结束训练" in user_input or "end training" in user_input.lower()
+
+            # 先在当前线程基于本轮开始时的对话记录组装好两个 prompt，再并发调用模型；
+            # 医生回复只依赖代表的发言和之前的对话，不依赖教练的评估结果
+            last_doctor_turn = session.conversation_log.last(Speaker.DOCTOR)
+            doctor_last_utterance = last_doctor_turn.text if last_doctor_turn else session.doctor_persona.get('opening_line', '')
+            eval_prompt = self._build_eval_prompt(doctor_last_utterance, user_input)
+            coach_line_id = next(line_ids)
+            # 通过 copy_context 提交，线程池中的模型调用继承本轮的指标 mode 标签和追踪上下文
+            coach_future = self.executor.submit(
+                contextvars.copy_context().run,
+                self._generate_line, emit, coach_line_id, "Coach      ▶ ", eval_prompt, stage="coach_eval",
+            )
+
+            doctor_future = None
+            if not end_training:
+                doctor_display_name = session.doctor_persona.get('name', '医生')
+                doctor_system_prompt_text = self._get_doctor_system_prompt(session.doctor_persona)
                 
-                coach_feedback = self.strands_agent(eval_prompt)
-                responses.append(f"Coach      ▶ {coach_feedback}")
-                self.conversation_log.append(("Coach", coach_feedback))
+                # 从异议知识库中检索与代表发言最相关的异议作为参考，让医生的异议有据可依（本地检索，无额外模型调用）
+                with metrics.span("objection_lookup"):
+                    objections = get_knowledge_base().search(
+                        user_input, drug=session.doctor_persona.get("drug"), k=int(os.getenv("OBJECTION_KB_PROMPT_TOP_K", 2)),
+                    )
+                next_doctor_llm_prompt = (
+                    PromptBuilder("doctor_reply")
+                    .instruction(DOCTOR_REPLY_INSTRUCTION)
+                    .section("可参考的常见异议（如需提出异议，选择与当前对话相关的一条，用你自己的话表达）",
+                             "\n".join(f"- {item['objection']}" for item in objections))
+                    .history("最近的对话", self._recent_dialogue(session, 4))
+                    .build(doctor_system_prompt_text)
+                )
+                doctor_line_id = next(line_ids)
+                doctor_future = self.executor.submit(
+                    contextvars.copy_context().run,
+                    self._generate_line, emit, doctor_line_id, f"Doctor {doctor_display_name} ▶ ",
+                    next_doctor_llm_prompt,
+                    system_prompt=doctor_system_prompt_text,
+                    use_tools=False,
+                    stage="doctor_reply",
+                )
+
+            # 结果按固定顺序（教练在前、医生在后）写回输出和对话记录
+            coach_feedback = None
+            try:
+                coach_feedback = coach_future.result()
+                emit_line(f"Coach      ▶ {coach_feedback}", coach_line_id)
+                session.conversation_log.add(Speaker.COACH, coach_feedback)
             except Exception as e:
-                responses.append(f"Coach: 评估时出错: {str(e)}")
+                emit_line(f"Coach: 评估时出错: {str(e)}")
+            if not end_training:
+                # 每轮增量更新累计评估，结束训练时无需回放整段对话
+                session.rolling_evaluation.update(doctor_last_utterance, user_input, coach_feedback)
 
-            if "结束训练" in user_input or "end training" in user_input.lower():
-                self.current_mode = "final_summary"
-                responses.append("System: 正在生成总结报告…")
+            if end_training:
+                session.current_mode = "final_summary"
+                emit_line("System: 正在生成总结报告…")
                 try:
-                    summary_prompt = f"作为医药销售培训教练，请对以下完整的对话记录进行总结性评估。内容应包括整体表现评分、主要优势、关键改进领域，以及可能的雷达图数据点（例如：学术性、沟通技巧、异议处理、合规性等维度，每个维度给一个分数）。对话记录如下：\n"
-                    for speaker, utterance in self.conversation_log:
-                        summary_prompt += f"{speaker}: {utterance}\n"
+                    # 总结只基于累计评估和最近几轮对话，prompt 长度不随训练轮数增长
+                    summary_prompt = (
+                        PromptBuilder("summary")
+                        .instruction(SUMMARY_INSTRUCTION)
+                        .section("累计评估", session.rolling_evaluation.to_prompt_text())
+                        .history("最近的对话", self._recent_dialogue(session, int(os.getenv('SUMMARY_RECENT_TURNS', 6))))
+                        .build(self.system_prompt)
+                    )
                     
-                    final_summary = self.strands_agent(summary_prompt)
-                    responses.append(f"Summary    ▶\n{final_summary}")
-                    self.conversation_log.append(("Summary", final_summary))
+                    summary_line_id = next(line_ids)
+                    final_summary = self._generate_line(emit, summary_line_id, "Summary    ▶\n", summary_prompt, stage="summary")
+                    emit_line(f"Summary    ▶\n{final_summary}", summary_line_id)
+                    session.conversation_log.add(Speaker.SUMMARY, final_summary)
                     
-                    self.current_mode = "waiting_for_start"
-                    self.doctor_persona = None
+                    session.current_mode = "waiting_for_start"
+                    session.doctor_persona = None
                 except Exception as e:
-                    responses.append(f"System: 生成总结报告时出错: {str(e)}")
-                return responses
+                    emit_line(f"System: 生成总结报告时出错: {str(e)}")
+                return
 
             try:
-                doctor_system_prompt_text = self._get_doctor_system_prompt()
-                
-                context_for_doctor_list = []
-                for log_speaker, log_utterance in reversed(self.conversation_log):
-                    if log_speaker.startswith("Doctor") or log_speaker == "User":
-                        context_for_doctor_list.append(f"{log_speaker}: {log_utterance}")
-                    if len(context_for_doctor_list) >= 4:
-                        break
-                context_for_doctor = "\n".join(reversed(context_for_doctor_list))
-                
-                next_doctor_llm_prompt = (
-                    f"这是最近的对话历史:\n{context_for_doctor}\n\n"
-                    f"现在轮到你 ({self.doctor_persona.get('name', '医生')}) 回应。你可以继续之前的对话，或者针对代表的发言提出一个相关的临床问题或常见的顾虑/异议（例如关于药物效果、副作用、价格、患者依从性等）。请生成你的下一句对话。"
-                )
-                
-                if hasattr(self.strands_agent, 'tool') and hasattr(self.strands_agent.tool, 'use_llm'):
-                    doctor_next_line_data = self.strands_agent.tool.use_llm(
-                        prompt=next_doctor_llm_prompt,
-                        system_prompt=doctor_system_prompt_text
-                    )
-                    if isinstance(doctor_next_line_data, dict) and 'content' in doctor_next_line_data and \
-                       isinstance(doctor_next_line_data['content'], list) and len(doctor_next_line_data['content']) > 0 and \
-                       'text' in doctor_next_line_data['content'][0]:
-                        doctor_next_line = str(doctor_next_line_data['content'][0]['text'])
-                    else:
-                        doctor_next_line = str(doctor_next_line_data)
-                else:
-                    original_prompt = self.strands_agent.system_prompt
-                    self.strands_agent.system_prompt = doctor_system_prompt_text
-                    doctor_next_line = str(self.strands_agent(next_doctor_llm_prompt))
-                    self.strands_agent.system_prompt = original_prompt
+                doctor_next_line = doctor_future.result().strip()
 
                 tool_marker = ""
-                objection_keywords = ["价格", "费用", "太贵", "效果", "疗效", "副作用", "不良反应", "依从性"]
-                if any(keyword in doctor_next_line for keyword in objection_keywords):
+                if "objection" in get_matcher().match(doctor_next_line):
                     tool_marker = " _ObjectionTool_"
 
-                doctor_display_name = self.doctor_persona.get('name', '医生')
-                responses.append(f"Doctor {doctor_display_name} ▶ {doctor_next_line}{tool_marker}")
-                self.conversation_log.append((f"Doctor {doctor_display_name}", doctor_next_line))
+                emit_line(f"Doctor {doctor_display_name} ▶ {doctor_next_line}{tool_marker}", doctor_line_id)
+                session.conversation_log.add(Speaker.DOCTOR, doctor_next_line, name=doctor_display_name)
             except Exception as e:
-                responses.append(f"Doctor: 生成回复时出错: {str(e)}")
-            return responses
+                emit_line(f"Doctor: 生成回复时出错: {str(e)}")
+            return
         
-        elif self.current_mode == "final_summary":
-            responses.append("System: 培训已结束。如需开始新的培训，请按格式提示开始。")
-            self.current_mode = "waiting_for_start"
-            self.doctor_persona = None
-            return responses
-        
-        return responses
+        elif session.current_mode == "final_summary":
+            emit_line("System: 培训已结束。如需开始新的培训，请按格式提示开始。")
+            session.current_mode = "waiting_for_start"
+            session.doctor_persona = None
+            return
+
+# 演示用的完整训练流程（开始 -> 四轮回答 -> 结束），benchmark.py 也以此作为默认回放脚本
+DEMO_CHAT_INTERACTIONS = [
+    ("User", "药品: Semaglutide；科室: Endocrinology；难度: Basic。点击【Start】"),
+    ("User", "主任好！最新 SELECT 研究显示口服司美格鲁肽可显著降低 MACE 复合终点，心血管获益明确..."),
+    ("User", "关于价格，我们有相应的患者援助项目，同时长期来看，良好的血糖和体重控制能减少并发症治疗费用，总体是经济的。"),
+    ("User", "我们有详细的剂量递增指导方案，前4周使用0.25mg起始剂量，随后逐步增加到维持剂量，能很好地管理胃肠道反应，提高患者耐受性和依从性。"),
+    ("User", "好的主任，我会把SELECT研究摘要和剂量递增方案发到您的邮箱，并向您预约下周进行一次详细的学术拜访。"),
+    ("User", "点击【结束训练】")
+]
 
 def demonstrate_chat_flow():
     print("欢迎来到 PharmaRep Coach！")
     coach_agent = PharmaRepCoachAgent()
 
-    chat_interactions = [
-        ("User", "药品: Semaglutide；科室: Endocrinology；难度: Basic。点击【Start】"),
-        ("User", "主任好！最新 SELECT 研究显示口服司美格鲁肽可显著降低 MACE 复合终点，心血管获益明确..."),
-        ("User", "关于价格，我们有相应的患者援助项目，同时长期来看，良好的血糖和体重控制能减少并发症治疗费用，总体是经济的。"),
-        ("User", "我们有详细的剂量递增指导方案，前4周使用0.25mg起始剂量，随后逐步增加到维持剂量，能很好地管理胃肠道反应，提高患者耐受性和依从性。"),
-        ("User", "好的主任，我会把SELECT研究摘要和剂量递增方案发到您的邮箱，并向您预约下周进行一次详细的学术拜访。"),
-        ("User", "点击【结束训练】")
-    ]
-
-    for speaker, message in chat_interactions:
+    for speaker, message in DEMO_CHAT_INTERACTIONS:
         print(f"\n{speaker:10} ▶ {message}")
         if speaker == "User":
             agent_responses = coach_agent.handle_message(message)
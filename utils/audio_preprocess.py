@@ -0,0 +1,203 @@
+# utils/audio_preprocess.py
+# 可选的转录前音频预处理（AUDIO_PREPROCESS=true）：用 ffmpeg 把浏览器录制的 webm 等格式解码并下混、重采样为 16 kHz 单声道，
+# 用 NumPy 按帧能量做语音活动检测，去掉首尾静音并把较长的中间停顿压缩到 AUDIO_PREPROCESS_KEEP_SILENCE 秒，
+# 再编码为 Ogg/Opus（或 FLAC、WAV）上传，Transcribe 需要处理的时长随之减少；编码结果不比原始录音小时仍上传原始录音。
+# 解码需要完整的音频，预处理只用于不超过 AUDIO_PREPROCESS_MAX_BYTES 的录音（在内存中处理），更长的录音跳过预处理、照常流式上传。
+# 需要安装 numpy 和 ffmpeg；缺少依赖或解码失败时原样上传，不影响转录。
+
+import io
+import os
+import shutil
+import subprocess
+import threading
+import wave
+
+from . import metrics
+from .transcription import UploadTooLargeError
+
+SAMPLE_RATE = 16000
+# 每帧 30 ms
+FRAME_SAMPLES = SAMPLE_RATE * 30 // 1000
+
+AUDIO_PREPROCESS_BYTES = metrics.Counter(
+    "medcoach_audio_preprocess_bytes_total", "Audio bytes before and after preprocessing.", ("direction",),
+)
+AUDIO_PREPROCESS_SECONDS = metrics.Counter(
+    "medcoach_audio_preprocess_audio_seconds_total", "Audio duration before and after preprocessing.", ("direction",),
+)
+
+_warned = set()
+_warned_lock = threading.Lock()
+
+
+def _warn_once(key: str, message: str):
+    with _warned_lock:
+        if key in _warned:
+            return
+        _warned.add(key)
+    print(f"Warning: {message}")
+
+
+def is_enabled() -> bool:
+    return os.getenv("AUDIO_PREPROCESS", "false").lower() in ("1", "true", "yes")
+
+
+# 各输出格式对应的 ffmpeg 编码参数和上传时的文件扩展名（Transcribe MediaFormat）
+OUTPUT_FORMATS = {
+    "ogg": (["-c:a", "libopus", "-b:a", "24k", "-f", "ogg"], "ogg"),
+    "flac": (["-f", "flac"], "flac"),
+    "wav": (None, "wav"),
+}
+
+
+class _PrefixedStream:
+    """已读入内存的开头部分 + 原始流的剩余部分，跳过预处理的长录音由此继续流式上传"""
+
+    def __init__(self, prefix: bytes, stream):
+        self._prefix = prefix
+        self._stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if not self._prefix:
+            return self._stream.read(size)
+        if size is None or size < 0:
+            chunk, self._prefix = self._prefix + self._stream.read(), b""
+            return chunk
+        chunk, self._prefix = self._prefix[:size], self._prefix[size:]
+        return chunk
+
+
+def _read_up_to(stream, limit: int) -> tuple[bytes, bool]:
+    """最多读取 limit + 1 字节，返回 (数据, 是否已读完整个流)"""
+    chunks = []
+    total = 0
+    while total <= limit:
+        chunk = stream.read(min(limit + 1 - total, 1024 * 1024))
+        if not chunk:
+            return b"".join(chunks), True
+        chunks.append(chunk)
+        total += len(chunk)
+    return b"".join(chunks), False
+
+
+def _ffmpeg(args: list[str], data: bytes) -> bytes:
+    completed = subprocess.run(
+        [os.getenv("FFMPEG_PATH", "ffmpeg"), "-hide_banner", "-loglevel", "error", *args],
+        input=data, capture_output=True, timeout=float(os.getenv("AUDIO_PREPROCESS_TIMEOUT", 30)),
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.decode("utf-8", "replace").strip()[-500:] or "ffmpeg failed")
+    return completed.stdout
+
+
+def decode(data: bytes):
+    """解码任意 ffmpeg 支持的格式，返回 16 kHz 单声道 int16 样本（下混与重采样由 ffmpeg 完成）"""
+    import numpy as np
+
+    pcm = _ffmpeg(["-i", "pipe:0", "-vn", "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "pipe:1"], data)
+    return np.frombuffer(pcm, dtype=np.int16)
+
+
+def trim_silence(samples, threshold_db: float | None = None, keep_silence: float | None = None):
+    """
+    按帧能量检测语音，返回去掉静音后的样本
+
+    阈值为 噪声底 + threshold_db（噪声底取帧能量的第 10 百分位，阈值不高于峰值以下 25 dB、不低于绝对下限）；语音帧前后各保留 keep_silence 秒，
+    因此首尾静音被裁掉，中间超过 2 × keep_silence 的停顿被压缩。检测不到语音时原样返回。
+    """
+    import numpy as np
+
+    threshold_db = threshold_db if threshold_db is not None else float(os.getenv("AUDIO_PREPROCESS_THRESHOLD_DB", 12))
+    keep_silence = keep_silence if keep_silence is not None else float(os.getenv("AUDIO_PREPROCESS_KEEP_SILENCE", 0.3))
+
+    frame_count = len(samples) // FRAME_SAMPLES
+    if frame_count == 0:
+        return samples
+    frames = samples[:frame_count * FRAME_SAMPLES].astype(np.float32).reshape(frame_count, FRAME_SAMPLES)
+    energy_db = 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-9)
+    # 几乎没有停顿的短录音中噪声底会落在较轻的语音上，阈值最多取到峰值以下 25 dB；30 dB（int16 均方根约 30）以下一律视为静音
+    threshold = max(min(np.percentile(energy_db, 10) + threshold_db, energy_db.max() - 25), 30.0)
+    voiced = energy_db > threshold
+    if not voiced.any():
+        return samples
+
+    # 语音帧向两侧扩展 keep_silence，保留词首词尾的弱音和自然停顿
+    padding = int(keep_silence * 1000 / 30)
+    # mode="full" 再截取中间 frame_count 帧：mode="same" 在录音短于卷积核（约 2 × keep_silence）时会返回比帧数更长的结果
+    keep = np.convolve(voiced.astype(np.int32), np.ones(2 * padding + 1, dtype=np.int32), mode="full")[padding:padding + frame_count] > 0
+    kept = frames[keep].astype(np.int16).reshape(-1)
+    # 末尾不足一帧的样本仅在最后一帧保留时一并保留
+    if keep[-1]:
+        kept = np.concatenate([kept, samples[frame_count * FRAME_SAMPLES:]])
+    return kept
+
+
+def encode(samples, output_format: str) -> bytes:
+    """编码为 16 kHz 单声道 WAV（标准库），或由 ffmpeg 转为 Ogg/Opus、FLAC"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(samples.tobytes())
+    codec_args = OUTPUT_FORMATS[output_format][0]
+    if codec_args is None:
+        return buffer.getvalue()
+    return _ffmpeg(["-f", "wav", "-i", "pipe:0", *codec_args, "pipe:1"], buffer.getvalue())
+
+
+def preprocess_audio(stream, file_extension: str, max_bytes: int | None = None):
+    """
+    读取上传的音频并预处理，返回 (stream, file_extension, stats)
+
+    stats 包含处理前后的字节数与时长（秒）；未做处理（依赖缺失、解码失败、编码后没有变小）时 stats["applied"] 为 False，
+    返回的 stream 为原始音频。超过 AUDIO_PREPROCESS_MAX_BYTES 的录音不读入内存，返回的 stream 继续流式读取原始音频，
+    stats 中 input_bytes 为 None。超过 max_bytes 时抛出 UploadTooLargeError（长录音由上传时的大小检查负责）。
+    """
+    limit = int(os.getenv("AUDIO_PREPROCESS_MAX_BYTES", 5 * 1024 * 1024))
+    if max_bytes:
+        limit = min(limit, max_bytes)
+    data, complete = _read_up_to(stream, limit)
+    if not complete:
+        if max_bytes and len(data) > max_bytes:
+            raise UploadTooLargeError(f"音频文件超过大小上限 {max_bytes} 字节")
+        return _PrefixedStream(data, stream), file_extension, {"applied": False, "input_bytes": None, "output_bytes": None}
+
+    stats = {"applied": False, "input_bytes": len(data), "output_bytes": len(data)}
+    output_format = os.getenv("AUDIO_PREPROCESS_FORMAT", "ogg").lower()
+    if output_format not in OUTPUT_FORMATS:
+        output_format = "ogg"
+
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        _warn_once("numpy", "AUDIO_PREPROCESS is enabled but numpy is not installed, uploading audio as-is")
+        return io.BytesIO(data), file_extension, stats
+    if shutil.which(os.getenv("FFMPEG_PATH", "ffmpeg")) is None:
+        _warn_once("ffmpeg", "AUDIO_PREPROCESS is enabled but ffmpeg was not found, uploading audio as-is")
+        return io.BytesIO(data), file_extension, stats
+
+    try:
+        with metrics.span("audio_preprocess"):
+            samples = decode(data)
+            trimmed = trim_silence(samples)
+            encoded = encode(trimmed, output_format)
+    except Exception as e:
+        print(f"Warning: audio preprocessing failed, uploading audio as-is: {str(e)}")
+        return io.BytesIO(data), file_extension, stats
+
+    if len(encoded) >= len(data):
+        # 重新编码后不比原始录音小（如高压缩率的 webm/opus 转为 FLAC），直接上传原始音频
+        return io.BytesIO(data), file_extension, stats
+
+    stats.update({
+        "applied": True,
+        "output_bytes": len(encoded),
+        "input_seconds": round(len(samples) / SAMPLE_RATE, 2),
+        "output_seconds": round(len(trimmed) / SAMPLE_RATE, 2),
+    })
+    AUDIO_PREPROCESS_BYTES.inc(stats["input_bytes"], direction="input")
+    AUDIO_PREPROCESS_BYTES.inc(stats["output_bytes"], direction="output")
+    AUDIO_PREPROCESS_SECONDS.inc(stats["input_seconds"], direction="input")
+    AUDIO_PREPROCESS_SECONDS.inc(stats["output_seconds"], direction="output")
+    return io.BytesIO(encoded), OUTPUT_FORMATS[output_format][1], stats
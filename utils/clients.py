@@ -0,0 +1,78 @@
+# utils/clients.py
+# 进程级共享的 AWS / HTTP 客户端。boto3 客户端是线程安全的，构建一次后在所有请求间复用，
+# 避免每次请求重复解析凭证、创建连接池和 TLS 握手。boto3 / requests 在首次创建客户端时才导入，不拖慢服务启动。
+
+import os
+import threading
+
+_aws_clients = {}
+_http_session = None
+# 可重入：创建 Transcribe 替身时会在持有锁的情况下获取共享 HTTP 会话
+_lock = threading.RLock()
+
+
+def get_aws_client(service_name: str):
+    """
+    返回指定服务的共享 boto3 客户端（首次调用时创建）
+
+    连接池大小由 AWS_MAX_POOL_CONNECTIONS 配置（默认 50）。设置 AWS_BACKEND=fake 时返回本地替身（见 utils/fake_aws.py）。
+    """
+    client = _aws_clients.get(service_name)
+    if client is None:
+        with _lock:
+            client = _aws_clients.get(service_name)
+            if client is None and os.getenv('AWS_BACKEND', 'aws').lower() == 'fake':
+                from .fake_aws import create_fake_client
+                client = _aws_clients[service_name] = create_fake_client(service_name)
+            elif client is None:
+                import boto3
+                from botocore.config import Config
+
+                client = boto3.client(
+                    service_name,
+                    aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+                    aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+                    region_name=os.getenv('AWS_REGION', 'us-east-1'),
+                    config=Config(
+                        max_pool_connections=int(os.getenv('AWS_MAX_POOL_CONNECTIONS', 50)),
+                        tcp_keepalive=True,
+                        retries={'mode': 'standard'},
+                    ),
+                )
+                _aws_clients[service_name] = client
+    return client
+
+
+def get_http_session():
+    """
+    返回共享的 requests.Session，复用 keep-alive 连接
+
+    连接池数量和每个池的最大连接数由 HTTP_POOL_CONNECTIONS、HTTP_POOL_MAXSIZE 配置。
+    """
+    global _http_session
+    if _http_session is None:
+        with _lock:
+            if _http_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=int(os.getenv('HTTP_POOL_CONNECTIONS', 10)),
+                    pool_maxsize=int(os.getenv('HTTP_POOL_MAXSIZE', 50)),
+                    max_retries=2,
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _http_session = session
+    return _http_session
+
+
+def warm_up(services=('s3', 'transcribe')):
+    """预先创建客户端（完成凭证解析和端点配置），供服务启动时在后台调用"""
+    for service_name in services:
+        try:
+            get_aws_client(service_name)
+        except Exception as e:
+            print(f"Warning: failed to warm up {service_name} client: {str(e)}")
+    get_http_session()
@@ -0,0 +1,124 @@
+# utils/conversation.py
+# 紧凑的对话记录：发言人用枚举表示，每轮对话存为带 __slots__ 的记录；
+# 按角色维护有界 deque，医生上下文窗口直接取自 deque，无需每轮倒序扫描整段记录。
+# 内存中只保留最近的若干轮，更早的记录可选地追加写入磁盘（JSONL）。
+
+import enum
+import json
+import os
+from collections import deque
+
+
+class Speaker(enum.IntEnum):
+    USER = 0
+    DOCTOR = 1
+    COACH = 2
+    SUMMARY = 3
+
+
+class Turn:
+    __slots__ = ("speaker", "name", "text")
+
+    def __init__(self, speaker: Speaker, text: str, name: str | None = None):
+        self.speaker = speaker
+        self.name = name  # 医生的显示名，其他角色为 None
+        self.text = text
+
+    @property
+    def label(self) -> str:
+        """与旧版 (speaker, utterance) 记录一致的发言人标签，如 "User"、"Doctor 李伟"、"Coach" """
+        if self.speaker is Speaker.DOCTOR:
+            return f"Doctor {self.name}" if self.name else "Doctor"
+        return self.speaker.name.capitalize()
+
+    def __iter__(self):
+        # 支持 `for speaker, utterance in log` 的元组式解包
+        yield self.label
+        yield self.text
+
+    def to_dict(self) -> dict:
+        return {"speaker": int(self.speaker), "name": self.name, "text": self.text}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Turn":
+        return cls(Speaker(data["speaker"]), data["text"], data.get("name"))
+
+
+class ConversationLog:
+    """
+    单个会话的对话记录
+
+    Args:
+        dialogue_window (int): 保留的最近医生/代表发言条数（医生上下文和总结都从中截取），默认读取 SESSION_DIALOGUE_WINDOW
+        max_turns (int): 内存中最多保留的轮数，默认读取 SESSION_LOG_MAX_TURNS
+        spill_path (str): 超出 max_turns 的旧记录追加写入的 JSONL 文件；为空时直接丢弃
+    """
+
+    __slots__ = ("_turns", "_dialogue", "_by_role", "max_turns", "spill_path", "spilled_count", "on_add")
+
+    def __init__(self, dialogue_window: int | None = None, max_turns: int | None = None, spill_path: str | None = None):
+        self.max_turns = max_turns or int(os.getenv("SESSION_LOG_MAX_TURNS", 200))
+        self._turns: deque[Turn] = deque()
+        self._dialogue: deque[Turn] = deque(maxlen=dialogue_window or int(os.getenv("SESSION_DIALOGUE_WINDOW", 8)))
+        # 每个角色各自的最近记录，容量与对话窗口相同
+        self._by_role: dict[Speaker, deque[Turn]] = {speaker: deque(maxlen=self._dialogue.maxlen) for speaker in Speaker}
+        self.spill_path = spill_path
+        self.spilled_count = 0
+        self.on_add = None  # on_add(turn)，每追加一轮调用一次（会话持久化按轮追加写入）
+
+    def add(self, speaker: Speaker, text: str, name: str | None = None) -> Turn:
+        turn = Turn(speaker, text, name)
+        self._turns.append(turn)
+        self._by_role[speaker].append(turn)
+        if speaker in (Speaker.USER, Speaker.DOCTOR):
+            self._dialogue.append(turn)
+        if len(self._turns) > self.max_turns:
+            self._spill(self._turns.popleft())
+        if self.on_add is not None:
+            self.on_add(turn)
+        return turn
+
+    def recent_dialogue(self, limit: int | None = None) -> list[Turn]:
+        """最近的医生/代表发言（按时间顺序），O(窗口长度)"""
+        turns = list(self._dialogue)
+        return turns[-limit:] if limit else turns
+
+    def recent(self, speaker: Speaker, limit: int | None = None) -> list[Turn]:
+        """某个角色最近的发言（按时间顺序）"""
+        turns = list(self._by_role[speaker])
+        return turns[-limit:] if limit else turns
+
+    def last(self, speaker: Speaker) -> Turn | None:
+        turns = self._by_role[speaker]
+        return turns[-1] if turns else None
+
+    def iter_all(self):
+        """按时间顺序遍历全部记录，包括已写入磁盘的旧记录"""
+        if self.spill_path and self.spilled_count:
+            with open(self.spill_path, encoding="utf-8") as f:
+                for line in f:
+                    yield Turn.from_dict(json.loads(line))
+        yield from self._turns
+
+    def _spill(self, turn: Turn):
+        if not self.spill_path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.spill_path)), exist_ok=True)
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(turn.to_dict(), ensure_ascii=False) + "\n")
+        self.spilled_count += 1
+
+    def discard_spill(self):
+        """删除已写入磁盘的旧记录"""
+        if self.spill_path:
+            try:
+                os.remove(self.spill_path)
+            except FileNotFoundError:
+                pass
+            self.spilled_count = 0
+
+    def __iter__(self):
+        return iter(self._turns)
+
+    def __len__(self) -> int:
+        return len(self._turns)
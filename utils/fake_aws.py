@@ -0,0 +1,104 @@
+# utils/fake_aws.py
+# 本地的 S3 / Transcribe 替身（AWS_BACKEND=fake）：只实现本项目用到的 API，按配置的耗时模拟上传和转录，
+# 转录结果通过 fake-transcribe:// URI 由共享 requests.Session 上挂载的适配器返回，调度器代码无需任何改动。
+
+import json
+import os
+import threading
+import time
+
+from requests import Response
+from requests.adapters import BaseAdapter
+
+TRANSCRIPT_URI_SCHEME = "fake-transcribe://"
+
+
+class FakeS3Client:
+    """读取完整上传流（保证上传耗时、大小上限等逻辑与真实路径一致），只记录对象大小"""
+
+    def __init__(self, latency: float | None = None):
+        self.latency = latency if latency is not None else float(os.getenv("FAKE_AWS_LATENCY", 0.05))
+        self.objects: dict[tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+        size = 0
+        while chunk := Fileobj.read(1024 * 1024):
+            size += len(chunk)
+        time.sleep(self.latency)
+        with self._lock:
+            self.objects[(Bucket, Key)] = size
+
+    def delete_object(self, Bucket, Key):
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+
+class FakeTranscribeClient:
+    """作业提交后经过 duration 秒变为 COMPLETED，结果文本固定"""
+
+    def __init__(self, duration: float | None = None, latency: float | None = None, text: str | None = None):
+        self.duration = duration if duration is not None else float(os.getenv("FAKE_TRANSCRIBE_DURATION", 2.0))
+        self.latency = latency if latency is not None else float(os.getenv("FAKE_AWS_LATENCY", 0.05))
+        self.text = text or os.getenv("FAKE_TRANSCRIPT_TEXT", "主任您好，我们的临床研究数据显示该药物可以显著改善血糖控制。")
+        self.jobs: dict[str, float] = {}  # job_name -> 提交时间
+        self._lock = threading.Lock()
+
+    def _status(self, job_name: str) -> str:
+        return "COMPLETED" if time.monotonic() - self.jobs[job_name] >= self.duration else "IN_PROGRESS"
+
+    def start_transcription_job(self, TranscriptionJobName, **kwargs):
+        time.sleep(self.latency)
+        with self._lock:
+            self.jobs[TranscriptionJobName] = time.monotonic()
+        return {"TranscriptionJob": {"TranscriptionJobName": TranscriptionJobName, "TranscriptionJobStatus": "IN_PROGRESS"}}
+
+    def list_transcription_jobs(self, Status=None, JobNameContains="", MaxResults=100, NextToken=None):
+        time.sleep(self.latency)
+        # 替身中的作业提交后立即处于 IN_PROGRESS，不会出现 QUEUED
+        with self._lock:
+            names = [name for name in self.jobs
+                     if JobNameContains in name and (Status is None or self._status(name) == Status)]
+        return {"TranscriptionJobSummaries": [{"TranscriptionJobName": name} for name in names]}
+
+    def get_transcription_job(self, TranscriptionJobName):
+        time.sleep(self.latency)
+        with self._lock:
+            status = self._status(TranscriptionJobName)
+        job = {"TranscriptionJobName": TranscriptionJobName, "TranscriptionJobStatus": status}
+        if status == "COMPLETED":
+            job["Transcript"] = {"TranscriptFileUri": f"{TRANSCRIPT_URI_SCHEME}{TranscriptionJobName}"}
+        return {"TranscriptionJob": job}
+
+
+class FakeTranscriptAdapter(BaseAdapter):
+    """返回 Amazon Transcribe 结果文件格式的 JSON"""
+
+    def __init__(self, transcribe_client: FakeTranscribeClient):
+        super().__init__()
+        self.transcribe_client = transcribe_client
+
+    def send(self, request, **kwargs):
+        response = Response()
+        response.status_code = 200
+        response.url = request.url
+        response.request = request
+        response._content = json.dumps(
+            {"results": {"transcripts": [{"transcript": self.transcribe_client.text}]}}, ensure_ascii=False
+        ).encode("utf-8")
+        return response
+
+    def close(self):
+        pass
+
+
+def create_fake_client(service_name: str):
+    if service_name == "s3":
+        return FakeS3Client()
+    if service_name == "transcribe":
+        from .clients import get_http_session
+        client = FakeTranscribeClient()
+        get_http_session().mount(TRANSCRIPT_URI_SCHEME, FakeTranscriptAdapter(client))
+        return client
+    raise ValueError(f"AWS_BACKEND=fake 不支持的服务: {service_name}")
@@ -0,0 +1,111 @@
+# utils/fake_model.py
+# 本地假模型：实现 Strands 的 Model 接口，按配置的首 token 延迟、生成速度和抖动逐 token 流式输出固定话术，
+# 不发起任何网络请求。用于压测和延迟基准（MODEL_PROVIDER=fake），让 /chat 的吞吐和延迟测量不产生模型费用。
+
+import asyncio
+import json
+import os
+import random
+
+from strands.models import Model
+
+DOCTOR_LINES = (
+    "这个药的价格确实偏高，医保报销之后患者每个月还要自付多少？",
+    "胃肠道反应的发生率有多高？临床上患者停药的比例是多少？",
+    "和现有的 GLP-1 相比，疗效上的差异有头对头研究的数据吗？",
+    "心血管获益的数据我了解了，那在老年患者中的安全性怎么样？",
+)
+
+COACH_FEEDBACK = (
+    "评分：{score}/100；合规性：🟢。亮点：引用了临床研究数据，称呼得体。"
+    "改进建议：先回应医生的顾虑，再给出具体的剂量管理方案，并主动约定后续拜访。"
+)
+
+SUMMARY_TEXT = (
+    "本次训练总结：学术性表现良好，能够引用研究数据；沟通技巧较为得体；"
+    "异议处理方面需要更具体地回应价格和副作用问题；全程未发现合规风险。下次训练建议重点练习异议处理。"
+)
+
+PERSONA_JSON = {
+    "name": "张敏", "specialty": "内分泌科",
+    "opening_line": "“你好，我门诊的糖尿病患者很多，你们这个药有什么新的循证数据？”",
+    "characteristics": "女·50 岁·主任医师·周处方量≈30 支",
+}
+
+
+class FakeModel(Model):
+    """
+    按 prompt 类型返回固定话术的假模型
+
+    Args:
+        latency (float): 首个 token 之前的等待时间（秒），默认读取 FAKE_MODEL_LATENCY
+        tokens_per_second (float): 生成速度，默认读取 FAKE_MODEL_TOKENS_PER_SEC
+        jitter (float): 延迟和生成速度的随机波动比例（0.2 表示 ±20%），默认读取 FAKE_MODEL_JITTER
+        seed (int): 随机种子，默认读取 FAKE_MODEL_SEED，便于多次基准测试之间对比
+        timeout (float): 生成耗时超过该秒数时抛出 TimeoutError，模拟真实客户端的读取超时
+    """
+
+    def __init__(self, latency: float | None = None, tokens_per_second: float | None = None,
+                 jitter: float | None = None, seed: int | None = None, timeout: float | None = None):
+        self.config = {
+            "model_id": "fake",
+            "latency": latency if latency is not None else float(os.getenv("FAKE_MODEL_LATENCY", 0.5)),
+            "tokens_per_second": tokens_per_second or float(os.getenv("FAKE_MODEL_TOKENS_PER_SEC", 50)),
+            "jitter": jitter if jitter is not None else float(os.getenv("FAKE_MODEL_JITTER", 0.2)),
+            "timeout": timeout,
+        }
+        self._random = random.Random(seed if seed is not None else int(os.getenv("FAKE_MODEL_SEED", 0)))
+
+    def update_config(self, **model_config):
+        self.config.update(model_config)
+
+    def get_config(self) -> dict:
+        return self.config
+
+    async def structured_output(self, output_model, prompt, system_prompt=None, **kwargs):
+        raise NotImplementedError("FakeModel 不支持 structured_output")
+        yield  # pragma: no cover
+
+    def _jittered(self, value: float) -> float:
+        jitter = self.config["jitter"]
+        return value * (1 + self._random.uniform(-jitter, jitter)) if jitter else value
+
+    def _respond(self, prompt: str, system_prompt: str | None) -> str:
+        # 医生回复使用医生人设的 system prompt，其余调用使用协调员 system prompt，按 prompt 内容区分
+        if "人设" in prompt:
+            return json.dumps(PERSONA_JSON, ensure_ascii=False)
+        if system_prompt and "角色扮演" in system_prompt:
+            return self._random.choice(DOCTOR_LINES)
+        if "总结" in prompt:
+            return SUMMARY_TEXT
+        return COACH_FEEDBACK.format(score=self._random.randint(60, 95))
+
+    async def stream(self, messages, tool_specs=None, system_prompt=None, **kwargs):
+        prompt = "".join(
+            block.get("text", "") for block in (messages[-1]["content"] if messages else []) if isinstance(block, dict)
+        )
+        text = self._respond(prompt, system_prompt)
+        timeout = self.config.get("timeout")
+        deadline = asyncio.get_running_loop().time() + timeout if timeout else None
+
+        async def sleep(seconds: float):
+            if deadline is not None and asyncio.get_running_loop().time() + seconds > deadline:
+                await asyncio.sleep(max(deadline - asyncio.get_running_loop().time(), 0))
+                raise TimeoutError(f"fake model timed out after {timeout:g}s")
+            await asyncio.sleep(seconds)
+
+        yield {"messageStart": {"role": "assistant"}}
+        yield {"contentBlockStart": {"start": {}}}
+        await sleep(max(self._jittered(self.config["latency"]), 0))
+        # 以单个字符为一个 token（中文话术下与真实模型的 token 粒度接近）
+        for char in text:
+            yield {"contentBlockDelta": {"delta": {"text": char}}}
+            await sleep(1 / max(self._jittered(self.config["tokens_per_second"]), 1e-3))
+        yield {"contentBlockStop": {}}
+        yield {"messageStop": {"stopReason": "end_turn"}}
+        yield {
+            "metadata": {
+                "usage": {"inputTokens": len(prompt), "outputTokens": len(text), "totalTokens": len(prompt) + len(text)},
+                "metrics": {"latencyMs": 0},
+            }
+        }
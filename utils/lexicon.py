@@ -0,0 +1,169 @@
+# utils/lexicon.py
+# 合规词库与多模式关键词匹配（Aho–Corasick）。词库按类别组织，自动机只构建一次，
+# 每条发言单次扫描即可找出所有类别的命中词，扫描耗时与词库大小无关。
+
+import json
+import os
+from functools import lru_cache
+
+DEFAULT_LEXICON_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "compliance_lexicon.json")
+
+# 批量匹配时用于拼接多条发言的分隔符，不会出现在任何词条中
+_BATCH_SEPARATOR = "\x00"
+
+
+class KeywordMatcher:
+    """
+    Aho–Corasick 多模式匹配器
+
+    Args:
+        lexicon (dict[str, list[str]]): 类别 -> 词条列表。同一词条可以属于多个类别，英文词条不区分大小写。
+    """
+
+    def __init__(self, lexicon: dict[str, list[str]]):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[tuple] = [()]  # 每个状态命中的 (词条, 类别)
+        self.categories = tuple(lexicon)
+
+        for category, terms in lexicon.items():
+            for term in terms:
+                term = term.lower()
+                if term and _BATCH_SEPARATOR not in term:
+                    self._insert(term, category)
+        self._build_fail_links()
+
+    def _insert(self, term: str, category: str):
+        state = 0
+        for char in term:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        if (term, category) not in self._output[state]:
+            self._output[state] += ((term, category),)
+
+    def _build_fail_links(self):
+        # 按 BFS 顺序构建失败指针，并把失败链上的输出合并到当前状态，匹配时无需再沿失败链收集
+        queue = list(self._goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail_target = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail_target if fail_target != next_state else 0
+                self._output[next_state] += self._output[self._fail[next_state]]
+
+    def iter_matches(self, text: str):
+        """依次产出 (结束位置, 词条, 类别)"""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for index, char in enumerate(text.lower()):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for term, category in output[state]:
+                yield index, term, category
+
+    def match(self, text: str) -> dict[str, set[str]]:
+        """返回 类别 -> 命中词条集合（只包含有命中的类别）"""
+        hits: dict[str, set[str]] = {}
+        for _, term, category in self.iter_matches(text):
+            hits.setdefault(category, set()).add(term)
+        return hits
+
+    def match_batch(self, texts: list[str]) -> list[dict[str, set[str]]]:
+        """批量匹配：多条发言拼接后单次扫描，按位置切分回每条发言的命中结果"""
+        results = [{} for _ in texts]
+        if not texts:
+            return results
+        texts = [text.lower().replace(_BATCH_SEPARATOR, " ") for text in texts]
+        joined = _BATCH_SEPARATOR.join(texts)
+        text_index = 0
+        boundary = len(texts[0])  # 当前发言的结束位置（不含）
+        for position, term, category in self.iter_matches(joined):
+            while position >= boundary:
+                text_index += 1
+                boundary += 1 + len(texts[text_index])
+            results[text_index].setdefault(category, set()).add(term)
+        return results
+
+
+def load_lexicon(path: str | None = None) -> dict[str, list[str]]:
+    """从 JSON 文件加载词库（类别 -> 词条列表），路径默认读取 COMPLIANCE_LEXICON_PATH"""
+    path = path or os.getenv("COMPLIANCE_LEXICON_PATH") or DEFAULT_LEXICON_PATH
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=None)
+def get_matcher(path: str | None = None) -> KeywordMatcher:
+    """返回进程内共享的匹配器（每个词库文件只构建一次）"""
+    return KeywordMatcher(load_lexicon(path))
+
+
+def _score_from_hits(utterance: str, hits: dict[str, set[str]]) -> dict:
+    # 基础评分因素
+    score = 70  # 基础分
+
+    # 准确性评估
+    if len(utterance) > 50:  # 回答有一定长度
+        score += 10
+    if "evidence" in hits:  # 引用证据
+        score += 10
+    if "safety" in hits:  # 提及安全性
+        score += 5
+
+    # 合规性评估
+    if "forbidden" in hits:
+        score -= 20
+
+    # 专业性评估
+    if "professional" in hits:
+        score += 5
+
+    # 确保分数在合理范围内
+    score = max(0, min(100, score))
+
+    # 生成改进建议
+    comments = []
+
+    if score < 60:
+        comments.append("回答需要更加专业和准确")
+    elif score < 80:
+        comments.append("可以增加更多循证医学证据")
+    else:
+        comments.append("回答质量良好")
+
+    if len(utterance) < 30:
+        comments.append("建议提供更详细的信息")
+
+    if "clinical_reference" not in hits:
+        comments.append("建议引用相关临床研究数据")
+
+    return {
+        "score": score,
+        "comment": "；".join(comments[:2]),  # 最多取前两个建议
+        "forbidden_hits": sorted(hits.get("forbidden", ())),
+    }
+
+
+def score_utterance(utterance: str, matcher: KeywordMatcher | None = None) -> dict:
+    """对一条药代发言做规则打分，返回 {"score", "comment", "forbidden_hits"}"""
+    matcher = matcher or get_matcher()
+    return _score_from_hits(utterance, matcher.match(utterance))
+
+
+def score_utterances(utterances: list[str], matcher: KeywordMatcher | None = None) -> list[dict]:
+    """批量打分，所有发言共用一次自动机扫描"""
+    matcher = matcher or get_matcher()
+    return [_score_from_hits(utterance, hits) for utterance, hits in zip(utterances, matcher.match_batch(utterances))]
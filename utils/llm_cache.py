@@ -0,0 +1,152 @@
+# utils/llm_cache.py
+# 模型响应缓存（可选开启）：按 规范化 prompt + system prompt + 模型 ID + temperature 做内容寻址，
+# 内存 LRU 在前、SQLite 磁盘层在后，支持 TTL 和按总字节数淘汰。
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "llm_cache.sqlite3")
+
+
+def normalize_prompt(text: str | None) -> str:
+    """合并空白字符，避免仅因空格/换行不同而缓存不命中"""
+    return " ".join((text or "").split())
+
+
+class ResponseCache:
+    """
+    两级模型响应缓存
+
+    Args:
+        path (str): SQLite 文件路径，默认读取 LLM_CACHE_PATH；传入空字符串则只使用内存层
+        memory_entries (int): 内存层最多缓存的条目数，默认读取 LLM_CACHE_MEMORY_ENTRIES
+        max_disk_bytes (int): 磁盘层响应文本总字节数上限，超出时淘汰最久未访问的条目，默认读取 LLM_CACHE_MAX_BYTES
+        ttl (float): 条目有效期（秒），默认读取 LLM_CACHE_TTL
+    """
+
+    def __init__(self, path: str | None = None, memory_entries: int | None = None,
+                 max_disk_bytes: int | None = None, ttl: float | None = None):
+        self.path = path if path is not None else (os.getenv("LLM_CACHE_PATH") or DEFAULT_CACHE_PATH)
+        self.memory_entries = memory_entries or int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", 2048))
+        self.max_disk_bytes = max_disk_bytes or int(os.getenv("LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+        self.ttl = ttl or float(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))
+        self.hits = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory: OrderedDict[str, tuple[str, float]] = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self._db = None
+        if self.path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self._db.commit()
+            self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(prompt: str, system_prompt: str | None, model_id: str | None, temperature: float | None, **extra) -> str:
+        payload = json.dumps(
+            [normalize_prompt(prompt), normalize_prompt(system_prompt), model_id, temperature, sorted(extra.items())],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        return self.get_any((key,))
+
+    def get_any(self, keys) -> str | None:
+        """按顺序查找多个键，返回第一个命中的值；全部未命中只计一次 miss"""
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                value = self._get_locked(key, now)
+                if value is not None:
+                    return value
+            self.misses += 1
+            return None
+
+    def _get_locked(self, key: str, now: float) -> str | None:
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[1] > now:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return entry[0]
+            del self._memory[key]
+
+        if self._db is not None:
+            row = self._db.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] > now:
+                self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                self._db.commit()
+                self._put_memory(key, row[0], row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return row[0]
+        return None
+
+    def put(self, key: str, value: str):
+        now = time.time()
+        expires_at = now + self.ttl
+        with self._lock:
+            self._put_memory(key, value, expires_at)
+            if self._db is None:
+                return
+            size = len(value.encode("utf-8"))
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, expires_at, now),
+            )
+            # 运行中累计的大小只增不减（替换、过期不扣除），超过上限时才重新统计并淘汰
+            self._disk_bytes += size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk(now)
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+            }
+
+    def _put_memory(self, key: str, value: str, expires_at: float):
+        self._memory[key] = (value, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now: float):
+        self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > self.max_disk_bytes:
+            # 按最近访问时间从旧到新删除，直到总大小回到上限以内
+            excess = total - self.max_disk_bytes
+            freed = 0
+            stale_keys = []
+            for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_access"):
+                stale_keys.append((key,))
+                freed += size
+                if freed >= excess:
+                    break
+            self._db.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+            total -= freed
+        self._disk_bytes = total
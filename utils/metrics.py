@@ -0,0 +1,232 @@
+# utils/metrics.py
+# 进程内指标与分阶段计时：无第三方依赖的 Counter / Histogram / Gauge，以 Prometheus 文本格式导出（/metrics）。
+# 每个阶段（教练评估、医生回复、总结、S3 上传、转录等）用 span() 计时，按 (stage, mode) 记入直方图；
+# 按 METRICS_TRACE_SAMPLE_RATE 采样的请求会把完整的 span 树写入本地文件（Chrome Trace Event 格式），便于离线做火焰图分析。
+
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+DEFAULT_TRACE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "traces.jsonl")
+
+# 覆盖从毫秒级的本地处理到分钟级的转录作业
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple, values: tuple, le: str | None = None) -> str:
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(labelnames, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def collect(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            series = list(self._series.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in series]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]  # 各桶计数（非累计）、总和、次数
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        lines = []
+        for key, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, str(bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, '+Inf')} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Gauge(_Metric):
+    """取值在导出时通过回调计算，如当前会话数、进行中的转录作业数"""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def collect(self) -> list[str]:
+        try:
+            return [f"{self.name} {self.callback()}"]
+        except Exception as e:
+            print(f"Warning: failed to collect gauge {self.name}: {str(e)}")
+            return []
+
+
+STAGE_SECONDS = Histogram(
+    "medcoach_stage_duration_seconds", "Duration of each processing stage.", ("stage", "mode"),
+)
+LLM_CALLS = Counter("medcoach_llm_calls_total", "Model calls by stage and outcome.", ("stage", "outcome"))
+LLM_TOKENS = Counter("medcoach_llm_tokens_total", "Model tokens by stage and direction.", ("stage", "direction"))
+TRANSCRIBE_JOBS = Counter("medcoach_transcription_jobs_total", "Finished transcription jobs by status.", ("status",))
+
+
+def register_gauge(name: str, documentation: str, callback) -> Gauge:
+    return Gauge(name, documentation, callback)
+
+
+def render() -> str:
+    """Prometheus 文本格式（version 0.0.4）"""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type_name}")
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+# ---- 分阶段计时与采样追踪 ----
+
+_mode = contextvars.ContextVar("metrics_mode", default="none")
+_trace = contextvars.ContextVar("metrics_trace", default=None)
+_parent_span = contextvars.ContextVar("metrics_parent_span", default=None)
+_trace_file_lock = threading.Lock()
+
+
+class _Trace:
+    __slots__ = ("trace_id", "name", "events")
+
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.events = []
+
+
+def _trace_sample_rate() -> float:
+    return float(os.getenv("METRICS_TRACE_SAMPLE_RATE", 0))
+
+
+@contextmanager
+def span(stage: str, **attributes):
+    """
+    为一个阶段计时：耗时按 (stage, mode) 记入 medcoach_stage_duration_seconds；
+    当前请求被采样时，同时作为追踪中的一个 span 记录（嵌套关系由 contextvars 传递）
+    """
+    span_id = uuid.uuid4().hex[:16]
+    parent_token = _parent_span.set(span_id)
+    started_wall = time.time()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        _parent_span.reset(parent_token)
+        mode = _mode.get()
+        STAGE_SECONDS.observe(elapsed, stage=stage, mode=mode)
+        trace = _trace.get()
+        if trace is not None:
+            trace.events.append({
+                "name": stage, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                "ts": int(started_wall * 1_000_000), "dur": int(elapsed * 1_000_000),
+                "args": {"mode": mode, "span_id": span_id, "parent": _parent_span.get(), **attributes},
+            })
+
+
+@contextmanager
+def trace(name: str, mode: str | None = None, **attributes):
+    """
+    请求 / 对话轮次的根 span：设置本次请求的 mode 标签，并按采样率决定是否记录完整追踪
+
+    在线程池中执行的子任务需通过 contextvars.copy_context().run 提交，才能继承 mode 和追踪上下文。
+    """
+    mode_token = _mode.set(mode or "none")
+    sample_rate = _trace_sample_rate()
+    current = _Trace(name) if sample_rate and random.random() < sample_rate else None
+    trace_token = _trace.set(current)
+    try:
+        with span(name, **attributes):
+            yield
+    finally:
+        _trace.reset(trace_token)
+        _mode.reset(mode_token)
+        if current is not None:
+            _write_trace(current)
+
+
+def record_llm_call(stage: str, outcome: str, usage: dict | None = None):
+    LLM_CALLS.inc(stage=stage, outcome=outcome)
+    if usage:
+        LLM_TOKENS.inc(usage.get("inputTokens", 0), stage=stage, direction="input")
+        LLM_TOKENS.inc(usage.get("outputTokens", 0), stage=stage, direction="output")
+        # 提供方报告的前缀缓存用量（Bedrock prompt caching 等），命中的输入 token 计入 cache_read
+        for key, direction in (("cacheReadInputTokens", "cache_read"), ("cacheWriteInputTokens", "cache_write")):
+            if usage.get(key):
+                LLM_TOKENS.inc(usage[key], stage=stage, direction=direction)
+
+
+def _write_trace(current: _Trace):
+    path = os.getenv("METRICS_TRACE_PATH") or DEFAULT_TRACE_PATH
+    # 每行一个追踪，traceEvents 可直接导入 chrome://tracing / Perfetto
+    line = json.dumps({"trace_id": current.trace_id, "name": current.name, "traceEvents": current.events}, ensure_ascii=False)
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with _trace_file_lock, open(path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        print(f"Warning: failed to write trace {current.trace_id}: {str(e)}")
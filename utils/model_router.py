@@ -0,0 +1,140 @@
+# utils/model_router.py
+# 分层模型路由：每个调用点（教练评估、医生回复、总结、人设生成）映射到一个模型层级，
+# 每个层级有自己的模型、max_tokens、temperature 和超时。层级近期延迟超出 SLO 时暂时降级，
+# 调用改走列表中的下一个层级；调用超时或失败（且尚未向客户端输出）时同样立即改用下一个层级。
+#
+# 配置示例（未配置任何层级时，所有调用都使用默认模型，与之前的行为一致）：
+#   MODEL_TIERS=fast,large
+#   MODEL_TIER_FAST_MODEL_ID=Qwen/Qwen3-8B
+#   MODEL_TIER_FAST_MAX_TOKENS=400
+#   MODEL_TIER_FAST_TIMEOUT=15
+#   MODEL_TIER_FAST_SLO=4
+#   MODEL_TIER_LARGE_MODEL_ID=deepseek-ai/DeepSeek-R1
+#   MODEL_ROUTES=coach_eval=fast,doctor_reply=fast,summary=large,persona=large
+
+import os
+import threading
+import time
+from collections import deque
+
+from . import metrics
+
+DEFAULT_TIER = "default"
+
+DEFAULT_ROUTES = "coach_eval=fast,doctor_reply=fast,summary=large,persona=large"
+
+TIER_FALLBACKS = metrics.Counter(
+    "medcoach_model_tier_fallbacks_total", "Calls moved to the next model tier.", ("tier", "reason"),
+)
+
+
+class ModelTier:
+    """
+    一个模型层级
+
+    Args:
+        name (str): 层级名称
+        provider (str): 模型提供方（openai / bedrock / fake），决定使用哪个调度器限流
+        build: 无参函数，首次使用时构建模型客户端
+        slo (float): 延迟 SLO（秒），近期调用的 p95 超过该值时层级暂时降级，0 表示不检查
+        cooldown (float): 降级持续时间（秒），之后重新启用并清空延迟记录
+        window (int): 计算 p95 时使用的最近调用数
+        timeout (float): 层级的调用超时（秒），失败的调用按该时长计入延迟
+    """
+
+    __slots__ = ("name", "provider", "slo", "cooldown", "timeout", "_build", "_model", "_latencies", "_degraded_until", "_lock")
+
+    def __init__(self, name: str, provider: str, build, slo: float = 0, cooldown: float = 60, window: int = 20,
+                 timeout: float | None = None):
+        self.name = name
+        self.provider = provider
+        self.slo = slo
+        self.cooldown = cooldown
+        self.timeout = timeout
+        self._build = build
+        self._model = None
+        self._latencies = deque(maxlen=window)
+        self._degraded_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._build()
+        return self._model
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self._degraded_until
+
+    def record(self, seconds: float, failed: bool = False):
+        """
+        记录一次调用耗时，近期 p95 超出 SLO 时降级
+
+        失败的调用至少按超时时长计入（未配置超时时视为无穷大），快速失败的层级不会因耗时短而显得健康。
+        """
+        if not self.slo:
+            return
+        if failed:
+            seconds = max(seconds, self.timeout) if self.timeout else float("inf")
+        with self._lock:
+            self._latencies.append(seconds)
+            if len(self._latencies) < 5:
+                return
+            ordered = sorted(self._latencies)
+            p95 = ordered[min(int(0.95 * len(ordered)), len(ordered) - 1)]
+            if p95 > self.slo:
+                print(f"Warning: model tier {self.name} p95 {p95:.1f}s exceeds SLO {self.slo:g}s, degrading for {self.cooldown:g}s")
+                self._degraded_until = time.monotonic() + self.cooldown
+                self._latencies.clear()
+                TIER_FALLBACKS.inc(tier=self.name, reason="slo")
+
+
+class ModelRouter:
+    """
+    调用点 -> 模型层级链
+
+    Args:
+        agent: PharmaRepCoachAgent，提供默认模型（agent.model / agent.provider）和 build_model
+    """
+
+    def __init__(self, agent):
+        self.order = [name.strip().lower() for name in os.getenv("MODEL_TIERS", "").split(",") if name.strip()]
+        self.tiers = {DEFAULT_TIER: ModelTier(DEFAULT_TIER, agent.provider, lambda: agent.model)}
+        for name in self.order:
+            if name != DEFAULT_TIER:
+                self.tiers[name] = self._tier_from_env(agent, name)
+        if DEFAULT_TIER not in self.order:
+            self.order.append(DEFAULT_TIER)
+
+        self.routes = {}
+        for item in os.getenv("MODEL_ROUTES", DEFAULT_ROUTES).split(","):
+            stage, _, tier = item.partition("=")
+            if tier.strip().lower() in self.tiers:
+                self.routes[stage.strip()] = tier.strip().lower()
+
+    @staticmethod
+    def _tier_from_env(agent, name: str) -> ModelTier:
+        prefix = f"MODEL_TIER_{name.upper()}_"
+        provider = (os.getenv(prefix + "PROVIDER") or agent.provider).lower()
+        model_id = os.getenv(prefix + "MODEL_ID")
+        max_tokens = int(os.getenv(prefix + "MAX_TOKENS", 0)) or None
+        temperature = float(os.getenv(prefix + "TEMPERATURE")) if os.getenv(prefix + "TEMPERATURE") else None
+        timeout = float(os.getenv(prefix + "TIMEOUT", 0)) or None
+        return ModelTier(
+            name, provider,
+            lambda: agent.build_model(provider, model_id, max_tokens=max_tokens, temperature=temperature, timeout=timeout),
+            slo=float(os.getenv(prefix + "SLO", 0)),
+            cooldown=float(os.getenv(prefix + "COOLDOWN", 60)),
+            timeout=timeout,
+        )
+
+    def route(self, stage: str) -> list[ModelTier]:
+        """按优先顺序返回该调用点可用的层级：从路由到的层级开始，依次为 MODEL_TIERS 中其后的层级，最后是默认模型"""
+        start = self.order.index(self.routes.get(stage, DEFAULT_TIER))
+        chain = [self.tiers[name] for name in self.order[start:]]
+        healthy = [tier for tier in chain if tier.healthy]
+        # 全部降级时仍按原顺序尝试，而不是直接失败
+        return healthy or chain
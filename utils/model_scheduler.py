@@ -0,0 +1,216 @@
+# utils/model_scheduler.py
+# 模型调用准入控制：每个模型提供方一个调度器，限制同时进行的调用数和每分钟 token 数，
+# 按优先级排队（医生回复 > 教练评估 > 总结 > 后台人设生成），排队已满或等待超时时立即拒绝，
+# 被限流的调用按带抖动的指数退避重试，避免高峰期所有请求一起重试把提供方打满。
+# 每轮并发调用所用的线程池（BoundedExecutor）同样有界，积压超出上限时不再排队，直接以 ModelOverloadedError 失败。
+
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from . import metrics
+
+# 数值越小越优先
+STAGE_PRIORITIES = {
+    "doctor_reply": 0,
+    "coach_eval": 1,
+    "summary": 2,
+    "llm": 2,
+    "persona": 3,
+}
+
+THROTTLE_MARKERS = ("throttl", "rate limit", "ratelimit", "too many requests", "429")
+
+SCHEDULER_EVENTS = metrics.Counter(
+    "medcoach_model_scheduler_events_total", "Model scheduler admissions, rejections and retries.", ("provider", "event"),
+)
+
+
+class ModelOverloadedError(Exception):
+    """模型调用排队已满或排队超时，调用未发出"""
+
+
+def is_throttling_error(error: Exception) -> bool:
+    text = f"{type(error).__name__} {error}".lower()
+    return any(marker in text for marker in THROTTLE_MARKERS)
+
+
+def _env(name: str, provider: str, default):
+    """优先读取按提供方区分的配置（如 MODEL_MAX_CONCURRENCY_OPENAI），否则使用通用配置"""
+    return os.getenv(f"{name}_{provider.upper()}") or os.getenv(name) or default
+
+
+class ModelScheduler:
+    """
+    单个模型提供方的调用调度器
+
+    Args:
+        provider (str): 提供方名称，用于指标标签和按提供方读取配置
+        max_concurrency (int): 同时进行的调用数上限，默认读取 MODEL_MAX_CONCURRENCY
+        tokens_per_minute (int): 每分钟 token 预算（令牌桶），0 表示不限，默认读取 MODEL_TOKENS_PER_MINUTE
+        max_queue (int): 排队中的调用数上限，超出时立即抛出 ModelOverloadedError，默认读取 MODEL_MAX_QUEUE
+        queue_timeout (float): 最长排队时间（秒），默认读取 MODEL_QUEUE_TIMEOUT
+        max_retries (int): 被限流时的最大重试次数，默认读取 MODEL_MAX_RETRIES
+        base_backoff (float): 首次重试的退避上限（秒），之后按 2 的幂增长，实际等待时间在 [0, 上限] 内随机
+        max_backoff (float): 退避上限的最大值（秒）
+    """
+
+    def __init__(self, provider: str = "default", max_concurrency: int | None = None,
+                 tokens_per_minute: int | None = None, max_queue: int | None = None,
+                 queue_timeout: float | None = None, max_retries: int | None = None,
+                 base_backoff: float = 0.5, max_backoff: float = 8.0):
+        self.provider = provider
+        self.max_concurrency = max_concurrency or int(_env("MODEL_MAX_CONCURRENCY", provider, 8))
+        self.tokens_per_minute = tokens_per_minute if tokens_per_minute is not None else int(_env("MODEL_TOKENS_PER_MINUTE", provider, 0))
+        self.max_queue = max_queue or int(_env("MODEL_MAX_QUEUE", provider, 64))
+        self.queue_timeout = queue_timeout or float(_env("MODEL_QUEUE_TIMEOUT", provider, 30))
+        self.max_retries = max_retries if max_retries is not None else int(_env("MODEL_MAX_RETRIES", provider, 3))
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self._condition = threading.Condition()
+        self._waiting = []  # (priority, seq)
+        self._sequence = itertools.count()
+        self._active = 0
+        self._tokens = float(self.tokens_per_minute)
+        self._refilled_at = time.monotonic()
+
+    def run(self, call, stage: str = "llm", estimated_tokens: int = 0, can_retry=None):
+        """
+        排队获得执行许可后调用 call()，返回其结果
+
+        estimated_tokens 在准入时从令牌桶预扣；call 返回后可通过 settle() 按实际用量校正。
+        can_retry() 返回 False 时（如已向客户端推送了部分输出）不再重试。
+        """
+        priority = STAGE_PRIORITIES.get(stage, STAGE_PRIORITIES["llm"])
+        for attempt in itertools.count():
+            # 重试时重新排队准入；token 只在首次准入时预扣，被限流的调用没有消耗提供方的额度
+            self._acquire(priority, estimated_tokens if attempt == 0 else 0)
+            try:
+                return call()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_throttling_error(e) or (can_retry and not can_retry()):
+                    raise
+                SCHEDULER_EVENTS.inc(provider=self.provider, event="retry")
+            finally:
+                self._release()
+            # 退避期间不占用执行许可，排队中的高优先级调用（如医生回复）可以先执行
+            time.sleep(random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt)))
+
+    def _release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """按实际 token 用量校正预扣值（差额可为负，即欠额，从后续补充中扣除）"""
+        if not self.tokens_per_minute:
+            return
+        with self._condition:
+            self._tokens += estimated_tokens - actual_tokens
+            self._condition.notify_all()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+
+    def _refill(self, now: float):
+        if self.tokens_per_minute:
+            self._tokens = min(self.tokens_per_minute, self._tokens + (now - self._refilled_at) * self.tokens_per_minute / 60)
+        self._refilled_at = now
+
+    def _has_budget(self, estimated_tokens: int) -> bool:
+        if not self.tokens_per_minute:
+            return True
+        # 单次预估超过整个桶容量时，桶满即放行，避免永远无法准入
+        return self._tokens >= min(estimated_tokens, self.tokens_per_minute)
+
+    def _acquire(self, priority: int, estimated_tokens: int):
+        with self._condition:
+            if len(self._waiting) >= self.max_queue:
+                SCHEDULER_EVENTS.inc(provider=self.provider, event="rejected")
+                raise ModelOverloadedError("模型服务繁忙（排队已满），请稍后重试")
+
+            entry = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, entry)
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._waiting[0] == entry and self._active < self.max_concurrency and self._has_budget(estimated_tokens):
+                        break
+                    if now >= deadline:
+                        SCHEDULER_EVENTS.inc(provider=self.provider, event="timeout")
+                        raise ModelOverloadedError(f"模型服务繁忙（排队超过 {self.queue_timeout:g} 秒），请稍后重试")
+                    # 令牌桶不足时需要定时醒来检查补充量，其余情况等待其他调用结束的通知
+                    self._condition.wait(timeout=min(deadline - now, 0.1 if self.tokens_per_minute else deadline - now))
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                raise
+
+            heapq.heappop(self._waiting)
+            self._active += 1
+            if self.tokens_per_minute:
+                self._tokens -= estimated_tokens
+            SCHEDULER_EVENTS.inc(provider=self.provider, event="admitted")
+            # 队首变化后唤醒其他等待者，下一个调用可能同样可以立即准入
+            self._condition.notify_all()
+
+
+class BoundedExecutor(ThreadPoolExecutor):
+    """
+    带有界等待队列的线程池
+
+    ThreadPoolExecutor 的等待队列没有上限，积压的调用到不了 ModelScheduler，MODEL_MAX_QUEUE 和排队超时都无法生效。
+    已提交未完成的任务超过 max_workers + max_queue 时，submit 不再排队，直接返回以 ModelOverloadedError 失败的 future，
+    调用方照常在 result() 中处理错误。
+
+    Args:
+        max_workers (int): 线程数上限（线程按需创建）
+        max_queue (int): 所有线程都忙时最多排队的任务数
+    """
+
+    def __init__(self, max_workers: int, max_queue: int, thread_name_prefix: str = ""):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.max_queue = max_queue
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        if not self._slots.acquire(blocking=False):
+            SCHEDULER_EVENTS.inc(provider="executor", event="rejected")
+            future = Future()
+            future.set_exception(ModelOverloadedError("模型服务繁忙（排队已满），请稍后重试"))
+            return future
+        try:
+            future = super().submit(fn, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+_schedulers: dict[str, ModelScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(provider: str) -> ModelScheduler:
+    """每个提供方一个进程内共享的调度器"""
+    with _schedulers_lock:
+        scheduler = _schedulers.get(provider)
+        if scheduler is None:
+            scheduler = _schedulers[provider] = ModelScheduler(provider)
+        return scheduler
+
+
+metrics.register_gauge(
+    "medcoach_model_queue_depth", "Model calls waiting for admission across providers.",
+    lambda: sum(scheduler.queue_depth for scheduler in list(_schedulers.values())),
+)
@@ -0,0 +1,160 @@
+# utils/objection_kb.py
+# 异议知识库：按药品和话题组织的常见异议及合规应对要点。数据文件只在进程内加载一次，编译成倒排索引，
+# 支持按 (药品, 话题) 直接查找，以及针对代表发言的 BM25 关键词检索（中文按字符二元组切分），单次检索远低于 1 毫秒，
+# 供 objection_tool 和医生回复的 prompt 使用，不需要额外的模型调用。
+
+import json
+import math
+import os
+import re
+from functools import lru_cache
+
+DEFAULT_KB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "objections.json")
+
+# 适用于所有药品的通用异议
+GENERIC_DRUG = ""
+
+_WORD_PATTERN = re.compile(r"[a-z0-9]+|[一-鿿]+")
+
+
+def tokenize(text: str) -> list[str]:
+    """英文和数字按单词切分；中文没有分词器，按相邻字符二元组切分（单字片段保留单字）"""
+    tokens = []
+    for run in _WORD_PATTERN.findall(text.lower()):
+        if run.isascii() or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class ObjectionKnowledgeBase:
+    """
+    异议知识库的倒排索引
+
+    Args:
+        entries (list[dict]): 每条包含 drug（空字符串表示通用）、topic、objection、hint，可选 keywords
+        drug_aliases (dict[str, list[str]]): 药品规范名 -> 别名（中文名、商品名），查询时统一换算成规范名
+        k1 (float), b (float): BM25 参数
+    """
+
+    def __init__(self, entries: list[dict], drug_aliases: dict[str, list[str]] | None = None,
+                 k1: float = 1.2, b: float = 0.75):
+        self.entries = [
+            {
+                "drug": entry.get("drug", GENERIC_DRUG).strip().lower(),
+                "topic": entry["topic"],
+                "objection": entry["objection"],
+                "hint": entry["hint"],
+            }
+            for entry in entries
+        ]
+        self._aliases = {}
+        for drug, aliases in (drug_aliases or {}).items():
+            for name in (drug, *aliases):
+                self._aliases[name.strip().lower()] = drug.strip().lower()
+
+        # (药品, 话题) -> 条目编号；token -> [(条目编号, 词频)]
+        self._by_key: dict[tuple[str, str], list[int]] = {}
+        postings: dict[str, dict[int, int]] = {}
+        lengths = []
+        for doc_id, (entry, source) in enumerate(zip(self.entries, entries)):
+            self._by_key.setdefault((entry["drug"], entry["topic"]), []).append(doc_id)
+            tokens = tokenize(" ".join((entry["objection"], entry["hint"], *source.get("keywords", ()))))
+            lengths.append(len(tokens))
+            for token in tokens:
+                counts = postings.setdefault(token, {})
+                counts[doc_id] = counts.get(doc_id, 0) + 1
+
+        # 预先算好每个 (token, 条目) 的 BM25 权重，检索时只需累加
+        count = len(self.entries)
+        average_length = sum(lengths) / count if count else 0
+        self._postings: dict[str, tuple[tuple[int, float], ...]] = {}
+        for token, counts in postings.items():
+            idf = math.log(1 + (count - len(counts) + 0.5) / (len(counts) + 0.5))
+            self._postings[token] = tuple(
+                (doc_id, idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[doc_id] / average_length)))
+                for doc_id, tf in counts.items()
+            )
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def canonical_drug(self, drug: str | None) -> str:
+        drug = (drug or "").strip().lower()
+        return self._aliases.get(drug, drug)
+
+    def lookup(self, drug: str, topic: str, k: int | None = None) -> list[dict]:
+        """按 (药品, 话题) 查找，药品专属的异议在前，通用异议在后"""
+        drug = self.canonical_drug(drug)
+        doc_ids = self._by_key.get((drug, topic), []) + (self._by_key.get((GENERIC_DRUG, topic), []) if drug else [])
+        return [self.entries[doc_id] for doc_id in doc_ids[:k]]
+
+    def search(self, query: str, drug: str | None = None, topic: str | None = None, k: int = 3) -> list[dict]:
+        """
+        对 query（通常是代表的发言）做 BM25 检索，返回最相关的 k 条
+
+        指定 drug 时只返回该药品专属和通用的异议，得分相同时药品专属的在前；指定 topic 时只返回该话题。
+        """
+        drug = self.canonical_drug(drug) if drug is not None else None
+        scores: dict[int, float] = {}
+        for token in set(tokenize(query)):
+            for doc_id, weight in self._postings.get(token, ()):
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight
+
+        ranked = []
+        for doc_id, score in scores.items():
+            entry = self.entries[doc_id]
+            if drug is not None and entry["drug"] not in (drug, GENERIC_DRUG):
+                continue
+            if topic is not None and entry["topic"] != topic:
+                continue
+            ranked.append((-score, entry["drug"] == GENERIC_DRUG, doc_id))
+        ranked.sort()
+        return [{**self.entries[doc_id], "score": round(-score, 3)} for score, _, doc_id in ranked[:k]]
+
+
+def load_knowledge_base(path: str | None = None) -> ObjectionKnowledgeBase:
+    """从 JSON 文件加载并编译知识库，路径默认读取 OBJECTION_KB_PATH"""
+    path = path or os.getenv("OBJECTION_KB_PATH") or DEFAULT_KB_PATH
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return ObjectionKnowledgeBase(data.get("objections", []), data.get("drugs"))
+
+
+@lru_cache(maxsize=None)
+def get_knowledge_base(path: str | None = None) -> ObjectionKnowledgeBase:
+    """返回进程内共享的知识库（每个数据文件只加载和编译一次）"""
+    return load_knowledge_base(path)
+
+
+def format_objections(entries: list[dict]) -> str:
+    """格式化为“异议 / 应对要点”列表文本"""
+    lines = []
+    for i, item in enumerate(entries, 1):
+        lines.append(f"{i}. 异议：{item['objection']}")
+        lines.append(f"   应对要点：{item['hint']}\n")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # 检索调试与计时：python -m utils.objection_kb "这个药副作用大吗" --drug 司美格鲁肽
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="在异议知识库中检索与发言最相关的异议")
+    parser.add_argument("query")
+    parser.add_argument("--drug")
+    parser.add_argument("--topic")
+    parser.add_argument("-k", type=int, default=3)
+    parser.add_argument("--path")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    kb = get_knowledge_base(args.path)
+    loaded = time.perf_counter()
+    results = kb.search(args.query, drug=args.drug, topic=args.topic, k=args.k)
+    searched = time.perf_counter()
+    print(f"INFO: loaded {len(kb)} objections in {(loaded - started) * 1000:.1f} ms, search took {(searched - loaded) * 1000:.3f} ms.")
+    for item in results:
+        print(f"[{item['score']}] ({item['drug'] or '*'}/{item['topic']}) {item['objection']} -> {item['hint']}")
@@ -0,0 +1,215 @@
+# utils/persona_store.py
+# 医生人设 / 场景库：按 (药品, 科室, 难度, 语言) 缓存人设，磁盘持久化 + 进程内 LRU。
+# 开始训练时直接命中缓存或使用模板人设（毫秒级），更丰富的 LLM 人设在后台生成，供后续会话使用。
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_STORE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "personas")
+
+LEVELS = ("basic", "intermediate", "advanced")
+
+# 内置人设，不区分难度
+SEED_PERSONAS = {
+    ("semaglutide", "endocrinology", "zh"): {
+        "name": "李伟", "specialty": "内分泌科",
+        "opening_line": "“你好，我是李伟主任，最近门诊里肥胖合并 2 型糖尿病的患者越来越多。你们司美格鲁肽有哪些新版数据？”",
+        "characteristics": "男·45 岁·主任医师·周处方量≈25 支"
+    },
+}
+
+LEVEL_CHARACTERISTICS = {
+    "basic": "经验丰富，关注药物的实际临床价值。",
+    "intermediate": "临床经验丰富，会追问循证数据和不良反应管理细节。",
+    "advanced": "学术带头人，熟悉最新指南和竞品数据，习惯提出尖锐的异议。",
+}
+
+START_MESSAGE_PATTERNS = {
+    "drug": re.compile(r"药品\s*[:：]\s*([^；;。,，]+)"),
+    "specialty": re.compile(r"科室\s*[:：]\s*([^；;。,，]+)"),
+    "level": re.compile(r"难度\s*[:：]\s*([^；;。,，]+)"),
+}
+
+
+def parse_start_message(message: str) -> dict:
+    """从开始训练的消息（如 "药品: Semaglutide；科室: Endocrinology；难度: Basic。点击【Start】"）中提取参数"""
+    params = {}
+    for field, pattern in START_MESSAGE_PATTERNS.items():
+        match = pattern.search(message)
+        if match:
+            params[field] = match.group(1).strip()
+    level = params.get("level", "basic").lower()
+    params["level"] = level if level in LEVELS else "basic"
+    return params
+
+
+def template_persona(drug: str, specialty: str, level: str = "basic", lang: str = "zh") -> dict:
+    """无需模型调用的模板人设"""
+    if lang == "zh":
+        return {
+            "name": "王医生", "specialty": specialty or "相关科室",
+            "opening_line": f"“你好，关于{drug or '你提到的药品'}，请详细介绍一下数据和证据。”",
+            "characteristics": LEVEL_CHARACTERISTICS.get(level, LEVEL_CHARACTERISTICS["basic"]),
+        }
+    return {
+        "name": "Dr. Wang", "specialty": specialty or "General",
+        "opening_line": f"\"Hello, please walk me through the data and evidence for {drug or 'this drug'}.\"",
+        "characteristics": f"A {level}-level doctor focused on real-world clinical value.",
+    }
+
+
+class PersonaStore:
+    """
+    人设缓存
+
+    查找顺序：内存 LRU -> 磁盘（每个 key 一个 JSON 文件，按需加载）-> 内置/模板人设。
+    配置了 generator 时，缺失或过期的人设会在后台调用 generator 重新生成并写回磁盘，当前请求不等待。
+
+    Args:
+        directory (str): 人设文件目录，默认读取 PERSONA_STORE_DIR
+        cache_size (int): 内存 LRU 容量，默认读取 PERSONA_CACHE_SIZE
+        generator: generator(drug, specialty, level, lang) -> dict，用于生成更丰富的人设（通常是 LLM 调用）
+        refresh_after (float): 人设生成后超过该秒数即在后台刷新，0 表示不刷新，默认读取 PERSONA_REFRESH_AFTER
+    """
+
+    def __init__(self, directory: str | None = None, cache_size: int | None = None, generator=None,
+                 refresh_after: float | None = None):
+        self.directory = directory or os.getenv("PERSONA_STORE_DIR") or DEFAULT_STORE_DIR
+        self.cache_size = cache_size or int(os.getenv("PERSONA_CACHE_SIZE", 1024))
+        self.generator = generator
+        self.refresh_after = refresh_after if refresh_after is not None else float(os.getenv("PERSONA_REFRESH_AFTER", 0))
+        self._cache: OrderedDict[tuple, dict] = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="persona-refresh")
+
+    @staticmethod
+    def make_key(drug: str, specialty: str, level: str = "basic", lang: str = "zh") -> tuple:
+        return (drug.strip().lower(), specialty.strip().lower(), level.lower(), lang)
+
+    def get(self, drug: str, specialty: str, level: str = "basic", lang: str = "zh") -> dict:
+        key = self.make_key(drug, specialty, level, lang)
+        record = self._get_cached(key)
+        if record is None:
+            record = self._load(key) or self._fallback(drug, specialty, level, lang)
+            self._put_cached(key, record)
+
+        if self.generator and self._needs_refresh(record):
+            self._schedule_refresh(key, (drug, specialty, level, lang))
+        return dict(record["persona"])
+
+    def put(self, drug: str, specialty: str, level: str, lang: str, persona: dict):
+        key = self.make_key(drug, specialty, level, lang)
+        record = {"persona": persona, "source": "generated", "generated_at": time.time()}
+        self._save(key, record)
+        self._put_cached(key, record)
+
+    def pregenerate(self, combos, workers: int = 4) -> int:
+        """批量生成并持久化人设，combos 为 (drug, specialty, level, lang) 列表，返回成功数量"""
+        if not self.generator:
+            raise ValueError("PersonaStore.pregenerate 需要配置 generator")
+
+        def generate(combo):
+            try:
+                self.put(*combo, self.generator(*combo))
+                return True
+            except Exception as e:
+                print(f"Warning: failed to generate persona for {combo}: {str(e)}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return sum(pool.map(generate, combos))
+
+    def _fallback(self, drug: str, specialty: str, level: str, lang: str) -> dict:
+        seed = SEED_PERSONAS.get((drug.strip().lower(), specialty.strip().lower(), lang))
+        if seed:
+            return {"persona": dict(seed), "source": "seed", "generated_at": None}
+        return {"persona": template_persona(drug, specialty, level, lang), "source": "template", "generated_at": None}
+
+    def _needs_refresh(self, record: dict) -> bool:
+        # 内置人设不会被覆盖；模板人设尽快替换为生成的人设；生成的人设按 refresh_after 定期刷新
+        if record["source"] == "template":
+            return True
+        if record["source"] == "generated":
+            return bool(self.refresh_after) and time.time() - record["generated_at"] > self.refresh_after
+        return False
+
+    def _schedule_refresh(self, key: tuple, params: tuple):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self.put(*params, self.generator(*params))
+            except Exception as e:
+                print(f"Warning: background persona refresh failed for {key}: {str(e)}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._executor.submit(refresh)
+
+    def _get_cached(self, key: tuple) -> dict | None:
+        with self._lock:
+            record = self._cache.get(key)
+            if record is not None:
+                self._cache.move_to_end(key)
+            return record
+
+    def _put_cached(self, key: tuple, record: dict):
+        with self._lock:
+            self._cache[key] = record
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _path(self, key: tuple) -> str:
+        digest = hashlib.sha1(json.dumps(key, ensure_ascii=False).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def _load(self, key: tuple) -> dict | None:
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Warning: failed to load persona for {key}: {str(e)}")
+            return None
+
+    def _save(self, key: tuple, record: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"key": list(key), **record}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    # 批量预生成人设：python -m utils.persona_store --drugs Semaglutide,Tirzepatide --specialties Endocrinology,Cardiology
+    import argparse
+    from itertools import product
+
+    from .agent import PharmaRepCoachAgent
+
+    parser = argparse.ArgumentParser(description="批量预生成医生人设")
+    parser.add_argument("--drugs", required=True, help="逗号分隔的药品名称")
+    parser.add_argument("--specialties", required=True, help="逗号分隔的科室")
+    parser.add_argument("--levels", default=",".join(LEVELS))
+    parser.add_argument("--langs", default="zh")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    split = lambda value: [item.strip() for item in value.split(",") if item.strip()]
+    combos = list(product(split(args.drugs), split(args.specialties), split(args.levels), split(args.langs)))
+    store = PersonaStore(generator=PharmaRepCoachAgent().generate_persona)
+    print(f"INFO: Generated {store.pregenerate(combos, workers=args.workers)}/{len(combos)} personas into {store.directory}.")
@@ -0,0 +1,143 @@
+# utils/prompts.py
+# 面向前缀缓存的 prompt 组装：静态说明和医生人设放在前面（system prompt + 用户消息开头的固定指令），
+# 每轮变化的内容（对话历史、代表发言、参考异议）放在最后，使 Bedrock prompt caching、vLLM / SGLang 前缀缓存能够命中。
+# 对话历史按 token 预算从最新往前保留；token 数由带缓存的分词器计算（同一条发言在多轮中只计算一次）。
+
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from . import metrics
+
+PROMPT_PREFIX_LOOKUPS = metrics.Counter(
+    "medcoach_prompt_prefix_lookups_total",
+    "Prompts whose stable prefix was sent recently (likely provider prefix-cache hit) by stage.", ("stage", "result"),
+)
+PROMPT_HISTORY_TRIMMED = metrics.Counter(
+    "medcoach_prompt_history_trimmed_total", "Dialogue lines dropped to fit the prompt token budget.", ("stage",),
+)
+
+_CJK_PATTERN = re.compile(r"[　-〿㐀-䶿一-鿿＀-￯]")
+
+
+@lru_cache(maxsize=None)
+def _load_encoder():
+    """PROMPT_TOKENIZER 指定 tiktoken 编码（如 cl100k_base）时使用真实分词器，否则使用估算"""
+    name = os.getenv("PROMPT_TOKENIZER")
+    if not name:
+        return None
+    try:
+        import tiktoken
+    except ImportError:
+        print(f"Warning: PROMPT_TOKENIZER={name} requires tiktoken, falling back to estimated token counts")
+        return None
+    return tiktoken.get_encoding(name).encode
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """
+    文本的 token 数（带缓存）
+
+    未配置分词器时按经验估算：中文等全角字符每字约 1 个 token，其余字符约 4 个 1 个 token。
+    """
+    encode = _load_encoder()
+    if encode is not None:
+        return len(encode(text))
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class _PrefixTracker:
+    """
+    记录最近发送过的稳定前缀，用于估算提供方前缀缓存的命中率
+
+    前缀在 ttl 秒内再次出现计为命中（Bedrock prompt caching 的缓存约 5 分钟过期，vLLM / SGLang 按 LRU 淘汰）。
+    """
+
+    def __init__(self, max_entries: int = 4096, ttl: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._seen: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, prefix: str) -> bool:
+        key = hashlib.sha1(prefix.encode("utf-8")).hexdigest()
+        now = time.monotonic()
+        with self._lock:
+            last_seen = self._seen.pop(key, None)
+            self._seen[key] = now
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+        hit = last_seen is not None and now - last_seen <= self.ttl
+        PROMPT_PREFIX_LOOKUPS.inc(stage=stage, result="hit" if hit else "miss")
+        return hit
+
+
+prefix_tracker = _PrefixTracker(ttl=float(os.getenv("PROMPT_PREFIX_CACHE_TTL", 300)))
+
+
+class PromptBuilder:
+    """
+    按“固定指令 → 每轮内容 → 对话历史”的顺序组装用户消息
+
+    Args:
+        stage (str): 调用点（coach_eval、doctor_reply、summary 等），用于指标标签
+        budget (int): 整个请求（system prompt + 用户消息）的 token 预算，默认读取 PROMPT_TOKEN_BUDGET；
+            超出时从最旧的对话历史开始删减，固定指令和每轮内容不会被删减
+    """
+
+    def __init__(self, stage: str, budget: int | None = None):
+        self.stage = stage
+        self.budget = budget or int(os.getenv("PROMPT_TOKEN_BUDGET", 3000))
+        self._instructions = []
+        self._sections = []  # (标题, 文本)
+        self._history = None  # (标题, 按时间顺序的行)
+
+    def instruction(self, text: str) -> "PromptBuilder":
+        """固定指令：不含任何每轮变化的内容，位于用户消息开头，与 system prompt 一起构成可缓存的前缀"""
+        self._instructions.append(text)
+        return self
+
+    def section(self, title: str, text: str) -> "PromptBuilder":
+        """每轮变化的内容，按添加顺序排在固定指令之后"""
+        if text:
+            self._sections.append((title, text))
+        return self
+
+    def history(self, title: str, lines: list[str]) -> "PromptBuilder":
+        """对话历史（按时间顺序），放在最后，超出预算时从最旧的行开始删减"""
+        self._history = (title, list(lines))
+        return self
+
+    def build(self, system_prompt: str = "") -> str:
+        prefix = "\n".join(self._instructions)
+        prefix_tracker.record(self.stage, f"{system_prompt}\n{prefix}")
+
+        blocks = [prefix] if prefix else []
+        blocks.extend(f"{title}：\n{text}" for title, text in self._sections)
+        if self._history is not None:
+            title, lines = self._history
+            used = count_tokens(system_prompt) + sum(count_tokens(block) for block in blocks) + count_tokens(title)
+            kept = self._fit(lines, self.budget - used)
+            if len(kept) < len(lines):
+                PROMPT_HISTORY_TRIMMED.inc(len(lines) - len(kept), stage=self.stage)
+            if kept:
+                blocks.append(f"{title}：\n" + "\n".join(kept))
+        return "\n\n".join(blocks)
+
+    @staticmethod
+    def _fit(lines: list[str], budget: int) -> list[str]:
+        """从最新的一行往前保留，直到用完预算"""
+        kept = []
+        for line in reversed(lines):
+            budget -= count_tokens(line) + 1
+            if budget < 0:
+                break
+            kept.append(line)
+        kept.reverse()
+        return kept
@@ -0,0 +1,169 @@
+# utils/session.py
+# 每个学员一份轻量会话状态，由 SessionManager 统一管理（LRU + 空闲 TTL 淘汰）
+# 配置了会话存储后端（utils/session_store.py）时，内存中的会话只是缓存：首次访问时从后端加载，
+# 每轮对话追加写入后端，请求结束时保存模式/人设/累计评估，多个 worker 进程可共享同一会话。
+
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from .conversation import ConversationLog, Turn
+from .session_store import SessionConflictError, SessionStore
+from .summary import RollingEvaluation
+
+# 客户端传入的 session_id 的合法格式（也用作溢出日志的文件名和存储后端的 key）
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,128}")
+
+
+class SessionState:
+    """单个训练会话的状态。不持有任何模型客户端，模型由 PharmaRepCoachAgent 在所有会话间共享。"""
+
+    __slots__ = ("session_id", "current_mode", "doctor_persona", "conversation_log", "rolling_evaluation", "last_access", "lock", "version")
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.current_mode = "waiting_for_start"  # waiting_for_start, doctor_interaction, final_summary
+        self.doctor_persona = None  # 存储医生角色信息 (name, opening_line, characteristics)
+        self.conversation_log = self.new_conversation_log(session_id)  # 存储对话历史（Turn 记录）
+        self.rolling_evaluation = RollingEvaluation()  # 逐轮更新的累计评估，供结束训练时生成总结
+        self.last_access = time.monotonic()
+        self.lock = threading.Lock()  # 同一会话的请求串行处理，不同会话互不阻塞
+        self.version = 0  # 与会话存储后端中的版本号一致时，说明内存中的状态是最新的
+
+    @staticmethod
+    def new_conversation_log(session_id: str) -> ConversationLog:
+        # 配置了 SESSION_LOG_SPILL_DIR 时，超出内存窗口的旧记录写入 <目录>/<session_id>.jsonl
+        # 不符合 SESSION_ID_PATTERN 的 id 改用其哈希作为文件名，文件始终位于该目录内
+        spill_dir = os.getenv("SESSION_LOG_SPILL_DIR")
+        if not spill_dir:
+            return ConversationLog()
+        name = session_id if SESSION_ID_PATTERN.fullmatch(session_id) else hashlib.sha256(session_id.encode("utf-8")).hexdigest()
+        return ConversationLog(spill_path=os.path.join(spill_dir, f"{name}.jsonl"))
+
+    def touch(self):
+        self.last_access = time.monotonic()
+
+
+class SessionManager:
+    """
+    按 session_id 管理训练会话
+
+    Args:
+        max_sessions (int): 最多保留的会话数，超出时淘汰最久未访问的会话。默认读取 SESSION_MAX_COUNT。
+        idle_ttl (float): 会话空闲超时（秒），超时会话在下次访问管理器时被清理。默认读取 SESSION_IDLE_TTL。
+        store (SessionStore): 会话持久化后端；为空时会话只保存在本进程内存中，淘汰即丢失
+    """
+
+    def __init__(self, max_sessions: int | None = None, idle_ttl: float | None = None, store: SessionStore | None = None):
+        self.max_sessions = max_sessions or int(os.getenv("SESSION_MAX_COUNT", 5000))
+        self.idle_ttl = idle_ttl or float(os.getenv("SESSION_IDLE_TTL", 3600))
+        self.store = store
+        self._sessions: OrderedDict[str, SessionState] = OrderedDict()  # 按最近访问时间排序，最旧的在前
+        self._lock = threading.Lock()
+
+    def get_or_create(self, session_id: str | None = None) -> SessionState:
+        """返回已有会话；session_id 为空或已被淘汰（且后端中也不存在）时创建新会话"""
+        with self._lock:
+            self._evict_expired_locked()
+            session = self._sessions.get(session_id) if session_id else None
+        # 读取存储后端（一次磁盘 / 网络往返）时不持有管理器锁，避免一个会话的慢查询阻塞所有会话的请求
+        if session is not None and self.store is not None and self.store.get_version(session_id) not in (None, session.version):
+            with self._lock:
+                if self._sessions.get(session_id) is session:
+                    self._discard(self._sessions.pop(session_id))  # 其他进程已更新该会话，丢弃本地缓存重新加载
+            session = None
+        loaded = self._load(session_id) if session is None and session_id and self.store is not None else None
+        with self._lock:
+            # 加载期间其他线程可能已放入同一会话，以缓存中的为准，保证同一 session_id 只有一个 SessionState
+            cached = self._sessions.get(session_id) if session_id else None
+            session = cached or session or loaded or self._attach(SessionState(session_id or uuid.uuid4().hex))
+            if cached is None:
+                self._sessions[session.session_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    self._discard(self._sessions.popitem(last=False)[1])
+            else:
+                self._sessions.move_to_end(session.session_id)
+            session.touch()
+            return session
+
+    def get(self, session_id: str) -> SessionState | None:
+        with self._lock:
+            self._evict_expired_locked()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                session.touch()
+            return session
+
+    def save(self, session: SessionState):
+        """请求处理结束时调用（持有 session.lock），把模式、人设和累计评估写入后端；对话记录已按轮写入"""
+        if self.store is None:
+            return
+        try:
+            session.version = self.store.save_state(
+                session.session_id, session.version, session.current_mode, session.doctor_persona,
+                session.rolling_evaluation.to_dict(),
+            )
+        except SessionConflictError as e:
+            # 其他进程已先行更新该会话：保留对方写入的状态，丢弃本地缓存，下次请求重新加载
+            print(f"Warning: {e}, reloading on next request")
+            with self._lock:
+                if self._sessions.get(session.session_id) is session:
+                    self._discard(self._sessions.pop(session.session_id))
+
+    def remove(self, session_id: str):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._discard(session)
+        if self.store is not None:
+            self.store.delete(session_id)
+
+    def _load(self, session_id: str) -> SessionState | None:
+        snapshot = self.store.load(session_id, int(os.getenv("SESSION_LOG_MAX_TURNS", 200)))
+        if snapshot is None:
+            return None
+        session = SessionState(session_id)
+        session.version = snapshot["version"]
+        session.current_mode = snapshot["current_mode"]
+        session.doctor_persona = snapshot["doctor_persona"]
+        if snapshot["rolling_evaluation"]:
+            session.rolling_evaluation = RollingEvaluation.from_dict(snapshot["rolling_evaluation"])
+        for turn in map(Turn.from_dict, snapshot["turns"]):
+            session.conversation_log.add(turn.speaker, turn.text, name=turn.name)
+        return self._attach(session)
+
+    def _attach(self, session: SessionState) -> SessionState:
+        # 在加载完已有记录之后再挂上写入回调，避免把加载的记录重复写回后端
+        if self.store is not None:
+            store, session_id = self.store, session.session_id
+            session.conversation_log.on_add = lambda turn: store.append_turn(session_id, turn)
+        return session
+
+    def evict_expired(self) -> int:
+        with self._lock:
+            return self._evict_expired_locked()
+
+    def _evict_expired_locked(self) -> int:
+        # 字典按访问顺序排列，只需从头部开始清理，遇到未过期的会话即可停止
+        deadline = time.monotonic() - self.idle_ttl
+        evicted = 0
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if oldest.last_access > deadline:
+                break
+            self._discard(self._sessions.pop(oldest_id))
+            evicted += 1
+        return evicted
+
+    @staticmethod
+    def _discard(session: SessionState):
+        # 淘汰的会话不会再访问其溢出日志（配置了存储后端时重新加载会从后端读取），删除文件避免在磁盘上堆积
+        session.conversation_log.discard_spill()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
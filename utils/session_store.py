@@ -0,0 +1,306 @@
+# utils/session_store.py
+# 可插拔的会话持久化后端，使多个 worker 进程 / 多台机器共享训练状态，重启后也能继续训练。
+# 对话记录按轮追加写入（不重写整段记录），会话在首次访问时才从后端加载。
+# 同一后端还保存转录作业的状态快照，GET /transcribe/<job_id> 落到未受理上传的 worker 时也能查到结果。
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from .conversation import Turn
+
+
+class SessionConflictError(Exception):
+    """保存会话状态时后端中的版本号与预期不一致（其他进程已先行更新），本次状态未写入"""
+
+
+class SessionStore(ABC):
+    """
+    会话持久化接口
+
+    load 返回的快照格式：
+        {"version": int, "current_mode": str, "doctor_persona": dict | None,
+         "rolling_evaluation": dict | None, "turns": [Turn.to_dict(), ...]（最近 max_turns 条，按时间顺序）}
+    """
+
+    @abstractmethod
+    def load(self, session_id: str, max_turns: int) -> dict | None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_version(self, session_id: str) -> int | None:
+        """返回会话当前版本号，会话不存在时返回 None。用于判断本进程缓存的会话是否已被其他进程更新"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def append_turn(self, session_id: str, turn: Turn):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_state(self, session_id: str, expected_version: int, current_mode: str, doctor_persona: dict | None,
+                   rolling_evaluation: dict) -> int:
+        """
+        仅当后端中的版本号等于 expected_version（新会话为 0）时保存会话的小体积状态字段并递增版本号，返回新版本号；
+        版本号不一致时抛出 SessionConflictError，不覆盖其他进程写入的状态
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_job(self, job_id: str, state: dict, ttl: float):
+        """保存转录作业的状态快照（TranscriptionJob.to_dict()），ttl 秒后过期"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_job(self, job_id: str) -> dict | None:
+        raise NotImplementedError
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    单机多进程共享的 SQLite（WAL 模式）实现
+
+    Args:
+        path (str): 数据库文件路径
+        ttl (float): 超过该秒数未更新的会话在启动时及之后写入时（每 purge_interval 秒至多一次）清理，0 表示不清理
+        purge_interval (float): 两次清理过期会话的最小间隔（秒）
+    """
+
+    def __init__(self, path: str, ttl: float = 0, purge_interval: float = 600):
+        self.path = path
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._next_purge = 0.0
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        db = self._connection()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "  session_id TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0, current_mode TEXT NOT NULL,"
+            "  doctor_persona TEXT, rolling_evaluation TEXT, updated_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS turns ("
+            "  id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL,"
+            "  speaker INTEGER NOT NULL, name TEXT, text TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, id);"
+            "CREATE TABLE IF NOT EXISTS transcription_jobs ("
+            "  job_id TEXT PRIMARY KEY, state TEXT NOT NULL, expires_at REAL NOT NULL);"
+        )
+        db.execute("DELETE FROM transcription_jobs WHERE expires_at < ?", (time.time(),))
+        self._purge_expired(db)
+        db.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 连接不能跨线程共享，每个线程各持一个
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _purge_expired(self, db: sqlite3.Connection):
+        # 长时间运行的进程也要清理过期会话，否则数据库只增不减；按间隔限流，避免每次写入都扫描全表
+        now = time.monotonic()
+        if not self.ttl or now < self._next_purge:
+            return
+        self._next_purge = now + self.purge_interval
+        cutoff = time.time() - self.ttl
+        db.execute("DELETE FROM turns WHERE session_id IN (SELECT session_id FROM sessions WHERE updated_at < ?)", (cutoff,))
+        db.execute("DELETE FROM sessions WHERE updated_at < ?", (cutoff,))
+
+    def load(self, session_id: str, max_turns: int) -> dict | None:
+        db = self._connection()
+        row = db.execute(
+            "SELECT version, current_mode, doctor_persona, rolling_evaluation FROM sessions WHERE session_id = ?",
+            (session_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        turns = db.execute(
+            "SELECT speaker, name, text FROM turns WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+            (session_id, max_turns),
+        ).fetchall()
+        return {
+            "version": row[0],
+            "current_mode": row[1],
+            "doctor_persona": json.loads(row[2]) if row[2] else None,
+            "rolling_evaluation": json.loads(row[3]) if row[3] else None,
+            "turns": [{"speaker": speaker, "name": name, "text": text} for speaker, name, text in reversed(turns)],
+        }
+
+    def get_version(self, session_id: str) -> int | None:
+        row = self._connection().execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def append_turn(self, session_id: str, turn: Turn):
+        db = self._connection()
+        db.execute(
+            "INSERT INTO turns (session_id, speaker, name, text) VALUES (?, ?, ?, ?)",
+            (session_id, int(turn.speaker), turn.name, turn.text),
+        )
+        self._purge_expired(db)
+        db.commit()
+
+    def save_state(self, session_id: str, expected_version: int, current_mode: str, doctor_persona: dict | None,
+                   rolling_evaluation: dict) -> int:
+        db = self._connection()
+        fields = (current_mode, json.dumps(doctor_persona, ensure_ascii=False) if doctor_persona else None,
+                  json.dumps(rolling_evaluation, ensure_ascii=False), time.time())
+        if expected_version:
+            cursor = db.execute(
+                "UPDATE sessions SET version = version + 1, current_mode = ?, doctor_persona = ?, rolling_evaluation = ?,"
+                " updated_at = ? WHERE session_id = ? AND version = ?",
+                (*fields, session_id, expected_version),
+            )
+        else:
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO sessions (session_id, version, current_mode, doctor_persona, rolling_evaluation, updated_at)"
+                " VALUES (?, 1, ?, ?, ?, ?)",
+                (session_id, *fields),
+            )
+        if cursor.rowcount != 1:
+            db.rollback()
+            raise SessionConflictError(f"session {session_id} was updated by another writer (expected version {expected_version})")
+        self._purge_expired(db)
+        db.commit()
+        return expected_version + 1
+
+    def delete(self, session_id: str):
+        db = self._connection()
+        db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+        db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        db.commit()
+
+    def save_job(self, job_id: str, state: dict, ttl: float):
+        db = self._connection()
+        now = time.time()
+        db.execute(
+            "INSERT OR REPLACE INTO transcription_jobs (job_id, state, expires_at) VALUES (?, ?, ?)",
+            (job_id, json.dumps(state, ensure_ascii=False), now + ttl),
+        )
+        db.execute("DELETE FROM transcription_jobs WHERE expires_at < ?", (now,))
+        db.commit()
+
+    def load_job(self, job_id: str) -> dict | None:
+        row = self._connection().execute(
+            "SELECT state FROM transcription_jobs WHERE job_id = ? AND expires_at >= ?", (job_id, time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Redis 协议实现，可用于 Redis / Valkey / KeyDB 等兼容服务（本地也可用 fakeredis 之类的替身）
+
+    每个会话两个 key：<prefix><id>:state（hash，状态字段和版本号）和 <prefix><id>:turns（list，按轮 RPUSH）。
+
+    Args:
+        client: redis-py 兼容的客户端实例
+        ttl (float): 会话 key 的过期时间（秒），每次写入时续期，0 表示不过期
+        prefix (str): key 前缀
+    """
+
+    def __init__(self, client, ttl: float = 0, prefix: str = "medcoach:session:"):
+        self.client = client
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    def _keys(self, session_id: str) -> tuple[str, str]:
+        return f"{self.prefix}{session_id}:state", f"{self.prefix}{session_id}:turns"
+
+    def load(self, session_id: str, max_turns: int) -> dict | None:
+        state_key, turns_key = self._keys(session_id)
+        pipe = self.client.pipeline()
+        pipe.hgetall(state_key)
+        pipe.lrange(turns_key, -max_turns, -1)
+        state, turns = pipe.execute()
+        if not state:
+            return None
+        state = {_decode(key): _decode(value) for key, value in state.items()}
+        return {
+            "version": int(state["version"]),
+            "current_mode": state["current_mode"],
+            "doctor_persona": json.loads(state["doctor_persona"]) if state.get("doctor_persona") else None,
+            "rolling_evaluation": json.loads(state["rolling_evaluation"]) if state.get("rolling_evaluation") else None,
+            "turns": [json.loads(_decode(turn)) for turn in turns],
+        }
+
+    def get_version(self, session_id: str) -> int | None:
+        version = self.client.hget(self._keys(session_id)[0], "version")
+        return int(version) if version is not None else None
+
+    def append_turn(self, session_id: str, turn: Turn):
+        _, turns_key = self._keys(session_id)
+        pipe = self.client.pipeline()
+        pipe.rpush(turns_key, json.dumps(turn.to_dict(), ensure_ascii=False))
+        if self.ttl:
+            pipe.expire(turns_key, self.ttl)
+        pipe.execute()
+
+    def save_state(self, session_id: str, expected_version: int, current_mode: str, doctor_persona: dict | None,
+                   rolling_evaluation: dict) -> int:
+        # 比较版本号和写入在同一个 Lua 脚本中原子执行
+        version = int(self.client.eval(
+            _SAVE_STATE_SCRIPT, 2, *self._keys(session_id), expected_version, current_mode,
+            json.dumps(doctor_persona, ensure_ascii=False) if doctor_persona else "",
+            json.dumps(rolling_evaluation, ensure_ascii=False), self.ttl,
+        ))
+        if version < 0:
+            raise SessionConflictError(f"session {session_id} was updated by another writer (expected version {expected_version})")
+        return version
+
+    def delete(self, session_id: str):
+        self.client.delete(*self._keys(session_id))
+
+    def save_job(self, job_id: str, state: dict, ttl: float):
+        self.client.set(f"{self.prefix}job:{job_id}", json.dumps(state, ensure_ascii=False), ex=max(int(ttl), 1))
+
+    def load_job(self, job_id: str) -> dict | None:
+        state = self.client.get(f"{self.prefix}job:{job_id}")
+        return json.loads(_decode(state)) if state is not None else None
+
+
+# KEYS: state, turns；ARGV: 预期版本号, current_mode, doctor_persona, rolling_evaluation, ttl。版本号不一致时返回 -1
+_SAVE_STATE_SCRIPT = """
+local version = tonumber(redis.call('HGET', KEYS[1], 'version') or '0')
+if version ~= tonumber(ARGV[1]) then
+    return -1
+end
+redis.call('HSET', KEYS[1], 'current_mode', ARGV[2], 'doctor_persona', ARGV[3], 'rolling_evaluation', ARGV[4], 'version', version + 1)
+if tonumber(ARGV[5]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+end
+return version + 1
+"""
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def create_session_store() -> SessionStore | None:
+    """
+    根据环境变量创建会话存储后端
+
+    SESSION_STORE: memory（默认，不持久化）| sqlite | redis
+    SESSION_STORE_PATH: SQLite 文件路径，默认 data/sessions.sqlite3
+    SESSION_STORE_URL: Redis 连接 URL，默认 redis://localhost:6379/0
+    SESSION_STORE_TTL: 会话保留时间（秒），默认 7 天
+    """
+    backend = os.getenv("SESSION_STORE", "memory").lower()
+    ttl = float(os.getenv("SESSION_STORE_TTL", 7 * 24 * 3600))
+    if backend == "sqlite":
+        default_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "sessions.sqlite3")
+        return SQLiteSessionStore(os.getenv("SESSION_STORE_PATH") or default_path, ttl=ttl)
+    if backend == "redis":
+        import redis  # 仅在使用 Redis 后端时需要安装 redis 包
+        return RedisSessionStore(redis.Redis.from_url(os.getenv("SESSION_STORE_URL", "redis://localhost:6379/0")), ttl=ttl)
+    return None
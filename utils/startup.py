@@ -0,0 +1,122 @@
+# utils/startup.py
+# 快速冷启动：.env 只加载一次；重量级依赖（strands、模型客户端、boto3）在服务开始监听后由后台线程预热，
+# /ready 据此报告就绪状态。以模块方式运行时检查 `import main` 的耗时是否超出预算：
+#   python -m utils.startup --budget 1.0
+
+import os
+import threading
+import time
+
+_env_loaded = False
+_env_lock = threading.Lock()
+
+
+def load_env():
+    """加载 .env（不覆盖已有的环境变量），同一进程内多次调用只生效一次"""
+    global _env_loaded
+    if _env_loaded:
+        return
+    with _env_lock:
+        if not _env_loaded:
+            from dotenv import load_dotenv
+            load_dotenv()
+            _env_loaded = True
+
+
+class WarmUp:
+    """
+    后台预热任务
+
+    Args:
+        tasks (dict): 任务名 -> 无参函数，按顺序在同一个后台线程中执行
+    """
+
+    def __init__(self, tasks: dict):
+        self.tasks = tasks
+        self._results = {}  # 任务名 -> {"seconds": float, "error": str | None}
+        self._thread = None
+        self._lock = threading.Lock()
+        self._started_at = None
+        self._finished_at = None
+
+    def start(self):
+        """启动预热（可重复调用，只会启动一次）"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._started_at = time.monotonic()
+                self._thread = threading.Thread(target=self._run, name="warm-up", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        for name, task in self.tasks.items():
+            started = time.perf_counter()
+            error = None
+            try:
+                task()
+            except Exception as e:
+                error = str(e)
+                print(f"Warning: warm-up task {name} failed: {error}")
+            self._results[name] = {"seconds": round(time.perf_counter() - started, 3), "error": error}
+        self._finished_at = time.monotonic()
+
+    @property
+    def ready(self) -> bool:
+        return self._finished_at is not None and not any(result["error"] for result in self._results.values())
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready,
+            "started": self._thread is not None,
+            "warm_up_seconds": round(self._finished_at - self._started_at, 3) if self._finished_at else None,
+            "tasks": {name: self._results.get(name, {"pending": True}) for name in self.tasks},
+        }
+
+
+def measure_import(module: str = "main") -> tuple[float, list[tuple[float, str]]]:
+    """
+    在全新的子进程中导入 module，返回 (耗时秒数, 按累计耗时排序的最慢导入列表)
+
+    耗时明细来自 `python -X importtime`，单位为秒。
+    """
+    import subprocess
+    import sys
+
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    elapsed = time.perf_counter() - started
+    if completed.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{completed.stderr[-2000:]}")
+
+    slowest = []
+    for line in completed.stderr.splitlines():
+        # 格式：import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        slowest.append((int(cumulative) / 1_000_000, name.rstrip()))
+    slowest.sort(reverse=True)
+    return elapsed, slowest
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="检查服务模块的导入耗时是否超出预算")
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--budget", type=float, default=float(os.getenv("IMPORT_TIME_BUDGET", 1.0)), help="允许的导入耗时（秒）")
+    parser.add_argument("--top", type=int, default=10, help="输出最慢的导入数量")
+    args = parser.parse_args()
+
+    elapsed, slowest = measure_import(args.module)
+    print(f"INFO: import {args.module} took {elapsed:.3f}s (budget {args.budget:.3f}s, includes interpreter start-up).")
+    for seconds, name in slowest[:args.top]:
+        print(f"  {seconds * 1000:8.1f} ms  {name}")
+    if elapsed > args.budget:
+        print(f"ERROR: import time exceeds budget by {elapsed - args.budget:.3f}s.")
+        sys.exit(1)
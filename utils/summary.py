@@ -0,0 +1,117 @@
+# utils/summary.py
+# 增量式训练评估：每轮对话后更新各维度的累计得分，结束训练时只需把累计状态和最近几轮对话交给模型，
+# 总结 prompt 的长度与训练轮数无关
+
+import re
+
+from .lexicon import get_matcher
+
+DIMENSIONS = ("学术性", "沟通技巧", "异议处理", "合规性")
+
+COACH_SCORE_PATTERN = re.compile(r"(\d{1,3})\s*/\s*100")
+
+
+def score_turn(doctor_utterance: str, rep_utterance: str) -> dict:
+    """
+    对单轮代表发言按四个维度做规则打分（0-100）
+
+    异议处理只在医生上一句提出了异议时打分，否则该维度为 None（不计入本轮）。
+    """
+    matcher = get_matcher()
+    rep_hits, doctor_hits = matcher.match_batch([rep_utterance, doctor_utterance])
+
+    academic = 60
+    if "academic_evidence" in rep_hits:
+        academic += 20
+    if "professional" in rep_hits:
+        academic += 10
+    if len(rep_utterance) > 50:
+        academic += 10
+
+    communication = 65
+    if "address" in rep_hits:
+        communication += 10
+    if "follow_up" in rep_hits:
+        communication += 15
+    if len(rep_utterance) < 15:
+        communication -= 15
+
+    objection = None
+    raised = doctor_hits.get("objection")
+    if raised:
+        objection = 50
+        if raised & rep_hits.get("objection", set()):
+            objection += 25
+        if "solution" in rep_hits:
+            objection += 25
+
+    compliance = 100 - 30 * len(rep_hits.get("forbidden", ()))
+
+    scores = dict(zip(DIMENSIONS, (academic, communication, objection, compliance)))
+    return {name: None if score is None else max(0, min(100, score)) for name, score in scores.items()}
+
+
+class RollingEvaluation:
+    """一个训练会话的累计评估状态，大小固定，与对话轮数无关"""
+
+    __slots__ = ("turns", "dimension_totals", "dimension_counts", "coach_score_total", "coach_score_count", "notes", "max_notes")
+
+    def __init__(self, max_notes: int = 3):
+        self.turns = 0
+        self.dimension_totals = dict.fromkeys(DIMENSIONS, 0)
+        self.dimension_counts = dict.fromkeys(DIMENSIONS, 0)
+        self.coach_score_total = 0
+        self.coach_score_count = 0
+        self.notes = []  # 最近几轮教练反馈的摘录
+        self.max_notes = max_notes
+
+    def update(self, doctor_utterance: str, rep_utterance: str, coach_feedback: str | None = None):
+        """合入一轮对话：规则维度得分 + 教练反馈中的 X/100 评分"""
+        self.turns += 1
+        for name, score in score_turn(doctor_utterance or "", rep_utterance).items():
+            if score is not None:
+                self.dimension_totals[name] += score
+                self.dimension_counts[name] += 1
+
+        if coach_feedback:
+            match = COACH_SCORE_PATTERN.search(coach_feedback)
+            if match and int(match.group(1)) <= 100:
+                self.coach_score_total += int(match.group(1))
+                self.coach_score_count += 1
+            excerpt = " ".join(coach_feedback.split())[:120]
+            self.notes.append(f"第{self.turns}轮：{excerpt}")
+            del self.notes[:-self.max_notes]
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "RollingEvaluation":
+        evaluation = cls()
+        for name, value in data.items():
+            if name in cls.__slots__:
+                setattr(evaluation, name, value)
+        return evaluation
+
+    def dimension_scores(self) -> dict:
+        return {
+            name: round(self.dimension_totals[name] / self.dimension_counts[name])
+            for name in DIMENSIONS if self.dimension_counts[name]
+        }
+
+    def coach_average(self) -> int | None:
+        if not self.coach_score_count:
+            return None
+        return round(self.coach_score_total / self.coach_score_count)
+
+    def to_prompt_text(self) -> str:
+        lines = [f"已完成对话轮数：{self.turns}"]
+        coach_average = self.coach_average()
+        if coach_average is not None:
+            lines.append(f"教练逐轮评分均值：{coach_average}/100")
+        scores = self.dimension_scores()
+        lines.append("规则维度得分：" + ("，".join(f"{name} {score}" for name, score in scores.items()) or "暂无"))
+        if self.notes:
+            lines.append("最近的教练反馈摘录：")
+            lines.extend(self.notes)
+        return "\n".join(lines)
@@ -1,8 +1,11 @@
 # utils/tools.py
 # 合并自 scenario_tool.py, objection_tool.py, eval_tool.py
 
+import os
 from typing import Any, Literal # Literal 用于 enum 类型提示
 from strands import tool # 导入 @tool 装饰器
+from .lexicon import score_utterance
+from .objection_kb import format_objections, get_knowledge_base
 
 # --- scenario_tool ---
 @tool
@@ -42,7 +45,8 @@ def scenario_tool(
 @tool
 def objection_tool(
     drug: str, 
-    topic: Literal["efficacy", "safety", "cost", "convenience"]
+    topic: Literal["efficacy", "safety", "cost", "convenience"],
+    utterance: str = ""
 ) -> dict:
     """
     给定药品，列出常见异议与要点提示
@@ -50,58 +54,21 @@ def objection_tool(
     Args:
         drug (str): 药品名称
         topic (Literal["efficacy", "safety", "cost", "convenience"]): 关注话题
+        utterance (str): 药代的发言（可选），提供时按与发言的相关度排序
     """
-    # Tool implementation - 生成常见异议和应对要点
-    objections_db = {
-        "efficacy": [
-            {
-                "objection": "这个药真的有效吗？",
-                "hint": "引用临床试验数据，说明药物的有效率和起效时间"
-            },
-            {
-                "objection": "和其他药物相比效果如何？",
-                "hint": "对比研究结果，突出药物的独特优势"
-            }
-        ],
-        "safety": [
-            {
-                "objection": "这个药有什么副作用？",
-                "hint": "诚实告知常见副作用，强调安全监测和管理措施"
-            },
-            {
-                "objection": "长期使用安全吗？",
-                "hint": "提供长期安全性数据，说明监测方案"
-            }
-        ],
-        "cost": [
-            {
-                "objection": "这个药太贵了",
-                "hint": "从性价比角度分析，提及可能的医保政策或患者援助项目"
-            }
-        ],
-        "convenience": [
-            {
-                "objection": "用药方式太复杂",
-                "hint": "详细说明用药方法，提供简化的用药指导"
-            }
-        ]
-    }
-
-    # Get objections for the specified topic
-    result = objections_db.get(topic, [
+    # Tool implementation - 从异议知识库检索常见异议和应对要点（索引在进程内只构建一次）
+    kb = get_knowledge_base()
+    top_k = int(os.getenv("OBJECTION_KB_TOP_K", 3))
+    result = kb.search(utterance, drug=drug, topic=topic, k=top_k) if utterance else []
+    result = result or kb.lookup(drug, topic, k=top_k) or [
         {
             "objection": f"关于{drug}的{topic}方面的疑虑",
             "hint": "提供专业、准确的信息回应"
         }
-    ])
+    ]
 
     # 格式化结果为文本
-    result_lines = [f"药品：{drug} | 话题：{topic}\n"]
-    for i, item in enumerate(result, 1):
-        result_lines.append(f"{i}. 异议：{item['objection']}")
-        result_lines.append(f"   应对要点：{item['hint']}\n")
-    
-    result_text = "\n".join(result_lines)
+    result_text = f"药品：{drug} | 话题：{topic}\n\n" + format_objections(result)
 
     # Return structured response
     return {
@@ -123,49 +90,10 @@ def eval_tool(
         context (str): 对话上下文
     """
     # Tool implementation - 评估回答质量
-    # 简化的评分逻辑（实际应用中可能需要更复杂的NLP分析）
-    
-    # 基础评分因素
-    score = 70  # 基础分
-    
-    # 准确性评估
-    if len(repUtterance) > 50:  # 回答有一定长度
-        score += 10
-    if "临床试验" in repUtterance or "研究" in repUtterance:  # 引用证据
-        score += 10
-    if "副作用" in repUtterance or "安全" in repUtterance:  # 提及安全性
-        score += 5
-    
-    # 合规性评估
-    forbidden_words = ["一定", "绝对", "包治", "神药"]
-    if any(word in repUtterance for word in forbidden_words):
-        score -= 20
-    
-    # 专业性评估
-    professional_terms = ["适应症", "禁忌症", "药物相互作用", "不良反应"]
-    if any(term in repUtterance for term in professional_terms):
-        score += 5
-    
-    # 确保分数在合理范围内
-    score = max(0, min(100, score))
-    
-    # 生成改进建议
-    comments = []
-    
-    if score < 60:
-        comments.append("回答需要更加专业和准确")
-    elif score < 80:
-        comments.append("可以增加更多循证医学证据")
-    else:
-        comments.append("回答质量良好")
-    
-    if len(repUtterance) < 30:
-        comments.append("建议提供更详细的信息")
-    
-    if not any(word in repUtterance for word in ["临床", "研究", "试验"]):
-        comments.append("建议引用相关临床研究数据")
-    
-    comment = "；".join(comments[:2])  # 最多取前两个建议
+    # 规则评分：合规词库由预编译的多模式匹配器单次扫描完成
+    evaluation = score_utterance(repUtterance)
+    score = evaluation["score"]
+    comment = evaluation["comment"]
 
     # 格式化结果为文本
     result_text = f"评估结果：\n分数：{score}/100\n改进建议：{comment}"
@@ -0,0 +1,479 @@
+# utils/transcription.py
+# Amazon Transcribe 异步作业管理：/transcribe 只负责提交作业，状态轮询和 S3 清理由后台调度线程统一完成
+# 按音频内容哈希去重：相同录音（浏览器重试、重复点击录音按钮）直接复用已完成的结果，或合并到进行中的作业
+# 配置了共享的会话存储后端时，作业状态同时写入后端，多 worker 部署下任一 worker 都能回答状态查询
+
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+from . import metrics
+from .clients import get_http_session
+
+SUPPORTED_MEDIA_FORMATS = ['mp3', 'mp4', 'wav', 'flac', 'ogg', 'amr', 'webm']
+
+TRANSCRIBE_DEDUP = metrics.Counter(
+    "medcoach_transcription_dedup_total", "Transcription requests by deduplication result.", ("result",),
+)
+
+# S3 分片上传的最小分片为 5 MiB
+MIN_MULTIPART_CHUNK_BYTES = 5 * 1024 * 1024
+
+DEFAULT_TRANSCRIPT_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "transcripts.sqlite3")
+
+
+class UploadTooLargeError(Exception):
+    """上传的音频超过 TRANSCRIBE_MAX_UPLOAD_BYTES"""
+
+
+class _CappedStream:
+    """
+    只读包装流：统计已读取字节数，超过上限时抛出 UploadTooLargeError
+
+    s3transfer 把 read(size) 返回不足 size 字节视为流已结束，而请求体流（如 Flask 的 request.stream）可能返回较短的数据，
+    因此这里循环读满 size 字节（或读到流末尾）再返回，避免把录音截断上传。
+    """
+
+    def __init__(self, stream, max_bytes: int | None):
+        self._stream = stream
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            chunk = self._stream.read()
+        else:
+            chunks = []
+            remaining = size
+            while remaining > 0:
+                part = self._stream.read(remaining)
+                if not part:
+                    break
+                chunks.append(part)
+                remaining -= len(part)
+            chunk = b"".join(chunks)
+        self.bytes_read += len(chunk)
+        if self.max_bytes and self.bytes_read > self.max_bytes:
+            raise UploadTooLargeError(f"音频文件超过大小上限 {self.max_bytes} 字节")
+        return chunk
+
+
+class HashingStream:
+    """
+    只读包装流：边读边计算音频内容的 SHA-256，用于识别重复提交的录音
+
+    prefetch() 预先读入开头最多 limit 字节；短录音在此时已完整读完（complete 为 True），
+    可在上传前就按哈希查找已有的转录结果，重复提交无需上传。
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._hasher = hashlib.sha256()
+        self._buffer = b""
+        self.complete = False
+
+    def prefetch(self, limit: int) -> bool:
+        chunks = []
+        total = 0
+        while total <= limit:
+            chunk = self._stream.read(min(limit + 1 - total, 1024 * 1024))
+            if not chunk:
+                self.complete = True
+                break
+            chunks.append(chunk)
+            total += len(chunk)
+        self._buffer = b"".join(chunks)
+        self._hasher.update(self._buffer)
+        return self.complete
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            chunk, self._buffer = self._buffer + self._read_stream(-1), b""
+            return chunk
+        if len(self._buffer) < size:
+            self._buffer += self._read_stream(size - len(self._buffer))
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    def _read_stream(self, size: int) -> bytes:
+        if self.complete:
+            return b""
+        chunk = self._stream.read(size)
+        if not chunk or size < 0:
+            self.complete = True
+        self._hasher.update(chunk)
+        return chunk
+
+    def hexdigest(self) -> str | None:
+        """读完全部内容后返回哈希，否则返回 None"""
+        return self._hasher.hexdigest() if self.complete else None
+
+
+def upload_audio_stream(s3_client, stream, s3_bucket: str, s3_key: str, max_bytes: int | None = None) -> int:
+    """
+    将请求体流直接分片上传到 S3，不落本地磁盘，返回上传的字节数
+
+    内存占用上限约为 分片大小 ×（并发数 + 1）（TRANSCRIBE_UPLOAD_CHUNK_BYTES、TRANSCRIBE_UPLOAD_CONCURRENCY），
+    与音频长度无关；小于一个分片的短录音直接以单次 PutObject 上传。超过 max_bytes 时中止上传并抛出 UploadTooLargeError。
+    """
+    from boto3.s3.transfer import TransferConfig
+
+    chunk_bytes = max(int(os.getenv("TRANSCRIBE_UPLOAD_CHUNK_BYTES", MIN_MULTIPART_CHUNK_BYTES)), MIN_MULTIPART_CHUNK_BYTES)
+    concurrency = int(os.getenv("TRANSCRIBE_UPLOAD_CONCURRENCY", 2))
+    config = TransferConfig(
+        multipart_threshold=chunk_bytes,
+        multipart_chunksize=chunk_bytes,
+        max_concurrency=concurrency,
+        use_threads=concurrency > 1,
+    )
+    # 不可 seek 的流由 s3transfer 逐片读入内存再并发上传，默认最多预读 10 个分片；限制为并发数，内存占用才与并发数一致
+    config.max_in_memory_upload_chunks = concurrency
+    capped = _CappedStream(stream, max_bytes)
+    try:
+        with metrics.span("s3_upload"):
+            s3_client.upload_fileobj(capped, s3_bucket, s3_key, Config=config)
+    except UploadTooLargeError:
+        raise
+    except Exception:
+        # s3transfer 可能包装读取时抛出的异常，按已读取字节数重新判断
+        if capped.max_bytes and capped.bytes_read > capped.max_bytes:
+            raise UploadTooLargeError(f"音频文件超过大小上限 {capped.max_bytes} 字节")
+        raise
+    return capped.bytes_read
+
+
+def create_transcript_cache():
+    """
+    按音频哈希缓存转录文本的 ResponseCache（内存 LRU + SQLite，带 TTL），TRANSCRIBE_CACHE_ENABLED=false 时返回 None
+
+    配置：TRANSCRIBE_CACHE_PATH（默认 data/transcripts.sqlite3）、TRANSCRIBE_CACHE_MEMORY_ENTRIES、
+    TRANSCRIBE_CACHE_MAX_BYTES、TRANSCRIBE_CACHE_TTL
+    """
+    if os.getenv("TRANSCRIBE_CACHE_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+    from .llm_cache import ResponseCache
+
+    return ResponseCache(
+        path=os.getenv("TRANSCRIBE_CACHE_PATH") or DEFAULT_TRANSCRIPT_CACHE_PATH,
+        memory_entries=int(os.getenv("TRANSCRIBE_CACHE_MEMORY_ENTRIES", 1024)),
+        max_disk_bytes=int(os.getenv("TRANSCRIBE_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+        ttl=float(os.getenv("TRANSCRIBE_CACHE_TTL", 24 * 3600)),
+    )
+
+
+class TranscriptionJob:
+    """一次转录请求的状态。status 取值：IN_PROGRESS, COMPLETED, FAILED"""
+
+    __slots__ = (
+        "job_id", "job_name", "s3_bucket", "s3_key", "status", "text", "error",
+        "created_at", "finished_at", "next_poll_at", "poll_interval", "dedup_key",
+    )
+
+    def __init__(self, job_id: str, job_name: str, s3_bucket: str | None, s3_key: str | None, poll_interval: float):
+        self.job_id = job_id
+        self.job_name = job_name
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.status = "IN_PROGRESS"
+        self.text = None
+        self.error = None
+        self.created_at = time.monotonic()
+        self.finished_at = None
+        self.next_poll_at = self.created_at + poll_interval
+        self.poll_interval = poll_interval
+        self.dedup_key = None  # 音频哈希 + 语言，用于合并相同录音的请求和写入结果缓存
+
+    def to_dict(self) -> dict:
+        result = {"job_id": self.job_id, "status": self.status}
+        if self.text is not None:
+            result["text"] = self.text
+        if self.error is not None:
+            result["error"] = self.error
+        return result
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TranscriptionJob":
+        """由共享存储中的状态快照还原（只用于回答状态查询，不参与轮询）"""
+        job = cls(data["job_id"], "", None, None, 0)
+        job.status = data["status"]
+        job.text = data.get("text")
+        job.error = data.get("error")
+        return job
+
+
+class TranscriptionScheduler:
+    """
+    后台转录作业调度器
+
+    所有进行中的作业由同一个后台线程轮询：每轮先用 list_transcription_jobs 批量查出仍在排队/处理中的作业，
+    只对已结束的作业调用 get_transcription_job 取结果。每个作业的轮询间隔按 backoff 倍数递增（自适应退避），
+    作业结束（完成、失败或超时）时统一清理 S3 上的音频文件。
+
+    Args:
+        get_transcribe_client: 返回 Transcribe 客户端的函数
+        get_s3_client: 返回 S3 客户端的函数
+        timeout (float): 单个作业最长等待时间（秒），默认读取 TRANSCRIBE_JOB_TIMEOUT
+        initial_interval (float): 首次轮询间隔（秒）
+        max_interval (float): 最大轮询间隔（秒）
+        backoff (float): 每次轮询后间隔的增长倍数
+        result_ttl (float): 已结束作业的结果保留时间（秒），超时后 GET 将返回 404
+        result_cache (ResponseCache): 按音频哈希缓存的转录文本（内存 + 磁盘，带 TTL），为空时只合并进行中的相同请求
+        job_store (SessionStore): 多个 worker 共享的存储后端，作业状态变化时写入快照；为空时状态只在本进程内可查
+    """
+
+    def __init__(self, get_transcribe_client, get_s3_client, timeout: float | None = None,
+                 initial_interval: float = 0.5, max_interval: float = 5.0, backoff: float = 1.5,
+                 result_ttl: float = 600, result_cache=None, job_store=None):
+        self.get_transcribe_client = get_transcribe_client
+        self.get_s3_client = get_s3_client
+        self.timeout = timeout or float(os.getenv("TRANSCRIBE_JOB_TIMEOUT", 120))
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.result_ttl = result_ttl
+        self.result_cache = result_cache
+        self.job_store = job_store
+        # 作业名前缀区分本进程提交的作业，便于 list_transcription_jobs 按名称批量过滤
+        self.job_name_prefix = f"transcribe_job_{uuid.uuid4().hex[:8]}_"
+        self._jobs: dict[str, TranscriptionJob] = {}
+        self._in_flight_by_key: dict[str, TranscriptionJob] = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    @staticmethod
+    def make_dedup_key(audio_hash: str, language_code: str = 'zh-CN') -> str:
+        return f"{audio_hash}:{language_code}"
+
+    def claim(self, audio_hash: str, language_code: str = 'zh-CN') -> tuple[TranscriptionJob, bool]:
+        """
+        按音频哈希查找可复用的作业，返回 (job, created)
+
+        结果缓存命中时返回一个已完成的作业；相同录音的作业仍在进行中时返回该作业（合并请求）。
+        两者都没有时创建一个占位作业（created 为 True），之后的相同请求会合并到它上面；
+        调用方上传音频后通过 submit(..., job=job) 启动，上传失败时调用 abandon()。
+        """
+        dedup_key = self.make_dedup_key(audio_hash, language_code)
+        with self._condition:
+            job = self._in_flight_by_key.get(dedup_key)
+            if job is not None:
+                TRANSCRIBE_DEDUP.inc(result="coalesced")
+                return job, False
+            text = self.result_cache.get(dedup_key) if self.result_cache is not None else None
+            if text is not None:
+                TRANSCRIBE_DEDUP.inc(result="cache_hit")
+                job, created = self._register_cached(text), False
+            else:
+                TRANSCRIBE_DEDUP.inc(result="miss")
+                job, created = self._new_job(), True
+                job.dedup_key = dedup_key
+                # 上传完成、作业启动前不轮询；上传方异常退出未调用 abandon() 时按作业超时结束
+                job.next_poll_at = job.created_at + self.timeout + self.max_interval
+                self._jobs[job.job_id] = job
+                self._in_flight_by_key[dedup_key] = job
+            # 占位作业同样需要后台线程：上传方未调用 submit / abandon 时由它按超时结束，缓存命中的结果也由它按 result_ttl 清理
+            self._ensure_started()
+        self._publish(job)
+        return job, created
+
+    def submit(self, s3_bucket: str, s3_key: str, media_format: str, language_code: str = 'zh-CN',
+               job: TranscriptionJob | None = None, audio_hash: str | None = None) -> TranscriptionJob:
+        """
+        为已上传到 S3 的音频启动转录作业。启动失败时作业直接标记为 FAILED（S3 文件同样会被清理）
+
+        job 为 claim() 返回的占位作业。传入 audio_hash（上传时才算出哈希的长录音）时先按哈希去重，
+        命中时删除刚上传的文件并返回已有的作业。
+        """
+        if job is None and audio_hash is not None:
+            job, created = self.claim(audio_hash, language_code)
+            if not created:
+                self._delete_object(s3_bucket, s3_key)
+                return job
+        if job is None:
+            job = self._new_job()
+            self._publish(job)
+
+        job.s3_bucket = s3_bucket
+        job.s3_key = s3_key
+        job.next_poll_at = time.monotonic() + job.poll_interval
+        try:
+            with metrics.span("transcribe_start"):
+                self.get_transcribe_client().start_transcription_job(
+                    TranscriptionJobName=job.job_name,
+                    Media={'MediaFileUri': f"s3://{s3_bucket}/{s3_key}"},
+                    MediaFormat=media_format if media_format in SUPPORTED_MEDIA_FORMATS else 'webm',
+                    LanguageCode=language_code,
+                    Settings={
+                        'ShowSpeakerLabels': False,
+                    }
+                )
+        except Exception as e:
+            self._finish(job, "FAILED", error=f"启动转录作业失败: {str(e)}")
+            return job
+
+        with self._condition:
+            self._jobs[job.job_id] = job
+            self._ensure_started()
+            self._condition.notify()
+        return job
+
+    def abandon(self, job: TranscriptionJob, error: str):
+        """claim() 创建的占位作业未能启动（如上传失败）时结束它，合并到该作业的请求会收到同样的错误"""
+        self._finish(job, "FAILED", error=error)
+
+    def get(self, job_id: str, include_shared: bool = True) -> TranscriptionJob | None:
+        """本进程的作业；不在本进程时（由其他 worker 受理）按 include_shared 查询共享存储中的快照"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+        if job is None and include_shared:
+            job = self.get_shared(job_id)
+        return job
+
+    def get_shared(self, job_id: str) -> TranscriptionJob | None:
+        if self.job_store is None:
+            return None
+        try:
+            state = self.job_store.load_job(job_id)
+        except Exception as e:
+            print(f"Warning: failed to load transcription job {job_id} from the session store: {str(e)}")
+            return None
+        return TranscriptionJob.from_dict(state) if state is not None else None
+
+    def in_flight_count(self) -> int:
+        with self._condition:
+            return sum(1 for job in self._jobs.values() if job.status == "IN_PROGRESS")
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name="transcription-scheduler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                now = time.monotonic()
+                self._drop_expired_results(now)
+                in_flight = [job for job in self._jobs.values() if job.status == "IN_PROGRESS"]
+                due = [job for job in in_flight if job.next_poll_at <= now]
+                if not due:
+                    wait = min((job.next_poll_at for job in in_flight), default=now + self.result_ttl) - now
+                    self._condition.wait(timeout=max(wait, 0.05))
+                    continue
+            self._poll(due)
+
+    def _poll(self, due: list[TranscriptionJob]):
+        now = time.monotonic()
+        try:
+            active_names = self._list_active_job_names() if len(due) > 1 else None
+        except Exception as e:
+            print(f"Warning: list_transcription_jobs failed, falling back to per-job polling: {str(e)}")
+            active_names = None
+
+        for job in due:
+            if now - job.created_at > self.timeout:
+                self._finish(job, "FAILED", error="转录作业超时")
+                continue
+            if active_names is not None and job.job_name in active_names:
+                self._reschedule(job, now)
+                continue
+            try:
+                status = self.get_transcribe_client().get_transcription_job(TranscriptionJobName=job.job_name)
+                job_status = status['TranscriptionJob']['TranscriptionJobStatus']
+                if job_status == 'COMPLETED':
+                    transcript_file_uri = status['TranscriptionJob']['Transcript']['TranscriptFileUri']
+                    with metrics.span("transcript_download"):
+                        transcript_data = get_http_session().get(transcript_file_uri, timeout=10).json()
+                    self._finish(job, "COMPLETED", text=transcript_data['results']['transcripts'][0]['transcript'])
+                elif job_status == 'FAILED':
+                    failure_reason = status['TranscriptionJob'].get('FailureReason', '未知原因')
+                    self._finish(job, "FAILED", error=f"转录作业失败: {failure_reason}")
+                else:
+                    self._reschedule(job, now)
+            except Exception as e:
+                self._finish(job, "FAILED", error=f"检查转录状态失败: {str(e)}")
+
+    def _list_active_job_names(self) -> set[str]:
+        """一次性列出本进程所有仍在排队或处理中的作业名"""
+        client = self.get_transcribe_client()
+        names = set()
+        for status in ('QUEUED', 'IN_PROGRESS'):
+            kwargs = {'Status': status, 'JobNameContains': self.job_name_prefix, 'MaxResults': 100}
+            while True:
+                page = client.list_transcription_jobs(**kwargs)
+                names.update(summary['TranscriptionJobName'] for summary in page.get('TranscriptionJobSummaries', []))
+                if not page.get('NextToken'):
+                    break
+                kwargs['NextToken'] = page['NextToken']
+        return names
+
+    def _new_job(self) -> TranscriptionJob:
+        job_id = uuid.uuid4().hex
+        return TranscriptionJob(job_id, f"{self.job_name_prefix}{job_id}", None, None, self.initial_interval)
+
+    def _register_cached(self, text: str) -> TranscriptionJob:
+        """为缓存命中的结果登记一个已完成的作业，客户端可照常通过 job_id 查询"""
+        job = self._new_job()
+        job.status = "COMPLETED"
+        job.text = text
+        job.finished_at = time.monotonic()
+        self._jobs[job.job_id] = job
+        return job
+
+    def _publish(self, job: TranscriptionJob):
+        """把作业状态快照写入共享存储（作业创建和结束时各一次），保留到结果过期为止"""
+        if self.job_store is None:
+            return
+        try:
+            self.job_store.save_job(job.job_id, job.to_dict(), self.timeout + self.max_interval + self.result_ttl)
+        except Exception as e:
+            print(f"Warning: failed to publish transcription job {job.job_id}: {str(e)}")
+
+    def _delete_object(self, s3_bucket: str, s3_key: str):
+        try:
+            self.get_s3_client().delete_object(Bucket=s3_bucket, Key=s3_key)
+        except Exception:
+            pass
+
+    def _reschedule(self, job: TranscriptionJob, now: float):
+        job.poll_interval = min(job.poll_interval * self.backoff, self.max_interval)
+        job.next_poll_at = now + job.poll_interval
+
+    def _finish(self, job: TranscriptionJob, status: str, text: str | None = None, error: str | None = None):
+        """作业结束的唯一出口：记录结果、清理 S3 上的音频文件，并把成功的结果写入去重缓存"""
+        if job.s3_key is not None:
+            self._delete_object(job.s3_bucket, job.s3_key)
+        if status == "COMPLETED" and job.dedup_key is not None and self.result_cache is not None:
+            try:
+                self.result_cache.put(job.dedup_key, text)
+            except Exception as e:
+                print(f"Warning: failed to cache transcript: {str(e)}")
+        job.text = text
+        job.error = error
+        job.finished_at = time.monotonic()
+        job.status = status
+        self._publish(job)
+        if job.dedup_key is not None:
+            with self._condition:
+                if self._in_flight_by_key.get(job.dedup_key) is job:
+                    del self._in_flight_by_key[job.dedup_key]
+        # 从提交到结束的总耗时（Transcribe 排队 + 处理 + 轮询间隔）
+        metrics.STAGE_SECONDS.observe(job.finished_at - job.created_at, stage="transcribe_job", mode="none")
+        metrics.TRANSCRIBE_JOBS.inc(status=status)
+
+    def _drop_expired_results(self, now: float):
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.result_ttl]
+        for job_id in expired:
+            del self._jobs[job_id]